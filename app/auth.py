@@ -1,23 +1,22 @@
+import hashlib
+import time
 from datetime import datetime, timedelta
-from typing import Any, Dict, Union
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, Tuple, Union
 
 import jwt
-import requests
 from fastapi import Depends, HTTPException
 from fastapi.openapi.models import HTTPBearer
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security.base import SecurityBase
-from jwt import PyJWKClient
+from jwt.exceptions import PyJWKClientConnectionError
 from starlette.requests import Request
 from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
 
-from app import schemas
+from app import oidc, schemas
+from app.cache import LocalCache
 from app.config import settings
 
-B2C_CONFIG=requests.get(settings.azure_b2c_openidconfiguration).json()
-AD_CONFIG=requests.get(settings.azure_ad_openidconfiguration).json()
-b2c_jwks_client = PyJWKClient(B2C_CONFIG['jwks_uri'])
-ad_jwks_client = PyJWKClient(AD_CONFIG['jwks_uri'])
-
 class BearerAuth(SecurityBase):
     def __init__(
         self
@@ -41,108 +40,215 @@ class BearerAuth(SecurityBase):
             )
 auth_scheme=BearerAuth()
 
-def verify_jwt(token:str=Depends(auth_scheme))->Dict[str,Any]:
+### 検証済みのトークンのキャッシュ
+# 同じユーザーは同じトークンで何百回もリクエストしてくるので、RS256の検証はトークンごとに1回だけにする
+# キーはトークンのSHA-256、値は(検証できたか, claimsまたはエラーメッセージ)
+# - 検証できたトークンはexpまでキャッシュする
+# - 不正なトークンも短い間(JWT_NEGATIVE_CACHE_EXPIRE)キャッシュし、同じ不正なトークンを連打されても検証し直さない
+verified_tokens=LocalCache(settings.jwt_cache_max_entries,settings.jwt_negative_cache_expire)
+
+async def verify_jwt(token:str=Depends(auth_scheme))->Dict[str,Any]:
+    # キャッシュにあるトークンはイベントループ上でそのまま返し、RS256の検証(公開鍵の取得を含む)だけをスレッドプールで行う
+    key=hashlib.sha256(token.encode()).hexdigest()
+    cached=verified_tokens.get(key)
+    if cached is not None:
+        verified,result=cached
+        if verified:
+            return result
+        raise HTTPException(status_code=HTTP_401_UNAUTHORIZED,detail=result)
+    return await run_in_threadpool(_verify_and_cache,token,key)
+
+def _verify_and_cache(token:str,key:str)->Dict[str,Any]:
     try:
-        header=jwt.get_unverified_header(token)
-        payload=jwt.decode(token,options={"verify_signature": False})
-        if payload.get("iss")==B2C_CONFIG['issuer']:
-            signing_key = b2c_jwks_client.get_signing_key_from_jwt(token)
-            decoded_jwt = jwt.decode(token, signing_key.key, algorithms=header['alg'],audience=settings.azure_b2c_audience)
-            return decoded_jwt
-        elif payload.get("iss")==AD_CONFIG['issuer']:
-            signing_key = ad_jwks_client.get_signing_key_from_jwt(token)
-            decoded_jwt = jwt.decode(token, signing_key.key, algorithms=header['alg'],audience=settings.azure_ad_audience)
-            return decoded_jwt
-        else:
-            raise HTTPException(status_code=HTTP_401_UNAUTHORIZED,detail="不正なトークンです")
-    except Exception as e:
+        decoded_jwt=decode_jwt(token)
+    except (PyJWKClientConnectionError,oidc.OIDCUnavailableError) as e:
+        # 公開鍵・設定を取得できなかっただけでトークンが不正とは限らないのでキャッシュしない
         raise HTTPException(status_code=HTTP_401_UNAUTHORIZED,detail=f"不正なトークンです( {e} )")
-
-def get_current_user(decoded_jwt:Dict = Depends(verify_jwt))->schemas.JWTUser:
+    except Exception as e:
+        detail=f"不正なトークンです( {e} )"
+        verified_tokens.set(key,(False,detail))
+        raise HTTPException(status_code=HTTP_401_UNAUTHORIZED,detail=detail)
+    if decoded_jwt.get("exp"):
+        verified_tokens.set(key,(True,decoded_jwt),ttl=decoded_jwt["exp"]-time.time())
+    return decoded_jwt
+
+def jwt_cache_metrics()->Dict[str,Union[int,float]]:
+    hits=verified_tokens.hits
+    misses=verified_tokens.misses
+    return {
+        "hits":hits,
+        "misses":misses,
+        "entries":len(verified_tokens),
+        "hit_rate":hits/(hits+misses) if hits+misses else 0.0,
+    }
+
+def _provider_of(iss:Union[str,None])->Union[oidc.OIDCProvider,None]:
+    """issを発行したプロバイダー(B2C・AD) どれとも一致しなければNone
+
+    設定を読み込めないプロバイダーは飛ばして残りと比べるので、片方のプロバイダーの障害で他方のトークンまで拒否しない
+    どれとも一致せず、読み込めなかったプロバイダーがある時は(そのプロバイダーのトークンかもしれないので)OIDCUnavailableErrorを投げる
+    """
+    unavailable=None
+    for provider in (oidc.b2c,oidc.ad):
+        try:
+            if iss==provider.issuer:
+                return provider
+        except oidc.OIDCUnavailableError as e:
+            unavailable=e
+    if unavailable is not None:
+        raise unavailable
+    return None
+
+def decode_jwt(token:str)->Dict[str,Any]:
+    """トークンの署名・aud・expを検証してpayloadを返す 不正なトークンの場合は例外を投げる"""
+    header=jwt.get_unverified_header(token)
+    payload=jwt.decode(token,options={"verify_signature": False})
+    provider=_provider_of(payload.get("iss"))
+    if provider is None:
+        raise HTTPException(status_code=HTTP_401_UNAUTHORIZED,detail="不正なトークンです")
+    audience=settings.azure_b2c_audience if provider is oidc.b2c else settings.azure_ad_audience
+    signing_key = provider.jwks_client.get_signing_key_from_jwt(token)
+    decoded_jwt = jwt.decode(token, signing_key.key, algorithms=header['alg'],audience=audience)
+    return decoded_jwt
+
+async def get_current_user(decoded_jwt:Dict = Depends(verify_jwt))->schemas.JWTUser:
     user = schemas.JWTUser(**decoded_jwt)
     return user
 
 def user_object_id(user:schemas.JWTUser):
-    if user.iss == B2C_CONFIG['issuer']:
+    provider=_provider_of(user.iss)
+    if provider is oidc.b2c:
         return user.sub
-    elif user.iss == AD_CONFIG['issuer']:
+    elif provider is oidc.ad:
         if user.oid is not None:
             return user.oid
     raise Exception("User Object IDがありません")
 
-#例外を発生させないことで、ログインしてるならユーザー情報が取れるし、してないならNoneを返すようにする(顔出し画像が入る可能性があるカバー画像をレスポンスするか決める)
-def get_current_user_not_exception():
+### Role
+"""
+ユーザーのロールはトークン(のclaims)ごとに1回だけ計算し、各check_XXX()はその集合に含まれるかを見るだけにする
+- 今まではcheck_XXX()のたびにuser.groups(リスト)を何度も走査していた
+- 同じトークンで何度もリクエストが来るので、(発行元, groups, 入校処理済みか)が同じなら計算結果を使い回す(_resolve_roles)
+- 計算した結果はJWTUserに保持するので、1リクエストの中で何度check_XXX()を呼んでも計算は1回
+- 依存関係として使うadmin()などはDBもネットワークも使わないのでasync defにしている(async defのエンドポイントでスレッドプールを経由しないように)
+"""
+
+GUEST="guest" # schemas.UserRoleには無いがcheck_guest()で使うロール
+
+# クラス(団体のid)とそのクラスの保護者のAzure ADのグループ
+PARENTS_GROUPS_OF_CLASS:Dict[str,str]={
+    f"{grade}{cls}r":getattr(settings,f"azure_ad_groups_quaint_parents_{grade}{cls}r")
+    for grade in range(1,4)
+    for cls in range(1,9)
+}
+
+def _issuer_kind(user:schemas.JWTUser)->Union[str,None]:
+    # Azureの設定を取得できない場合はどちらでもないとする(今までのcheck_b2c・check_adと同じ)
     try:
-        user=verify_jwt()
-        return user
-    except:
+        provider=_provider_of(user.iss)
+    except oidc.OIDCUnavailableError:
         return None
+    if provider is oidc.b2c:
+        return "b2c"
+    if provider is oidc.ad:
+        return "ad"
+    return None
+
+@lru_cache(maxsize=1024)
+def _resolve_roles(issuer_kind:Union[str,None],groups:FrozenSet[str],visited:bool)->Tuple[FrozenSet[Union[schemas.UserRole,str]],FrozenSet[str]]:
+    """(ロールの集合, 保護者として登録されているクラスの集合)を返す"""
+    roles={schemas.UserRole.everyone}
+    is_admin=settings.azure_ad_groups_quaint_admin in groups
+    if is_admin:
+        roles.add(schemas.UserRole.admin)
+    for role,group in (
+        (schemas.UserRole.owner,settings.azure_ad_groups_quaint_owner),
+        (schemas.UserRole.chief,settings.azure_ad_groups_quaint_chief),
+        (schemas.UserRole.entry,settings.azure_ad_groups_quaint_entry),
+        (GUEST,settings.azure_ad_groups_quaint_guest),
+    ):
+        if is_admin or group in groups:
+            roles.add(role)
+
+    is_b2c_visited=issuer_kind=="b2c" and visited
+    is_ad=issuer_kind=="ad"
+    is_parents=is_ad and settings.azure_ad_groups_quaint_parents in groups
+    is_school=is_ad and (settings.azure_ad_groups_quaint_students in groups or settings.azure_ad_groups_quaint_teachers in groups)
+    for role,has_role in (
+        (schemas.UserRole.b2c,issuer_kind=="b2c"),
+        (schemas.UserRole.b2c_visited,is_b2c_visited),
+        (schemas.UserRole.ad,is_ad),
+        (schemas.UserRole.parents,is_parents),
+        (schemas.UserRole.students,is_ad and settings.azure_ad_groups_quaint_students in groups),
+        (schemas.UserRole.school,is_school),
+        (schemas.UserRole.visited,is_b2c_visited or is_ad),
+        (schemas.UserRole.visited_parents,is_b2c_visited or is_parents),
+        (schemas.UserRole.visited_school,is_b2c_visited or is_school),
+        (schemas.UserRole.school_parents,is_school or is_parents),
+    ):
+        if has_role:
+            roles.add(role)
+    # paperはどのユーザーも持たない(紙整理券の公演はWebから取得できない)
+
+    # ??r-parentsに存在するもののquaint-parentsに存在していない場合があるのでquaint-parentsにいることも条件にしている
+    parent_classes=frozenset(
+        cls for cls,group in PARENTS_GROUPS_OF_CLASS.items() if is_parents and group in groups
+    )
+    return frozenset(roles),parent_classes
+
+def _roles_of(user:schemas.JWTUser)->Tuple[FrozenSet[Union[schemas.UserRole,str]],FrozenSet[str]]:
+    if user._roles is None:
+        user._roles=_resolve_roles(
+            _issuer_kind(user),
+            frozenset(user.groups or ()),
+            bool(user.jobTitle and ('Visited' in user.jobTitle or 'visited' in user.jobTitle)),
+        )
+    return user._roles
+
+def roles(user:schemas.JWTUser)->FrozenSet[Union[schemas.UserRole,str]]:
+    """ユーザーが持っているロール(schemas.UserRoleとGUEST)の集合"""
+    return _roles_of(user)[0]
 
-### Role
-def check_admin(user:schemas.JWTUser):
+def check_role(role:schemas.UserRole,user:schemas.JWTUser):
     try:
-        if user.groups and settings.azure_ad_groups_quaint_admin in user.groups:
-            return True
-        else:
-            return False
-    except:
+        return schemas.UserRole(role) in roles(user)
+    except ValueError:
         return False
-def admin(user:schemas.JWTUser = Depends(get_current_user)):
+
+def check_admin(user:schemas.JWTUser):
+    return schemas.UserRole.admin in roles(user)
+async def admin(user:schemas.JWTUser = Depends(get_current_user)):
     if check_admin(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="admin(管理者)の権限がありません")
 def check_owner(user:schemas.JWTUser):
-    try:
-        if (user.groups and settings.azure_ad_groups_quaint_owner in user.groups) or check_admin(user):
-            return True
-        else:
-            return False
-    except:
-        return False
-def owner(user:schemas.JWTUser = Depends(get_current_user)):
+    return schemas.UserRole.owner in roles(user) # owner or admin
+async def owner(user:schemas.JWTUser = Depends(get_current_user)):
     if  check_owner(user): # owner or admin
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="Owner(クラ代・団体代表者)の権限がありません")
 def check_chief(user:schemas.JWTUser):
-    try:
-        if (user.groups and settings.azure_ad_groups_quaint_chief in user.groups) or check_admin(user):
-            return True
-        else:
-            return False
-    except:
-        return False
-def chief(user:schemas.JWTUser=Depends(get_current_user)):
+    return schemas.UserRole.chief in roles(user) # chief or admin
+async def chief(user:schemas.JWTUser=Depends(get_current_user)):
     if check_chief(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="チーフ会である必要があります")
 
 def check_guest(user:schemas.JWTUser):
-    try:
-        if (user.groups and settings.azure_ad_groups_quaint_guest in user.groups) or check_admin(user):
-            return True
-        else:
-            return False
-    except:
-        return False
+    return GUEST in roles(user) # guest or admin
 
-def guest(user:schemas.JWTUser=Depends(get_current_user)):
+async def guest(user:schemas.JWTUser=Depends(get_current_user)):
     if check_guest(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN, detail="ゲストである必要があります")
 
 def check_entry(user:schemas.JWTUser):
-    try:
-        if (user.groups and settings.azure_ad_groups_quaint_entry in user.groups) or check_admin(user):
-            return True
-        else:
-            return False
-    except:
-        return False
-def entry(user:schemas.JWTUser = Depends(get_current_user)):
+    return schemas.UserRole.entry in roles(user) # entry or admin
+async def entry(user:schemas.JWTUser = Depends(get_current_user)):
     if check_entry(user): # entry or admin
         return user
     else:
@@ -158,324 +264,85 @@ def paper():
     return False
 
 def check_b2c(user:schemas.JWTUser):
-    try:
-        if user.iss==B2C_CONFIG['issuer']:
-            return True
-        else:
-            return False
-    except:
-        return False
-def b2c(user:schemas.JWTUser=Depends(get_current_user)):
+    return schemas.UserRole.b2c in roles(user)
+async def b2c(user:schemas.JWTUser=Depends(get_current_user)):
     if check_b2c(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="一般アカウントを作成してログインしてください")
 
 def check_b2c_visited(user:schemas.JWTUser):
-    try:
-        if user.iss==B2C_CONFIG['issuer'] and (user.jobTitle and ('Visited' in user.jobTitle or 'visited' in user.jobTitle)):
-            return True
-        else:
-            return False
-    except:
-        return False
-def b2c_visited(user:schemas.JWTUser=Depends(get_current_user)):
+    return schemas.UserRole.b2c_visited in roles(user)
+async def b2c_visited(user:schemas.JWTUser=Depends(get_current_user)):
     if check_b2c_visited(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="入校処理を済ませている必要があります")
 def check_ad(user:schemas.JWTUser):
-    try:
-        if user.iss==AD_CONFIG['issuer']:
-            return True
-        else:
-            return False
-    except:
-        return False
-def ad(user:schemas.JWTUser=Depends(get_current_user)):
+    return schemas.UserRole.ad in roles(user)
+async def ad(user:schemas.JWTUser=Depends(get_current_user)):
     if check_ad(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="学校のアカウント、もしくは事前配布されたアカウントである必要があります")
 def check_parents(user:schemas.JWTUser):
-    if check_ad(user) and (user.groups and settings.azure_ad_groups_quaint_parents in user.groups):
-        return True
-    else:
-        return False
-def parents(user:schemas.JWTUser=Depends(get_current_user)):
+    return schemas.UserRole.parents in roles(user)
+async def parents(user:schemas.JWTUser=Depends(get_current_user)):
     if check_parents(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="本校保護者である必要があります")
 
-"""
-check_parents_??r(user : schemas.JWTUser)
-判定項目
-- admin
-- 保護者か（quaint-parentsに存在）
-- ??rの保護者か(??r-parentsに存在)
+def check_parents_of(group_id:str,user:schemas.JWTUser):
+    """group_id(??r)のクラスの保護者か
 
-??r-parentsに存在するもののquaint-parentsに存在していない場合があるのでcheck_parentsもつけている
-"""
-
-# 11rの保護者か
-def check_parents_11r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_11r in user.groups):
-        return True
-    else:
-        return False
-
-# 12rの保護者か
-def check_parents_12r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_12r in user.groups):
-        return True
-    else:
-        return False
-
-# 13rの保護者か
-def check_parents_13r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_13r in user.groups):
-        return True
-    else:
-        return False
-
-# 14rの保護者か
-def check_parents_14r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_14r in user.groups):
-        return True
-    else:
-        return False
-
-# 15rの保護者か
-def check_parents_15r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_15r in user.groups):
-        return True
-    else:
-        return False
-
-# 16rの保護者か
-def check_parents_16r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_16r in user.groups):
-        return True
-    else:
-        return False
-    
-# 17rの保護者か
-def check_parents_17r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_17r in user.groups):
-        return True
-    else:
-        return False
-    
-# 18rの保護者か
-def check_parents_18r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_18r in user.groups):
-        return True
-    else:
-        return False
-    
-# 21rの保護者か
-def check_parents_21r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_21r in user.groups):
-        return True
-    else:
-        return False
-    
-# 22rの保護者か
-def check_parents_22r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_22r in user.groups):
-        return True
-    else:
-        return False
-
-# 23rの保護者か
-def check_parents_23r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_23r in user.groups):
-        return True
-    else:
-        return False
-
-# 24rの保護者か
-def check_parents_24r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_24r in user.groups):
-        return True
-    else:
-        return False
-
-# 25rの保護者か
-def check_parents_25r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_25r in user.groups):
-        return True
-    else:
-        return False
-
-# 26rの保護者か
-def check_parents_26r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_26r in user.groups):
-        return True
-    else:
-        return False
-
-# 27rの保護者か
-def check_parents_27r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_27r in user.groups):
-        return True
-    else:
-        return False
-
-# 28rの保護者か
-def check_parents_28r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_28r in user.groups):
-        return True
-    else:
-        return False
-
-# 31rの保護者か
-def check_parents_31r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_31r in user.groups):
-        return True
-    else:
-        return False
-
-# 32rの保護者か
-def check_parents_32r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_32r in user.groups):
-        return True
-    else:
-        return False
-
-# 33rの保護者か
-def check_parents_33r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_33r in user.groups):
-        return True
-    else:
-        return False
-
-# 34rの保護者か
-def check_parents_34r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_34r in user.groups):
-        return True
-    else:
-        return False
-
-# 35rの保護者か
-def check_parents_35r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_35r in user.groups):
-        return True
-    else:
-        return False
-
-# 36rの保護者か
-def check_parents_36r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_36r in user.groups):
-        return True
-    else:
-        return False
-    
-# 37rの保護者か
-def check_parents_37r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_37r in user.groups):
-        return True
-    else:
-        return False
-
-# 38rの保護者か
-def check_parents_38r(user:schemas.JWTUser):
-    if check_ad(user) and check_parents(user) and (user.groups and settings.azure_ad_groups_quaint_parents_38r in user.groups):
-        return True
-    else:
-        return False
+    判定項目
+    - 保護者か（quaint-parentsに存在）
+    - ??rの保護者か(??r-parentsに存在)
+    """
+    return group_id in _roles_of(user)[1]
 
 def check_students(user:schemas.JWTUser):
-    if check_ad(user) and (user.groups and settings.azure_ad_groups_quaint_students in user.groups):
-        return True
-    else:
-        return False
+    return schemas.UserRole.students in roles(user)
 def students(user:schemas.JWTUser):
     if check_students(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="本校生徒である必要があります")
 def check_school(user:schemas.JWTUser):
-    if check_ad(user) and user.groups and (settings.azure_ad_groups_quaint_students in user.groups or settings.azure_ad_groups_quaint_teachers in user.groups):
-        return True
-    else:
-        return False
-def school(user:schemas.JWTUser=Depends(get_current_user)):
+    return schemas.UserRole.school in roles(user)
+async def school(user:schemas.JWTUser=Depends(get_current_user)):
     if check_school(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="本校生徒・教職員・学校関係者である必要があります")
 def check_visited(user:schemas.JWTUser):
-    return check_b2c_visited(user) or check_ad(user)
+    return schemas.UserRole.visited in roles(user)
 
-def visited(user:schemas.JWTUser=Depends(get_current_user)):
+async def visited(user:schemas.JWTUser=Depends(get_current_user)):
     if check_visited(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="入校処理がされていません")
 def check_visited_parents(user:schemas.JWTUser):
-    return check_b2c_visited(user) or check_parents(user)
+    return schemas.UserRole.visited_parents in roles(user)
 
-def visited_parents(user:schemas.JWTUser=Depends(get_current_user)):
+async def visited_parents(user:schemas.JWTUser=Depends(get_current_user)):
     if check_visited_parents(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="入校処理済みの一般アカウント、もしくは本校保護者である必要があります")
 def check_visited_school(user:schemas.JWTUser):
-    return  check_b2c_visited(user) or check_school(user)
-def visited_school(user:schemas.JWTUser=Depends(get_current_user)):
+    return schemas.UserRole.visited_school in roles(user)
+async def visited_school(user:schemas.JWTUser=Depends(get_current_user)):
     if check_visited_school(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="入校処理済みの一般アカウント、もしくは本校生徒・教職員・学校関係者である必要があります")
 def check_school_parents(user:schemas.JWTUser):
-    return check_school(user) or check_parents(user)
-def shool_parents(user:schemas.JWTUser=Depends(get_current_user)):
+    return schemas.UserRole.school_parents in roles(user)
+async def shool_parents(user:schemas.JWTUser=Depends(get_current_user)):
     if check_school_parents(user):
         return user
     else:
         raise HTTPException(HTTP_403_FORBIDDEN,detail="保護者、もしくは本校生徒・教職員・学校関係者である必要があります")
-
-def check_role(role:schemas.UserRole,user:schemas.JWTUser):
-    # 絶対もっといい方法ある
-    if role==schemas.UserRole.admin:
-        return check_admin(user)
-    elif role==schemas.UserRole.owner:
-        return check_owner(user)
-    elif role==schemas.UserRole.chief:
-        return check_chief(user)
-    elif role==schemas.UserRole.entry:
-        return check_entry(user)
-    elif role==schemas.UserRole.everyone:
-        return check_everyone(user)
-    elif role==schemas.UserRole.paper:
-        return check_paper(user)
-    elif role==schemas.UserRole.b2c:
-        return check_b2c(user)
-    elif role==schemas.UserRole.b2c_visited:
-        return check_b2c_visited(user)
-    elif role==schemas.UserRole.ad:
-        return check_ad(user)
-    elif role==schemas.UserRole.parents:
-        return check_parents(user)
-    elif role==schemas.UserRole.students:
-        return check_students(user)
-    elif role==schemas.UserRole.school:
-        return check_school(user)
-    elif role==schemas.UserRole.visited:
-        return check_visited(user)
-    elif role==schemas.UserRole.visited_parents:
-        return check_visited_parents(user)
-    elif role==schemas.UserRole.visited_school:
-        return check_visited_school(user)
-    elif role==schemas.UserRole.school_parents:
-        return check_school_parents(user)
-    else:
-        return False
-
-
-
-    
-
-
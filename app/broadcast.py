@@ -0,0 +1,174 @@
+import json
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Tuple, Union
+
+import redis
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from app import crud, schemas, sse
+from app.config import settings
+from app.db import SessionLocal
+from app.redis_possible import get_redis_if_possible, report_redis_error
+
+"""
+Hebe(今やっている・次の団体)とお知らせを、workerのメモリに持っておいて返す・Server-Sent Eventsで配信する
+
+サイネージの画面は GET /hebe/nowplaying, /hebe/upnext, /news を繰り返し読みに来るので、そのたびにDBを読んでいた
+- 各workerは話題(TOPICS)ごとの最新の値(スナップショット)をメモリに持ち、GETはそれを返す
+- 変更したcrudの関数がcommitした後にpublish()を呼ぶと、そのセッションで読み直した値をRedisのpub/sub(CHANNEL)で全workerに送る
+  各workerは受け取った値でスナップショットを置き換え、GET /hebe/stream, /news/stream に接続しているブラウザに送る(app/sse.py)
+- 通知を取りこぼした時やRedisに接続できない時のため、BROADCAST_REFRESH秒より古いスナップショットはDBから読み直す
+"""
+
+CHANNEL = "quaint-broadcast"
+
+
+def _load_hebe(db: Session) -> Dict[str, Any]:
+    values = {}
+    for name, get in [
+        ("nowplaying", crud.get_hebe_nowplaying),
+        ("upnext", crud.get_hebe_upnext),
+    ]:
+        hebe = get(db)
+        values[name] = {"group_id": hebe.group_id if hebe is not None else ""}
+    return values
+
+
+def _load_news(db: Session) -> Any:
+    return [
+        json.loads(schemas.NewsBase.from_orm(news).json())
+        for news in crud.get_all_news(db)
+    ]
+
+
+# 話題ごとに、DBから値を読む関数 値はJSONにできるもの
+TOPICS: Dict[str, Callable[[Session], Any]] = {
+    "hebe": _load_hebe,
+    "news": _load_news,
+}
+
+
+_snapshots: Dict[str, Tuple[float, Any, str]] = {}  # 話題 → (読んだ時刻, 値, 値のJSON)
+_lock = threading.Lock()
+_load_locks = {topic: threading.Lock() for topic in TOPICS}
+
+
+def _set(topic: str, value: Any) -> None:
+    """スナップショットを置き換えて、変わっていれば接続しているブラウザに送る"""
+    encoded = json.dumps(value, ensure_ascii=False)
+    with _lock:
+        previous = _snapshots.get(topic)
+        _snapshots[topic] = (time.monotonic(), value, encoded)
+    if previous is not None and previous[2] == encoded:
+        return
+    _hub.send(topic, sse.message(topic, encoded))
+
+
+def _fresh(topic: str) -> Union[Tuple[float, Any, str], None]:
+    with _lock:
+        snapshot = _snapshots.get(topic)
+    if snapshot is None:
+        return None
+    if time.monotonic() - snapshot[0] > float(settings.broadcast_refresh):
+        return None
+    return snapshot
+
+
+def _current(topic: str) -> Tuple[float, Any, str]:
+    snapshot = _fresh(topic)
+    if snapshot is not None:
+        return snapshot
+    # 同時に来たリクエストのうち1つだけがDBから読む
+    with _load_locks[topic]:
+        snapshot = _fresh(topic)
+        if snapshot is not None:
+            return snapshot
+        db = SessionLocal()
+        try:
+            _set(topic, TOPICS[topic](db))
+        finally:
+            db.close()
+    with _lock:
+        return _snapshots[topic]
+
+
+def current(topic: str) -> Any:
+    """話題の最新の値 スナップショットが無い・古い時はDBから読む(時間がかかるのでasync def のエンドポイントからは呼ばないこと)"""
+    _listener.start()
+    return _current(topic)[1]
+
+
+def publish(db: Session, topic: str) -> None:
+    """話題の値が変わったことを全workerに知らせる 変更をcommitした後に、同じセッションで呼ぶ"""
+    value = TOPICS[topic](db)
+    _set(topic, value)
+    conn = get_redis_if_possible()
+    if conn is None:
+        return
+    try:
+        conn.publish(CHANNEL, json.dumps({"topic": topic, "value": value}))
+    except redis.RedisError:
+        report_redis_error()
+
+
+def clear() -> None:
+    """スナップショットを全て捨てる(テストでDBを作り直した時など)"""
+    with _lock:
+        _snapshots.clear()
+
+
+def subscribe(topic: str) -> sse.Subscription:
+    """イベントループ上で呼ぶ"""
+    return _hub.subscribe(topic)
+
+
+def connections() -> int:
+    """このworkerで配信中の接続の数"""
+    return _hub.connections()
+
+
+def stream(subscription: sse.Subscription) -> AsyncIterator[str]:
+    """text/event-streamの本文 接続した時と値が変わった時に、`event: <話題>` で値のJSONを送る"""
+
+    async def first() -> str:
+        # スナップショットが無い・古ければDBから読む
+        snapshot = await run_in_threadpool(_current, subscription.key)
+        return sse.message(subscription.key, snapshot[2])
+
+    return sse.stream(subscription, first)
+
+
+def _listen() -> None:
+    while True:
+        conn = get_redis_if_possible()
+        if conn is None:
+            time.sleep(settings.redis_breaker_cooldown)
+            continue
+        pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CHANNEL)
+            # 購読していなかった間の通知を取りこぼしているかもしれないので、次に読む時にDBから読み直す
+            clear()
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+                try:
+                    data = json.loads(message["data"])
+                    topic, value = data["topic"], data["value"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if topic in TOPICS:
+                    _set(topic, value)
+        except redis.RedisError:
+            report_redis_error()
+            time.sleep(settings.redis_breaker_cooldown)
+        finally:
+            pubsub.close()
+
+
+# 他のworkerからの通知を受け取るスレッド(最初に使われた時に1回だけ起動する)
+_listener = sse.LazyThread(_listen, "broadcast")
+_hub = sse.Hub(_listener)
@@ -0,0 +1,482 @@
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Awaitable, Callable, Dict, List, Tuple, Union
+
+import anyio.from_thread
+import anyio.to_thread
+import redis
+
+from app.config import settings
+from app.redis_possible import (
+    get_redis_if_possible,
+    redis_delete_if_possible,
+    redis_get_if_possible,
+    register_script,
+    report_redis_error,
+)
+
+"""
+workerプロセス内のメモリ(LRU)とRedisの2段のキャッシュ
+
+星陵祭当日のピークには団体・公演の取得がすべてRedisに集中してRedisがボトルネックになるので、各workerのメモリにも短い時間だけ結果を持っておく
+- 読み込み: プロセス内 → Redis → (呼び出し側で)DB の順に探す
+- 書き込み(DBの更新)時はinvalidate()でRedisのキーを消し、Redisのpub/subで全ノード・全workerのプロセス内キャッシュからも消す
+- プロセス内のTTL(CACHE_LOCAL_EXPIRE)とRedisのTTL(CACHE_REDIS_EXPIRE)は別々に設定できる
+
+キャッシュが切れた瞬間に同時に来たリクエストが全部DBに行かないよう、作り直すのは1つのリクエストだけにする(single-flight)
+- Redisには「いつまで新しいか(fresh_for)」を値と一緒に保存し、expireはそれよりstale_for秒長くする
+- 新しい期限を過ぎた(stale)値は、Redisのロックを取れた1リクエストだけが作り直し、他は古い値をそのまま返す
+- 値が無いときは、worker内ではFutureで1スレッドだけが、worker間ではRedisのロックで1workerだけが作り直し、他はその結果を待つ
+
+作り直している間にDBが更新されてinvalidate()された場合、作り直した(更新前の)値を後から保存するとCACHE_REDIS_EXPIRE秒の間更新が見えなくなる
+- invalidate()はキーごとの世代(Redisの"gen:<キー>")を1つ進めてからキーを削除する
+- 作り直す前に世代を読んでおき、保存する時に世代が変わっていれば保存しない(Luaスクリプトで確認と保存をアトミックに行う)
+- プロセス内のキャッシュも同じように、作り直している間に何かが削除されていれば保存しない
+"""
+
+INVALIDATE_CHANNEL = "quaint-cache-invalidate"
+LOCK_POLL_INTERVAL = 0.05  # 他のworkerがキャッシュを作り直すのを待つ間、Redisを確認する間隔(秒)
+
+# ロックを取ったリクエスト自身のロックだけを外す(タイムアウトした後に他が取ったロックは外さない)
+_UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_unlock_script = register_script(_UNLOCK_SCRIPT)
+
+# 作り直し始めた時から世代が変わっていない(invalidate()されていない)時だけ保存する
+# KEYS[1]:キー KEYS[2]:世代のキー ARGV[1]:作り直し始めた時の世代 ARGV[2]:値 ARGV[3]:expire
+_STORE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+_store_script = register_script(_STORE_SCRIPT)
+
+
+class LocalCache:
+    """プロセス内のLRUキャッシュ 各エントリはttl秒(set()で個別に指定も可)で期限切れになる"""
+
+    def __init__(self, max_entries: int, ttl: float) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, ttl: Union[float, None] = None) -> None:
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)  # 一番使われていないものから捨てる
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+local_cache = LocalCache(settings.cache_local_max_entries, settings.cache_local_expire)
+
+
+def _pack(value: str, fresh_for: int) -> str:
+    return str(time.time() + fresh_for) + "|" + value
+
+
+def _unpack(cache_result: Union[str, None]) -> Union[Tuple[float, str], None]:
+    """Redisに保存した値を(新しい期限, 値)に戻す 形式が違う(古い形式のキーなど)ときはNone"""
+    if cache_result is None:
+        return None
+    fresh_until, sep, value = cache_result.partition("|")
+    if not sep:
+        return None
+    try:
+        return float(fresh_until), value
+    except ValueError:
+        return None
+
+
+def _lock_key(key: str) -> str:
+    return "lock:" + key
+
+
+def _generation_key(key: str) -> str:
+    return "gen:" + key
+
+
+def _generation(key: str) -> Union[str, None]:
+    """キーの今の世代 Redisが使えない時はNone"""
+    conn = get_redis_if_possible()
+    if conn is None:
+        return None
+    try:
+        return conn.get(_generation_key(key)) or "0"
+    except redis.RedisError:
+        report_redis_error()
+        return None
+
+
+def _store(key: str, value: str, ex: int, generation: Union[str, None]) -> None:
+    """世代がgenerationのままならRedisに保存する 世代を読めなかった時は保存しない"""
+    if generation is None:
+        return
+    conn = get_redis_if_possible()
+    if conn is None:
+        return
+    try:
+        _store_script(
+            keys=[key, _generation_key(key)], args=[generation, value, ex], client=conn
+        )
+    except redis.RedisError:
+        report_redis_error()
+
+
+def _acquire(key: str) -> Tuple[bool, Union[str, None]]:
+    """キャッシュを作り直すロックを取る
+
+    Returns:
+        Tuple[bool, Union[str, None]]: (作り直してよいか, ロックのトークン) Redisが使えない時はロック無しで(True, None)
+    """
+    conn = get_redis_if_possible()
+    if conn is None:
+        return True, None
+    token = uuid.uuid4().hex
+    try:
+        acquired = conn.set(
+            _lock_key(key), token, ex=max(1, int(settings.cache_lock_timeout)), nx=True
+        )
+    except redis.RedisError:
+        report_redis_error()
+        return True, None
+    if acquired:
+        return True, token
+    return False, None
+
+
+def _release(key: str, token: Union[str, None]) -> None:
+    if token is None:
+        return
+    conn = get_redis_if_possible()
+    if conn is None:
+        return
+    try:
+        _unlock_script(keys=[_lock_key(key)], args=[token], client=conn)
+    except redis.RedisError:
+        report_redis_error()
+
+
+def _wait_for_other_worker(key: str) -> Union[str, None]:
+    """他のworkerがキャッシュを作り直すのを待つ ロックが外れても値が無い・待ちきれなかったらNone"""
+    conn = get_redis_if_possible()
+    deadline = time.monotonic() + settings.cache_lock_timeout
+    while conn is not None and time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            cache_result, locked = conn.mget([key, _lock_key(key)])
+        except redis.RedisError:
+            report_redis_error()
+            return None
+        cached = _unpack(cache_result)
+        if cached is not None:
+            return cached[1]
+        if locked is None:
+            return None
+    return None
+
+
+def _compute_and_store(
+    key: str, compute: Callable[[], Union[str, None]], fresh_for: int, stale_for: int
+) -> Union[str, None]:
+    # 作り直している間にinvalidate()されたら、更新前の値かもしれないので保存しない
+    generation = _generation(key)
+    epoch = _local_epoch
+    value = compute()
+    if value is None:
+        # 元のデータが無くなっているので、古いキャッシュも返さないようにする
+        local_cache.delete(key)
+        redis_delete_if_possible(key)
+        return None
+    _store(key, _pack(value, fresh_for), fresh_for + stale_for, generation)
+    if epoch == _local_epoch:
+        local_cache.set(key, value)
+    return value
+
+
+def _compute_on_miss(
+    key: str, compute: Callable[[], Union[str, None]], fresh_for: int, stale_for: int
+) -> Union[str, None]:
+    acquired, token = _acquire(key)
+    if not acquired:
+        value = _wait_for_other_worker(key)
+        if value is not None:
+            local_cache.set(key, value)
+            return value
+        # 作り直していたworkerが失敗した・時間がかかりすぎている場合は自分で作る
+    try:
+        return _compute_and_store(key, compute, fresh_for, stale_for)
+    finally:
+        _release(key, token)
+
+
+_inflight: Dict[str, Future] = {}  # キーごとに、このworker内で作り直している最中の結果
+_inflight_lock = threading.Lock()
+
+
+def _single_flight(key: str, compute: Callable[[], Union[str, None]]) -> Union[str, None]:
+    """同じキーについて同時に呼ばれた場合、computeを実行するのはworker内で1スレッドだけにする"""
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inflight[key] = future
+    if not leader:
+        try:
+            return future.result(timeout=settings.cache_lock_timeout)
+        except FutureTimeoutError:
+            return compute()
+    try:
+        value = compute()
+        future.set_result(value)
+        return value
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def get_or_compute(
+    key: str,
+    compute: Callable[[], Union[str, None]],
+    fresh_for: Union[int, None] = None,
+    stale_for: Union[int, None] = None,
+) -> Union[str, None]:
+    """キャッシュがあればそれを返し、無ければcomputeで作ってキャッシュする
+
+    Args:
+        key (str): キャッシュのキー(app/cache_keys.py)
+        compute (Callable[[], Union[str, None]]): DBなどから値を作る関数 対象が存在しない時はNoneを返す(キャッシュしない)
+        fresh_for (Union[int, None]): この秒数の間は作り直さない 省略時はCACHE_REDIS_EXPIRE
+        stale_for (Union[int, None]): 新しい期限を過ぎてから、作り直している間に古い値を返してよい秒数 省略時はCACHE_STALE_EXPIRE
+
+    Returns:
+        Union[str, None]: キャッシュされていた・作った値 computeがNoneを返した時はNone
+    """
+    value = local_cache.get(key)
+    if value is not None:
+        return value
+    return _get_or_compute_shared(key, compute, fresh_for, stale_for)
+
+
+def peek(key: str) -> Union[str, None]:
+    """キャッシュされていれば(新しい期限を過ぎていても)その値を返す 無ければNone(作り直さない)"""
+    value = local_cache.get(key)
+    if value is not None:
+        return value
+    cached = _unpack(redis_get_if_possible(key))
+    if cached is None:
+        return None
+    return cached[1]
+
+
+async def aget_or_compute(
+    key: str,
+    compute: Callable[[], Awaitable[Union[str, None]]],
+    fresh_for: Union[int, None] = None,
+    stale_for: Union[int, None] = None,
+) -> Union[str, None]:
+    """get_or_computeのasync def のエンドポイント用 computeはAsyncSessionを使うコルーチン関数
+
+    プロセス内のキャッシュにあればイベントループ上でそのまま返す
+    無ければRedisの読み書き・ロック・他のリクエストの待ち合わせ(どれも同期の処理)をスレッドプールで行い、computeだけをイベントループに戻して実行する
+    """
+    value = local_cache.get(key)
+    if value is not None:
+        return value
+    return await anyio.to_thread.run_sync(
+        _get_or_compute_shared,
+        key,
+        lambda: anyio.from_thread.run(compute),
+        fresh_for,
+        stale_for,
+    )
+
+
+def _get_or_compute_shared(
+    key: str,
+    compute: Callable[[], Union[str, None]],
+    fresh_for: Union[int, None],
+    stale_for: Union[int, None],
+) -> Union[str, None]:
+    """プロセス内のキャッシュに無かった時の、Redis → compute の部分"""
+    fresh_for = fresh_for or settings.cache_redis_expire
+    stale_for = stale_for if stale_for is not None else settings.cache_stale_expire
+
+    cached = _unpack(redis_get_if_possible(key))
+    if cached is not None:
+        fresh_until, value = cached
+        if time.time() < fresh_until:
+            local_cache.set(key, value)
+            return value
+        acquired, token = _acquire(key)
+        if not acquired:
+            return value  # 他のリクエストが作り直しているので古い値を返す
+        try:
+            return _compute_and_store(key, compute, fresh_for, stale_for)
+        finally:
+            _release(key, token)
+    return _single_flight(
+        key, lambda: _compute_on_miss(key, compute, fresh_for, stale_for)
+    )
+
+
+def invalidate(*keys: str) -> None:
+    """キャッシュを削除し、他のworker・ノードにも削除するよう通知する
+
+    読み込み専用のレプリカ(DB_READER_HOSTS)を使っている時は、削除した直後にまだ反映されていないレプリカから
+    古い値を読んでキャッシュし直してしまうことがあるので、DB_READER_MAX_LAG秒後にもう一度削除する
+    """
+    if len(keys) == 0:
+        return
+    _invalidate_now(keys)
+    if settings.db_reader_hosts != "" and float(settings.db_reader_max_lag) > 0:
+        _start_delayed_invalidator()
+        _delayed.put((time.monotonic() + float(settings.db_reader_max_lag), keys))
+
+
+_local_epoch = 0  # プロセス内のキャッシュを削除するたびに進める
+
+
+def _delete_local(*keys: str) -> None:
+    global _local_epoch
+    _local_epoch += 1
+    local_cache.delete(*keys)
+
+
+def _invalidate_now(keys: Tuple[str, ...]) -> None:
+    _delete_local(*keys)
+    conn = get_redis_if_possible()
+    if conn is None:
+        return
+    # 世代を進めてから削除する(削除した後に、作り直していた更新前の値を保存させない)
+    generation_expire = int(settings.cache_redis_expire) + int(settings.cache_stale_expire)
+    try:
+        pipe = conn.pipeline(transaction=True)
+        for key in keys:
+            pipe.incr(_generation_key(key))
+            pipe.expire(_generation_key(key), generation_expire)
+        pipe.delete(*keys)
+        pipe.execute()
+        conn.publish(INVALIDATE_CHANNEL, json.dumps(list(keys)))
+    except redis.RedisError:
+        report_redis_error()
+
+
+_delayed: "queue.Queue[Tuple[float, Tuple[str, ...]]]" = queue.Queue()  # (削除する時刻, キー) 遅らせる秒数は一定なので古い順に並ぶ
+_delayed_invalidator: Union[threading.Thread, None] = None
+_delayed_invalidator_lock = threading.Lock()
+
+
+def _invalidate_delayed() -> None:
+    while True:
+        due, keys = _delayed.get()
+        wait = due - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            _invalidate_now(keys)
+        except Exception as e:
+            print(f"キャッシュを削除できません: {e}")
+
+
+def _start_delayed_invalidator() -> None:
+    global _delayed_invalidator
+    with _delayed_invalidator_lock:
+        if _delayed_invalidator is not None:
+            return
+        _delayed_invalidator = threading.Thread(
+            target=_invalidate_delayed, name="cache-delayed-invalidation", daemon=True
+        )
+        _delayed_invalidator.start()
+
+
+def _listen_invalidation() -> None:
+    while True:
+        conn = get_redis_if_possible()
+        if conn is None:
+            time.sleep(settings.redis_breaker_cooldown)
+            continue
+        pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            # 購読していなかった間の削除の通知を取りこぼしているかもしれないので、プロセス内のキャッシュは全部捨てる
+            _delete_local()
+            local_cache.clear()
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message is None:
+                    continue
+                try:
+                    keys: List[str] = json.loads(message["data"])
+                except ValueError:
+                    continue
+                _delete_local(*keys)
+        except redis.RedisError:
+            report_redis_error()
+            time.sleep(settings.redis_breaker_cooldown)
+        finally:
+            pubsub.close()
+
+
+_listener: Union[threading.Thread, None] = None
+
+
+def start_invalidation_listener() -> None:
+    """他のworker・ノードからのキャッシュ削除の通知を受け取るスレッドを起動する(workerの起動時に1回呼ぶ)"""
+    global _listener
+    if _listener is not None or local_cache.ttl <= 0:
+        return
+    _listener = threading.Thread(
+        target=_listen_invalidation, name="cache-invalidation", daemon=True
+    )
+    _listener.start()
@@ -0,0 +1,88 @@
+from typing import List
+
+"""
+キャッシュ(app/cache.py, Redis)のキーの一覧
+
+キーの文字列をmain.pyやcrud.pyに直接書くと、読み込み側と削除側でキーがずれてキャッシュが消えなくなるので、ここでまとめて作る
+DBを更新する関数は、更新した内容を含むキャッシュのキーをinvalidate()で削除する
+- 団体の情報(タグを含む)を変更した → for_group(group_id)
+- 公演を追加・削除した → for_event(group_id, event_id)
+- 公演をまとめて追加した → for_events(group_ids)
+"""
+
+ALL_GROUPS = "groups"  # GET /groups
+EVENTS_ON_SALE = "events-on-sale"  # GET /events/on_sale
+VOTE_RANKING = "vote-ranking"  # 団体ごとの投票数のsorted set(app/vote_ranking.py)
+
+
+def group(group_id: str) -> str:
+    """GET /groups/{group_id}"""
+    return "group:" + group_id
+
+
+def group_events(group_id: str) -> str:
+    """GET /groups/{group_id}/events"""
+    return "groupevents:" + group_id
+
+
+def group_events_today(group_id: str) -> str:
+    """GET /groups/{group_id}/events/today"""
+    return "groupevents-today:" + group_id
+
+
+def event(group_id: str, event_id: str) -> str:
+    """GET /groups/{group_id}/events/{event_id}"""
+    return "group:" + group_id + "-event:" + event_id
+
+
+def tickets_numberdata(event_id: str) -> str:
+    """GET /groups/{group_id}/events/{event_id}/tickets"""
+    return "tickets-numberdata-" + event_id
+
+
+def waiting_room(event_id: str) -> str:
+    """公演の順番待ちの列の状態のhash(app/waiting_room.py)"""
+    return "waiting-room:" + event_id
+
+
+def waiting_room_users(event_id: str) -> str:
+    """公演の順番待ちの列に並んだユーザーとその順番のhash(app/waiting_room.py)"""
+    return "waiting-room-users:" + event_id
+
+
+def ga_screenpageview(start_date: str, end_date: str, page_path: str) -> str:
+    """GET /ga/screenpageview"""
+    return "ga-screenpageview-" + start_date + end_date + page_path
+
+
+def ticket_stock_left(event_id: str) -> str:
+    """公演の整理券の残り人数(app/ticket_stock.py)"""
+    return "ticket-stock-left-" + event_id
+
+
+def user_votable_groups(owner_id: str) -> str:
+    """GET /users/me/votable_groups ユーザーの整理券・投票が変わったときに削除する"""
+    return "user-votable-groups:" + owner_id
+
+
+def for_group(group_id: str) -> List[str]:
+    """団体の情報が変わったときに削除するキー"""
+    return [ALL_GROUPS, group(group_id)]
+
+
+def for_event(group_id: str, event_id: str) -> List[str]:
+    """公演が追加・削除されたときに削除するキー"""
+    return [
+        group_events(group_id),
+        group_events_today(group_id),
+        event(group_id, event_id),
+        EVENTS_ON_SALE,
+    ]
+
+
+def for_events(group_ids: List[str]) -> List[str]:
+    """公演をまとめて追加したときに削除するキー(追加した公演のキーはまだ読まれていないので含めない)"""
+    keys = [EVENTS_ON_SALE]
+    for group_id in group_ids:
+        keys += [group_events(group_id), group_events_today(group_id)]
+    return keys
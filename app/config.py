@@ -20,6 +20,16 @@ class Settings(BaseSettings):
     mysql_password: str = os.getenv("MYSQL_PASSWORD")
     db_host: str = os.getenv("DB_HOST")
     mysql_database: str = os.getenv("MYSQL_DATABASE")
+    mysql_max_connections: int = os.getenv("MYSQL_MAX_CONNECTIONS", 151)  # MySQLのmax_connections 全ノード・全workerのコネクションプールの合計をこれ以下にする
+    db_workers: int = os.getenv("DB_WORKERS", os.getenv("WEB_CONCURRENCY", 1))  # MySQLに接続する全ノードのworker(プロセス)数の合計
+    db_reserved_connections: int = os.getenv("DB_RESERVED_CONNECTIONS", 10)  # マイグレーション・管理作業用にプールに割り当てずに残しておくコネクション数
+    db_pool_timeout: float = os.getenv("DB_POOL_TIMEOUT", 3)  # プールのコネクションが空くのを待つ最大の秒数
+    db_pool_recycle: int = os.getenv("DB_POOL_RECYCLE", 1800)  # この秒数より前に作ったコネクションは作り直す(MySQLのwait_timeoutより短くする)
+    db_pool_pre_ping: bool = os.getenv("DB_POOL_PRE_PING", True)  # プールから貸し出す前にコネクションが切れていないか確認する
+    db_shed_wait_threshold: float = os.getenv("DB_SHED_WAIT_THRESHOLD", 1)  # コネクションを待った時間(直近の平均)がこの秒数を超え、プールが空いていない間は待たずに503を返す(0で無効)
+    db_shed_retry_after: int = os.getenv("DB_SHED_RETRY_AFTER", 2)  # 混み合っていて503を返す時のRetry-Afterの秒数
+    db_reader_hosts: str = os.getenv("DB_READER_HOSTS", "")  # 読み込み専用のレプリカのホスト(カンマ区切り) 空ならプライマリだけを使う
+    db_reader_max_lag: float = os.getenv("DB_READER_MAX_LAG", 2)  # レプリカへの反映の遅れの上限として扱う秒数 キャッシュを削除してからこの秒数後にもう一度削除する
 
     jwt_privatekey: str = os.getenv("JWT_PRIVATEKEY")
     jwt_publickey: str = (
@@ -28,6 +38,12 @@ class Settings(BaseSettings):
 
     # 星陵祭の設定
     family_ticket_sell_starts: str = os.getenv("FAMILY_TICKET_SELL_STARTS")
+    ticket_token_secret: str = os.getenv("TICKET_TOKEN_SECRET", "")  # 整理券のトークンに署名する鍵(入口の端末と共有する) 空ならトークンを発行しない
+    waiting_room_secret: str = os.getenv("WAITING_ROOM_SECRET", "")  # 順番待ちのトークンに署名する鍵(全workerで同じにする) 空なら順番待ちをしない
+    waiting_room_opens_before: int = os.getenv("WAITING_ROOM_OPENS_BEFORE", 600)  # 整理券の配布開始の何秒前から列に並べるか
+    waiting_room_rate: float = os.getenv("WAITING_ROOM_RATE", 20)  # 1公演あたり1秒に整理券の取得へ通す人数
+    waiting_room_min_rate: float = os.getenv("WAITING_ROOM_MIN_RATE", 2)  # DBが混み合っている時でも1秒に通す人数
+    waiting_room_target_wait: float = os.getenv("WAITING_ROOM_TARGET_WAIT", 0.05)  # コネクションを待った時間(直近の平均)がこの秒数を超えたら通す人数を減らす
 
     # Azure Blob Storage
     connect_str: str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
@@ -40,6 +56,9 @@ class Settings(BaseSettings):
     azure_b2c_audience = "06b8cb1b-b866-43bf-9bc6-2898c6a149f3"
     azure_ad_openidconfiguration = "https://login.microsoftonline.com/158e6d17-f3d5-4365-8428-26dfc74a9d27/v2.0/.well-known/openid-configuration"
     azure_ad_audience = "0f2252c5-62ef-4aab-af65-99a753f1c77c"
+    oidc_snapshot_path: str = os.getenv("OIDC_SNAPSHOT_PATH", "app/oidc-snapshot.json")  # 取得したOpenID Connectの設定・公開鍵を保存するファイル
+    oidc_refresh_interval: float = os.getenv("OIDC_REFRESH_INTERVAL", 60 * 60)  # OpenID Connectの設定・公開鍵を取得し直す間隔(秒)
+    oidc_timeout: float = os.getenv("OIDC_TIMEOUT", 5)  # OpenID Connectの設定を取得する時のタイムアウト(秒)
 
     b2c_msgraph_tenant: str = "450b2222-dcb5-471d-9657-bb4ee50acd97"
     b2c_msgraph_client: str = "06b8cb1b-b866-43bf-9bc6-2898c6a149f3"
@@ -85,6 +104,9 @@ class Settings(BaseSettings):
 
     ## JWT EXPIRE
     access_token_expire: datetime.timedelta = datetime.timedelta(days=10)
+    ## 検証済みのJWTのキャッシュ(app/auth.py)
+    jwt_cache_max_entries: int = os.getenv("JWT_CACHE_MAX_ENTRIES", 10000)  # 各workerのメモリにキャッシュするトークンの数の上限
+    jwt_negative_cache_expire: float = os.getenv("JWT_NEGATIVE_CACHE_EXPIRE", 10)  # 不正なトークンをキャッシュする秒数
 
     production_flag: int = os.getenv("PRODUCTION_FLAG", 0)
     api_hostname: str = os.getenv("API_HOSTNAME", "DEFAULT")
@@ -94,6 +116,18 @@ class Settings(BaseSettings):
 
     ## Redis
     redis_host: str = os.getenv("REDIS_HOST", "")
+    redis_max_connections: int = os.getenv("REDIS_MAX_CONNECTIONS", 50)  # 1プロセスあたりのコネクションプールの上限
+    redis_socket_timeout: float = os.getenv("REDIS_SOCKET_TIMEOUT", 0.5)  # 秒
+    redis_breaker_cooldown: float = os.getenv("REDIS_BREAKER_COOLDOWN", 5)  # Redisへの接続に失敗してから再び問い合わせるまでの秒数
+    cache_redis_expire: int = os.getenv("CACHE_REDIS_EXPIRE", 3600)  # 団体・公演の情報をRedisにキャッシュする秒数 更新時に削除されるので長めでいい
+    cache_local_expire: float = os.getenv("CACHE_LOCAL_EXPIRE", 5)  # 団体・公演の情報を各workerのメモリにキャッシュする秒数(0で無効)
+    cache_local_max_entries: int = os.getenv("CACHE_LOCAL_MAX_ENTRIES", 1024)  # 各workerのメモリにキャッシュするキーの数の上限
+    cache_stale_expire: int = os.getenv("CACHE_STALE_EXPIRE", 60)  # 期限切れのキャッシュを、作り直している間だけ返してよい秒数
+    cache_lock_timeout: float = os.getenv("CACHE_LOCK_TIMEOUT", 5)  # キャッシュを作り直すリクエストが他を待たせる最大の秒数
+    vote_ranking_reconcile_interval: int = os.getenv("VOTE_RANKING_RECONCILE_INTERVAL", 60)  # 投票数のランキング(Redis)をDBから作り直す間隔の秒数
+    ticket_stream_interval: float = os.getenv("TICKET_STREAM_INTERVAL", 1)  # 整理券の枚数の配信(SSE)で、同じ公演の枚数を送る最短の間隔の秒数
+    ticket_stream_refresh: float = os.getenv("TICKET_STREAM_REFRESH", 15)  # 通知が無くても配信中の公演の枚数を数え直す間隔の秒数
+    broadcast_refresh: float = os.getenv("BROADCAST_REFRESH", 30)  # Hebe・お知らせのworkerのメモリのスナップショットを、通知が無くてもDBから読み直す秒数
 
     ## Google Analytics Property ID
     ga_property_id: str = os.getenv("GA_PROPERTY_ID", "")
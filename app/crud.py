@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Union
+from typing import BinaryIO, Dict, Iterator, List, Union
 
 # from hashids import Hashids
 import ulid
@@ -11,7 +11,19 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session, join
 from sqlalchemy.sql import func
 
-from app import auth, models, schemas, blob_storage
+from app import (
+    auth,
+    broadcast,
+    cache_keys,
+    models,
+    schemas,
+    blob_storage,
+    ticket_counters,
+    ticket_stock,
+    ticket_token,
+    vote_ranking,
+)
+from app.cache import invalidate
 from app.config import params, settings
 
 
@@ -35,56 +47,7 @@ def time_overlap(
 
 
 def is_parent_belong_to(group_id: str, user: schemas.JWTUser):
-    if group_id == "11r":
-        return auth.check_parents_11r(user)
-    elif group_id == "12r":
-        return auth.check_parents_12r(user)
-    elif group_id == "13r":
-        return auth.check_parents_13r(user)
-    elif group_id == "14r":
-        return auth.check_parents_14r(user)
-    elif group_id == "15r":
-        return auth.check_parents_15r(user)
-    elif group_id == "16r":
-        return auth.check_parents_16r(user)
-    elif group_id == "17r":
-        return auth.check_parents_17r(user)
-    elif group_id == "18r":
-        return auth.check_parents_18r(user)
-    elif group_id == "21r":
-        return auth.check_parents_21r(user)
-    elif group_id == "22r":
-        return auth.check_parents_22r(user)
-    elif group_id == "23r":
-        return auth.check_parents_23r(user)
-    elif group_id == "24r":
-        return auth.check_parents_24r(user)
-    elif group_id == "25r":
-        return auth.check_parents_25r(user)
-    elif group_id == "26r":
-        return auth.check_parents_26r(user)
-    elif group_id == "27r":
-        return auth.check_parents_27r(user)
-    elif group_id == "28r":
-        return auth.check_parents_28r(user)
-    elif group_id == "31r":
-        return auth.check_parents_31r(user)
-    elif group_id == "32r":
-        return auth.check_parents_32r(user)
-    elif group_id == "33r":
-        return auth.check_parents_33r(user)
-    elif group_id == "34r":
-        return auth.check_parents_34r(user)
-    elif group_id == "35r":
-        return auth.check_parents_35r(user)
-    elif group_id == "36r":
-        return auth.check_parents_36r(user)
-    elif group_id == "37r":
-        return auth.check_parents_37r(user)
-    elif group_id == "38r":
-        return auth.check_parents_38r(user)
-    else:
-        return False
+    return auth.check_parents_of(group_id, user)
 
 
 def grant_ownership(
@@ -169,6 +132,7 @@ def create_group(db: Session, group: schemas.GroupCreate):
     db.add(db_group)
     db.commit()
     db.refresh(db_group)
+    invalidate(*cache_keys.for_group(db_group.id))
     return db_group
 
 
@@ -225,6 +189,7 @@ def update_group(db: Session, group: schemas.Group, updated_group: schemas.Group
     db_group.update_dict(updated_group.dict())
     db.commit()
     db.refresh(db_group)
+    invalidate(*cache_keys.for_group(db_group.id))
     return db_group
 
 
@@ -237,6 +202,7 @@ def change_public_thumbnail_image_url(
     db_group.public_thumbnail_image_url = public_thumbnail_image_url
     db.commit()
     db.refresh(db_group)
+    invalidate(*cache_keys.for_group(db_group.id))
     return db_group
 
 
@@ -254,6 +220,7 @@ def add_tag(db: Session, group_id: str, tag_id: schemas.GroupTagCreate):
         db.refresh(db_grouptag)
     except:
         raise HTTPException(200, "Already Registed")
+    invalidate(*cache_keys.for_group(group.id))
     return db_grouptag
 
 
@@ -277,12 +244,14 @@ def delete_grouptag(db: Session, group: schemas.Group, tag: schemas.Tag):
         models.GroupTag.group_id == group.id, models.GroupTag.tag_id == tag.id
     ).delete()
     db.commit()
+    invalidate(*cache_keys.for_group(group.id))
     return 0
 
 
 def delete_group(db: Session, group: schemas.Group):
     db.query(models.Group).filter(models.Group.id == group.id).delete()
     db.commit()
+    invalidate(*cache_keys.for_group(group.id), cache_keys.group_events(group.id))
 
 
 def add_grouplink(db: Session, group_id: str, linktext: str, name: str):
@@ -317,65 +286,83 @@ def delete_grouplink(db: Session, grouplink_id: str):
 
 # Event
 def create_event(db: Session, group_id: str, event: schemas.EventCreate):
-    add_event: schemas.EventDBInput = event
-    add_event.starts_at = event.starts_at.isoformat()
-    add_event.ends_at = event.ends_at.isoformat()
-    add_event.sell_starts = event.sell_starts.isoformat()
-    add_event.sell_ends = event.sell_ends.isoformat()
-    db_event = models.Event(id=ulid.new().str, group_id=group_id, **add_event.dict())
+    db_event = models.Event(id=ulid.new().str, group_id=group_id, **event.dict())
     db.add(db_event)
     db.commit()
     db.refresh(db_event)
+    invalidate(*cache_keys.for_event(group_id, db_event.id))
     return db_event
 
 
 def get_all_events(db: Session, group_id: str):
-    db_events: List[schemas.EventDBOutput] = (
+    db_events: List[models.Event] = (
         db.query(models.Event).filter(models.Event.group_id == group_id).all()
     )
-    events: List[schemas.Event] = []
-    for e in db_events:
-        event = schemas.Event(
-            id=e.id,
-            group_id=e.group_id,
-            eventname=e.eventname,
-            lottery=e.lottery,
-            target=e.target,
-            ticket_stock=e.ticket_stock,
-            starts_at=datetime.fromisoformat(e.starts_at),
-            ends_at=datetime.fromisoformat(e.ends_at),
-            sell_starts=datetime.fromisoformat(e.sell_starts),
-            sell_ends=datetime.fromisoformat(e.sell_ends),
-        )
-        events.append(event)
-    return events
+    return [schemas.Event.from_orm(e) for e in db_events]
 
 
 def get_event(db: Session, event_id: str):
-    e: schemas.EventDBOutput = (
-        db.query(models.Event).filter(models.Event.id == event_id).first()
-    )
+    e: models.Event = db.query(models.Event).filter(models.Event.id == event_id).first()
     if e:
-        event = schemas.Event(
-            id=e.id,
-            group_id=e.group_id,
-            eventname=e.eventname,
-            lottery=e.lottery,
-            target=e.target,
-            ticket_stock=e.ticket_stock,
-            starts_at=datetime.fromisoformat(e.starts_at),
-            ends_at=datetime.fromisoformat(e.ends_at),
-            sell_starts=datetime.fromisoformat(e.sell_starts),
-            sell_ends=datetime.fromisoformat(e.sell_ends),
-        )
-        return event
+        return schemas.Event.from_orm(e)
     else:
         return None
 
 
+def get_events_on_sale(db: Session, at: datetime) -> List[schemas.Event]:
+    """atの時点で整理券を配布中の公演 (sell_starts, sell_ends)のインデックスを使う"""
+    db_events: List[models.Event] = (
+        db.query(models.Event)
+        .filter(models.Event.sell_starts <= at, at < models.Event.sell_ends)
+        .order_by(models.Event.sell_starts)
+        .all()
+    )
+    return [schemas.Event.from_orm(e) for e in db_events]
+
+
+def get_waiting_room_events(
+    db: Session, at: datetime, opens_before: timedelta
+) -> List[schemas.Event]:
+    """atの時点で順番待ちの列に並べる(配布中・配布開始のopens_before前からの)公演"""
+    db_events: List[models.Event] = (
+        db.query(models.Event)
+        .filter(
+            models.Event.waiting_room == True,
+            models.Event.sell_starts <= at + opens_before,
+            at < models.Event.sell_ends,
+        )
+        .order_by(models.Event.sell_starts)
+        .all()
+    )
+    return [schemas.Event.from_orm(e) for e in db_events]
+
+
+def get_events_starting_between(
+    db: Session, group_id: str, start: datetime, end: datetime
+) -> List[schemas.Event]:
+    """団体の、start以降end未満に始まる公演 (group_id, starts_at)のインデックスを使う"""
+    db_events: List[models.Event] = (
+        db.query(models.Event)
+        .filter(
+            models.Event.group_id == group_id,
+            models.Event.starts_at >= start,
+            models.Event.starts_at < end,
+        )
+        .order_by(models.Event.starts_at)
+        .all()
+    )
+    return [schemas.Event.from_orm(e) for e in db_events]
+
+
 def delete_events(db: Session, event: schemas.Event):
+    ticket_counters.forget(db, event.id)
     db.query(models.Event).filter(models.Event.id == event.id).delete()
     db.commit()
+    ticket_stock.forget(event.id)
+    invalidate(
+        *cache_keys.for_event(event.group_id, event.id),
+        cache_keys.tickets_numberdata(event.id),
+    )
 
 
 def get_all_active_tickets_of_event(db, event_id) -> List[str]:
@@ -404,18 +391,8 @@ def get_all_active_tickets_of_event(db, event_id) -> List[str]:
 
 ## Ticket CRUD
 def count_tickets_for_event(db: Session, event: schemas.Event) -> int:
-    res = (
-        db.query(func.sum(models.Ticket.person).label("person_sum"))
-        .filter(
-            models.Ticket.event_id == event.id,
-            or_(models.Ticket.status == "active", models.Ticket.status == "used"),
-        )
-        .first()
-    )
-    # db_tickets_count:int=db.query(models.Ticket).filter(models.Ticket.event_id==event.id,or_(models.Ticket.status=="active",models.Ticket.status=="paper")).count() #抽選機能を付けるのであれば、枚数確認せず抽選申し込みできるだろうという予想から、status!="cancelled"としなかった  紙整理券(paper)は含めた
-    if res.person_sum is None:
-        return 0
-    return res.person_sum
+    # active・usedの整理券の人数の合計 ticketsをSUMせず集計の行を引く(app/ticket_counters.py)
+    return ticket_counters.get(db, event.id).taken
 
 
 def check_qualified_for_ticket(
@@ -423,7 +400,7 @@ def check_qualified_for_ticket(
 ):
     ### このユーザーが同じ時間帯で他の公演のチケットを取っていないか(この公演の2枚目も含む)
     ### 整理券の上限に達していないか(各公演の開始時刻で判定されます)
-    taken_events: List[schemas.EventDBOutput] = (
+    taken_events: List[models.Event] = (
         db.query(models.Event)
         .join(
             models.Ticket,
@@ -437,19 +414,7 @@ def check_qualified_for_ticket(
     )
     tickets_num_per_day: int = 0
     for taken_event in taken_events:
-        e = taken_event
-        te = schemas.Event(
-            id=e.id,
-            group_id=e.group_id,
-            eventname=e.eventname,
-            lottery=e.lottery,
-            target=e.target,
-            ticket_stock=e.ticket_stock,
-            starts_at=datetime.fromisoformat(e.starts_at),
-            ends_at=datetime.fromisoformat(e.ends_at),
-            sell_starts=datetime.fromisoformat(e.sell_starts),
-            sell_ends=datetime.fromisoformat(e.sell_ends),
-        )
+        te = taken_event
         if time_overlap(te.starts_at, te.ends_at, event.starts_at, event.ends_at):
             return False
         if (
@@ -488,8 +453,12 @@ def create_ticket(
         created_at=datetime.now(timezone(timedelta(hours=+9))).isoformat(),
     )
     db.add(db_ticket)
+    db.flush()
+    ticket_counters.transition(db, event.id, person, None, "active")
     db.commit()
     db.refresh(db_ticket)
+    invalidate(cache_keys.user_votable_groups(db_ticket.owner_id))
+    db_ticket.token = ticket_token.issue(db_ticket, event)
     return db_ticket
 
 
@@ -504,6 +473,8 @@ def spectest_ticket(group_id: str, event_id: str, db: Session, user: schemas.JWT
         created_at=datetime.now(timezone(timedelta(hours=+9))).isoformat(),
     )
     db.add(db_ticket)
+    db.flush()
+    ticket_counters.transition(db, event_id, 1, None, "active")
     db.commit()
     db.refresh(db_ticket)
     return db_ticket
@@ -517,23 +488,102 @@ def get_ticket(db: Session, ticket_id):
 
 
 def delete_ticket(db: Session, ticket: schemas.Ticket):
-    db_ticket = db.query(models.Ticket).filter(models.Ticket.id == ticket.id).first()
+    # 同じ整理券を同時にキャンセルしても残数を2回戻さないよう、行をロックしてから今の状態を読む
+    db_ticket = (
+        db.query(models.Ticket)
+        .filter(models.Ticket.id == ticket.id)
+        .with_for_update()
+        .populate_existing()
+        .first()
+    )
+    if db_ticket.status == "cancelled":
+        db.commit()  # ロックを外す
+        return ticket
+    # count_tickets_for_eventで数えられている状態からのキャンセルなら残数を戻す
+    from_status = db_ticket.status
+    was_counted = from_status in ("active", "used")
     db_ticket.status = "cancelled"
+    db.flush()
+    ticket_counters.transition(
+        db, db_ticket.event_id, db_ticket.person, from_status, "cancelled"
+    )
     db.commit()
     db.refresh(db_ticket)
+    invalidate(cache_keys.user_votable_groups(db_ticket.owner_id))
+    if was_counted:
+        ticket_stock.release(db_ticket.event_id, db_ticket.person)
     return ticket
 
 
 def use_ticket(db: Session, ticket_id: str):
-    ticket = db.query(models.Ticket).filter(models.Ticket.id == ticket_id).first()
+    # 複数の入口で同時にもぎっても集計に2回数えないよう、行をロックしてから今の状態を読む
+    ticket = (
+        db.query(models.Ticket)
+        .filter(models.Ticket.id == ticket_id)
+        .with_for_update()
+        .populate_existing()
+        .first()
+    )
     if not ticket:
         return None
+    from_status = ticket.status
     ticket.status = "used"
+    db.flush()
+    ticket_counters.transition(db, ticket.event_id, ticket.person, from_status, "used")
     db.commit()
     db.refresh(ticket)
     return ticket
 
 
+def use_tickets(db: Session, ticket_ids: List[str]) -> Dict[str, str]:
+    """複数の整理券をまとめてもぎる 同じ整理券を何度送っても結果は変わらない
+
+    複数の入口で同じ整理券を同時にもぎっても2回もぎられないよう、行をロックしてから
+    UPDATE ... WHERE id IN (...) AND status='active' を1回だけ実行する
+
+    Args:
+        db (Session): Session
+        ticket_ids (List[str]): もぎる整理券のid
+
+    Returns:
+        Dict[str, str]: 整理券のidごとの結果
+            used→今回もぎった, already_used→既にもぎられていた, unavailable→キャンセル済みなど, unknown→存在しない
+    """
+    results: Dict[str, str] = {ticket_id: "unknown" for ticket_id in ticket_ids}
+    if len(results) == 0:
+        return results
+    statuses = (
+        db.query(
+            models.Ticket.id,
+            models.Ticket.status,
+            models.Ticket.event_id,
+            models.Ticket.person,
+        )
+        .filter(models.Ticket.id.in_(list(results)))
+        .with_for_update()
+        .all()
+    )
+    active_ids: List[str] = []
+    used_person: Dict[str, int] = {}  # 公演ごとの今回もぎった人数
+    for ticket_id, status, event_id, person in statuses:
+        if status == "active":
+            active_ids.append(ticket_id)
+            results[ticket_id] = "used"
+            used_person[event_id] = used_person.get(event_id, 0) + person
+        elif status == "used":
+            results[ticket_id] = "already_used"
+        else:
+            results[ticket_id] = "unavailable"
+    if len(active_ids) != 0:
+        db.query(models.Ticket).filter(
+            models.Ticket.id.in_(active_ids), models.Ticket.status == "active"
+        ).update({models.Ticket.status: "used"}, synchronize_session=False)
+        for event_id, person in used_person.items():
+            ticket_counters.transition(db, event_id, person, "active", "used")
+    db.commit()
+    return results
+
+
 def chief_create_ticket(
     db: Session, event: schemas.Event, user: schemas.JWTUser, person: int
 ):
@@ -547,6 +597,8 @@ def chief_create_ticket(
         created_at=datetime.now(timezone(timedelta(hours=+9))).isoformat(),
     )
     db.add(db_ticket)
+    db.flush()
+    ticket_counters.transition(db, event.id, person, None, "paper")
     db.commit()
     db.refresh(db_ticket)
     return db_ticket
@@ -561,6 +613,8 @@ def chief_delete_ticket(db: Session, event: schemas.Event):
     if db_ticket is None:
         return None
     db_ticket.status = "cancelled"
+    db.flush()
+    ticket_counters.transition(db, event.id, db_ticket.person, "paper", "cancelled")
     db.commit()
     db.refresh(db_ticket)
     return db_ticket
@@ -608,6 +662,16 @@ def get_tag(db: Session, id: str):
     return db_tag
 
 
+def _cache_keys_for_tag(db: Session, id: str) -> List[str]:
+    # タグ名は団体の情報に含まれるので、そのタグが付いている団体のキャッシュを全部消す
+    keys = [cache_keys.ALL_GROUPS]
+    for grouptag in (
+        db.query(models.GroupTag.group_id).filter(models.GroupTag.tag_id == id).all()
+    ):
+        keys.append(cache_keys.group(grouptag.group_id))
+    return keys
+
+
 def put_tag(db: Session, id: str, tag: schemas.TagCreate):
     db_tag = db.query(models.Tag).filter(models.Tag.id == id).first()
     if not db_tag:
@@ -615,6 +679,7 @@ def put_tag(db: Session, id: str, tag: schemas.TagCreate):
     db_tag.tagname = tag.tagname
     db.commit()
     db.refresh(db_tag)
+    invalidate(*_cache_keys_for_tag(db, id))
     return db_tag
 
 
@@ -622,8 +687,10 @@ def delete_tag(db: Session, id: str):
     db_tag = db.query(models.Tag).filter(models.Tag.id == id).first()
     if not db_tag:
         return None
+    keys = _cache_keys_for_tag(db, id)  # 削除するとどの団体に付いていたか分からなくなるので先に調べる
     db.delete(db_tag)
     db.commit()
+    invalidate(*keys)
     return 0
 
 
@@ -632,59 +699,95 @@ def create_vote(db: Session, group_id: str, user: schemas.JWTUser) -> schemas.Vo
     if get_group_public(db, group_id).enable_vote:
         try:
             db_vote = models.Vote(
-                id=ulid.new(), user_id=auth.user_object_id(user), group_id=group_id
+                id=ulid.new().str, user_id=auth.user_object_id(user), group_id=group_id
             )
             created_vote: schemas.Vote = db_vote
             db.add(db_vote)
             db.commit()
             db.refresh(db_vote)
+            invalidate(cache_keys.user_votable_groups(db_vote.user_id))
+            vote_ranking.incr(group_id)
             return created_vote
+        except IntegrityError:
+            # (user_id, group_id)のユニーク制約 同時に投票された場合もここで弾かれる
+            db.rollback()
+            raise HTTPException(400, "すでにその団体に対して投票済みです")
         except:
             raise HTTPException(400, f"{group_id}への投票作成中にエラーが発生しました")
     else:
         raise HTTPException(400, "投票不可の団体を指定しています")
 
 
+def _finished_tickets_of_user(db: Session, owner_id: str):
+    """ユーザーの、公演が終了したactive/used状態の整理券 (投票に使える整理券)"""
+    return (
+        db.query(models.Ticket.group_id)
+        .join(models.Event, models.Event.id == models.Ticket.event_id)
+        .filter(
+            models.Ticket.owner_id == owner_id,
+            models.Ticket.status.in_(["active", "used"]),
+            models.Event.ends_at < datetime.now(timezone(timedelta(hours=+9))),
+        )
+    )
+
+
 # ユーザーが指定された団体に対して投票可能かを返す
 # ユーザーが何回投票しているかなどは判定してないので注意
 def get_user_votable(db: Session, user: schemas.JWTUser, group_id) -> bool:
-    # 有効な整理券があるかを判定
-    # group_idに対応するactive/used状態の整理券を抽出
-    tickets: list[schemas.Ticket] = (
-        db.query(models.Ticket)
+    owner_id = auth.user_object_id(user)
+    # 公演が終了した有効な整理券がある かつ その団体にまだ投票していない を1回のクエリで判定する
+    has_finished_ticket = (
+        _finished_tickets_of_user(db, owner_id)
+        .filter(models.Ticket.group_id == group_id)
+        .exists()
+    )
+    voted = (
+        db.query(models.Vote.id)
+        .filter(models.Vote.user_id == owner_id, models.Vote.group_id == group_id)
+        .exists()
+    )
+    return bool(db.query(and_(has_finished_ticket, ~voted)).scalar())
+
+
+def get_unvoted_group_ends_at(db: Session, user: schemas.JWTUser) -> Dict[str, datetime]:
+    """ユーザーがまだ投票していない団体ごとに、active/used状態の整理券の公演の最も早い終了時刻を返す
+
+    この時刻を過ぎた団体に投票できる 結果はユーザーの整理券・投票が変わるまで変わらないのでキャッシュできる
+    tickets, events, votesを1回のjoinで集計する
+    """
+    owner_id = auth.user_object_id(user)
+    rows = (
+        db.query(models.Ticket.group_id, func.min(models.Event.ends_at))
+        .join(models.Event, models.Event.id == models.Ticket.event_id)
+        .outerjoin(
+            models.Vote,
+            and_(
+                models.Vote.group_id == models.Ticket.group_id,
+                models.Vote.user_id == owner_id,
+            ),
+        )
         .filter(
-            models.Ticket.group_id == group_id,
-            or_(models.Ticket.status == "active", models.Ticket.status == "used"),
-            models.Ticket.owner_id == auth.user_object_id(user),
+            models.Ticket.owner_id == owner_id,
+            models.Ticket.status.in_(["active", "used"]),
+            models.Vote.id.is_(None),
         )
+        .group_by(models.Ticket.group_id)
         .all()
     )
+    return {group_id: ends_at for group_id, ends_at in rows}
 
-    # 所有している整理券が公演終了時間を越しているかを判定していく
-    for ticket in tickets:
-        # 整理券に対応するeventを取得
-        event: schemas.Event = db.query(models.Event).get(ticket.event_id)
-
-        if datetime.fromisoformat(event.ends_at) < datetime.now(
-            timezone(timedelta(hours=+9))
-        ):
-            # eventの終了時刻が現在の時刻よりも前 -> 整理券は投票に対して有効
-            # 既に投票しているかの判定
-            vote = (
-                db.query(models.Vote)
-                .filter(
-                    models.Vote.group_id == group_id,
-                    models.Vote.user_id == auth.user_object_id(user),
-                )
-                .first()
-            )
 
-            if not vote:
-                # まだ投票していない
-                return True
+def get_user_votable_groups(db: Session, user: schemas.JWTUser) -> List[str]:
+    """ユーザーがまだ投票できる団体のidを全て返す(団体ごとにget_user_votableを呼ぶのと同じ結果を1回のクエリで)
 
-    # 上のforの中で return True で終わらなかった -> 有効な整理券がない or 既に投票ずみ
-    return False
+    get_user_votableと同じく、ユーザーが何回投票しているかは判定していない
+    """
+    now = datetime.now(timezone(timedelta(hours=+9)))
+    return sorted(
+        group_id
+        for group_id, ends_at in get_unvoted_group_ends_at(db, user).items()
+        if ends_at < now
+    )
 
 
 # ユーザーが投票した数を返す
@@ -714,6 +817,17 @@ def get_group_votes(db: Session, group: schemas.Group):
     return db.query(models.Vote).filter(models.Vote.group_id == group.id).count()
 
 
+def count_votes_of_all_groups(db: Session) -> Dict[str, int]:
+    """全団体の投票数を1回のGROUP BYで数える(投票されていない団体は0)"""
+    rows = (
+        db.query(models.Group.id, func.count(models.Vote.id))
+        .outerjoin(models.Vote, models.Vote.group_id == models.Group.id)
+        .group_by(models.Group.id)
+        .all()
+    )
+    return {group_id: votes_num for group_id, votes_num in rows}
+
+
 def get_hebe_nowplaying(db: Session):
     return db.query(models.HebeNowplaying).first()
 
@@ -729,10 +843,12 @@ def set_hebe_nowplaying(db: Session, hebe: schemas.HebeResponse):
         db.add(add_hebe)
         db.commit()
         db.refresh(add_hebe)
+        broadcast.publish(db, "hebe")
         return add_hebe
     db_hebe.group_id = hebe.group_id
     db.commit()
     db.refresh(db_hebe)
+    broadcast.publish(db, "hebe")
     return db_hebe
 
 
@@ -743,13 +859,68 @@ def set_hebe_upnext(db: Session, hebe: schemas.HebeResponse):
         db.add(add_hebe)
         db.commit()
         db.refresh(add_hebe)
+        broadcast.publish(db, "hebe")
         return add_hebe
     db_hebe.group_id = hebe.group_id
     db.commit()
     db.refresh(db_hebe)
+    broadcast.publish(db, "hebe")
     return db_hebe
 
 
+# CSVの一括追加(POST /support/events)で扱うDataFrameの列
+# 行ごとにループしたりクエリを投げたりすると、数千行のシートで数十秒かかるので、列ごとにまとめて変換・検証する
+DF_COLUMNS = [
+    "group_id",
+    "eventname",
+    "lottery",
+    "target",
+    "ticket_stock",
+    "starts_at",
+    "ends_at",
+    "sell_starts",
+    "sell_ends",
+]
+DF_TIME_COLUMNS = ["starts_at", "ends_at", "sell_starts", "sell_ends"]
+# datetime.fromisoformatで読める書き方(日付と時刻) 秒の桁数などが崩れたものはpandasだと読めてしまうので先に弾く
+DF_ISO_DATETIME = r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d{1,6})?)?(?:Z|[+-]\d{2}:\d{2})?"
+DF_BOOL_VALUES = {
+    "true": True,
+    "1": True,
+    "yes": True,
+    "on": True,
+    "false": False,
+    "0": False,
+    "no": False,
+    "off": False,
+}
+
+
+def _first_row(mask: pd.Series) -> Union[int, None]:
+    """maskがTrueの最初の行番号(0始まり) 無ければNone"""
+    rows = np.flatnonzero(mask.to_numpy())
+    if len(rows) == 0:
+        return None
+    return int(rows[0])
+
+
+def _parse_df_times(df: pd.DataFrame) -> pd.DataFrame:
+    """5〜8列目の時刻をまとめて日本時間のdatetimeに変換する 読めない値はNaT
+
+    タイムゾーンの無い時刻は日本時間として扱う(models.JSTDateTimeと同じ)
+    """
+    times = {}
+    for n, column in enumerate(DF_TIME_COLUMNS, start=5):
+        values = df.iloc[:, n].astype(str)
+        valid = values.str.fullmatch(DF_ISO_DATETIME)
+        naive = ~values.str.contains(r"(?:Z|[+-]\d{2}:\d{2})$")
+        values = values.mask(naive, values + "+09:00").where(valid)
+        times[column] = pd.to_datetime(
+            values, format="ISO8601", errors="coerce", utc=True
+        ).dt.tz_convert(models.JST)
+    return pd.DataFrame(times)
+
+
 # 受け取ったpandas.DataFrameを変換する
 # 受け取った値についての検証はcolumnsだけ行う
 def convert_df(df: pd.DataFrame) -> pd.DataFrame:
@@ -760,131 +931,47 @@ def convert_df(df: pd.DataFrame) -> pd.DataFrame:
             f"列の数が合いません。正しい列の数は12です。サンプルシートと比較して確認してください。",
         )
 
-    converted_df = pd.DataFrame(
-        columns=[
-            "group_id",
-            "eventname",
-            "lottery",
-            "target",
-            "ticket_stock",
-            "starts_at",
-            "ends_at",
-            "sell_starts",
-            "sell_ends",
-        ]
+    """
+    年・月・日の列と時刻の列(9:30:00)をくっつけて 2024-09-16T09:30:00+09:00 のようにする
+    month, day, hourは 9 → 09 みたいにする必要がある
+    """
+    date = (
+        df.iloc[:, 5].astype(str)
+        + "-"
+        + df.iloc[:, 6].astype(str).str.zfill(2)
+        + "-"
+        + df.iloc[:, 7].astype(str).str.zfill(2)
     )
+    times = {}
+    invalid = pd.Series(False, index=df.index)
+    for n, column in enumerate(DF_TIME_COLUMNS, start=8):
+        parts = df.iloc[:, n].astype(str).str.split(":")
+        hour, minute, second = parts.str[0], parts.str[1], parts.str[2]
+        # 時・分・秒が揃っていない行
+        invalid |= second.isna()
+        times[column] = (
+            date + "T" + hour.str.zfill(2) + ":" + minute + ":" + second + "+09:00"
+        )
 
-    # 1行ずつ取り出して変換する
-    for i in range(len(df)):
-        try:
-            # 時間の情報を変換する
-            year = str(df.iat[i, 5])
-            month = str(df.iat[i, 6])
-            day = str(df.iat[i, 7])
-            hours = {
-                "starts_at": str(df.iat[i, 8]).split(":")[0],
-                "ends_at": str(df.iat[i, 9]).split(":")[0],
-                "sell_starts": str(df.iat[i, 10]).split(":")[0],
-                "sell_ends": str(df.iat[i, 11]).split(":")[0],
-            }
-
-            """
-            month, day, hourの表現を変換する
-            上の三つを時間にくっつける上で 9 → 09 みたいにする必要がある
-            """
-            if len(month) == 1:
-                month = "0" + month
-            if len(day) == 1:
-                day = "0" + day
-
-            for key in ["starts_at", "ends_at", "sell_starts", "sell_ends"]:
-                if len(hours[key]) == 1:
-                    hours[key] = "0" + hours[key]
-
-            times = {
-                "starts_at": hours["starts_at"]
-                + ":"
-                + str(df.iat[i, 8]).split(":")[1]
-                + ":"
-                + str(df.iat[i, 8]).split(":")[2],
-                "ends_at": hours["ends_at"]
-                + ":"
-                + str(df.iat[i, 9]).split(":")[1]
-                + ":"
-                + str(df.iat[i, 9]).split(":")[2],
-                "sell_starts": hours["sell_starts"]
-                + ":"
-                + str(df.iat[i, 10]).split(":")[1]
-                + ":"
-                + str(df.iat[i, 10]).split(":")[2],
-                "sell_ends": hours["sell_ends"]
-                + ":"
-                + str(df.iat[i, 11]).split(":")[1]
-                + ":"
-                + str(df.iat[i, 11]).split(":")[2],
-            }
-
-            converted_df = pd.concat(
-                [
-                    converted_df,
-                    pd.DataFrame(
-                        data={
-                            "group_id": [df.iat[i, 0]],
-                            "eventname": [df.iat[i, 1]],
-                            "lottery": df.iat[i, 2],
-                            "target": [df.iat[i, 3]],
-                            "ticket_stock": [df.iat[i, 4]],
-                            "starts_at": [
-                                year
-                                + "-"
-                                + month
-                                + "-"
-                                + day
-                                + "T"
-                                + times["starts_at"]
-                                + "+09:00"
-                            ],
-                            "ends_at": [
-                                year
-                                + "-"
-                                + month
-                                + "-"
-                                + day
-                                + "T"
-                                + times["ends_at"]
-                                + "+09:00"
-                            ],
-                            "sell_starts": [
-                                year
-                                + "-"
-                                + month
-                                + "-"
-                                + day
-                                + "T"
-                                + times["sell_starts"]
-                                + "+09:00"
-                            ],
-                            "sell_ends": [
-                                year
-                                + "-"
-                                + month
-                                + "-"
-                                + day
-                                + "T"
-                                + times["sell_ends"]
-                                + "+09:00"
-                            ],
-                        }
-                    ),
-                ],
-                ignore_index=True,
-            )
-        except:
-            raise HTTPException(
-                422,
-                f"pandas.DataFrameの変換に失敗しました。表記方法が正しいことを確認してください。<エラー箇所> 行番号 : { i + 1 }",
-            )
+    i = _first_row(invalid)
+    if i is not None:
+        raise HTTPException(
+            422,
+            f"pandas.DataFrameの変換に失敗しました。表記方法が正しいことを確認してください。<エラー箇所> 行番号 : {df.index[i] + 1}",
+        )
 
+    converted_df = pd.DataFrame(
+        {
+            "group_id": df.iloc[:, 0].to_numpy(),
+            "eventname": df.iloc[:, 1].to_numpy(),
+            "lottery": df.iloc[:, 2].to_numpy(),
+            "target": df.iloc[:, 3].to_numpy(),
+            "ticket_stock": df.iloc[:, 4].to_numpy(),
+            **{column: times[column].to_numpy() for column in DF_TIME_COLUMNS},
+        },
+        columns=DF_COLUMNS,
+        index=df.index,
+    )
     return converted_df
 
 
@@ -892,17 +979,7 @@ def convert_df(df: pd.DataFrame) -> pd.DataFrame:
 def check_df(db: Session, df: pd.DataFrame) -> None:
     # カラム名が正しいかの検証
     columns = df.columns.values
-    correct_columns = [
-        "group_id",
-        "eventname",
-        "lottery",
-        "target",
-        "ticket_stock",
-        "starts_at",
-        "ends_at",
-        "sell_starts",
-        "sell_ends",
-    ]
+    correct_columns = DF_COLUMNS
     for i in range(len(columns)):
         if not (columns[i] == correct_columns[i]):
             raise HTTPException(
@@ -910,72 +987,293 @@ def check_df(db: Session, df: pd.DataFrame) -> None:
                 f"カラム名が正しいことを確認してください。<エラー箇所> 表記 : {columns[i]}, 正表記 : {correct_columns[i]}",
             )
 
-    # group_idが正しいかの検証
-    for i in range(len(df)):
-        group = db.query(models.Group).filter(models.Group.id == df.iat[i, 0]).first()
-
-        if not group:
-            raise HTTPException(
-                400,
-                f"存在しないgroup_idが含まれています。<エラー箇所> 行番号 : {i + 1}, group_id : {df.iat[i, 0]}",
-            )
+    # group_idが正しいかの検証 シートに出てくる団体をまとめて1回のクエリで調べる
+    group_ids = df.iloc[:, 0].astype(str)
+    existing = {
+        group_id
+        for (group_id,) in db.query(models.Group.id)
+        .filter(models.Group.id.in_(group_ids.unique().tolist()))
+        .all()
+    }
+    i = _first_row(~group_ids.isin(existing))
+    if i is not None:
+        raise HTTPException(
+            400,
+            f"存在しないgroup_idが含まれています。<エラー箇所> 行番号 : {df.index[i] + 1}, group_id : {df.iat[i, 0]}",
+        )
 
     # 時刻の表記の仕方が正しいかの判定
-    for m in range(len(df)):
-        for n in [5, 6, 7, 8]:
-            try:
-                time = datetime.fromisoformat(df.iat[m, n])
-            except:
-                raise HTTPException(
-                    422,
-                    f"時刻の表記方法が正しいことを確認してください。<エラー箇所> 行番号 : {m + 1}, 列番号 : {n + 1}",
-                )
+    times = _parse_df_times(df)
+    invalid = times.isna()
+    m = _first_row(invalid.any(axis=1))
+    if m is not None:
+        n = 5 + int(np.argmax(invalid.iloc[m].to_numpy()))
+        raise HTTPException(
+            422,
+            f"時刻の表記方法が正しいことを確認してください。<エラー箇所> 行番号 : {df.index[m] + 1}, 列番号 : {n + 1}",
+        )
 
     # 時刻の設定に問題がないかを確認
-    for i in range(len(df)):
-        starts_at = datetime.fromisoformat(df.iat[i, 5])
-        ends_at = datetime.fromisoformat(df.iat[i, 6])
-        sell_starts = datetime.fromisoformat(df.iat[i, 7])
-        sell_ends = datetime.fromisoformat(df.iat[i, 8])
-
-        if starts_at > ends_at:
+    starts_invalid = times["starts_at"] > times["ends_at"]
+    sell_invalid = times["sell_starts"] > times["sell_ends"]
+    i = _first_row(starts_invalid | sell_invalid)
+    if i is not None:
+        if starts_invalid.iat[i]:
             raise HTTPException(
                 400,
                 f"公演の開始時刻は終了時刻よりも前である必要があります。group_id : {df.iat[i , 0]}, eventname : {df.iat[i , 1]}",
             )
-        if sell_starts > sell_ends:
-            raise HTTPException(
-                400,
-                f"配布開始時刻は配布終了時刻よりも前である必要があります。group_id : {df.iat[i , 0]}, eventname : {df.iat[i , 1]}",
-            )
+        raise HTTPException(
+            400,
+            f"配布開始時刻は配布終了時刻よりも前である必要があります。group_id : {df.iat[i , 0]}, eventname : {df.iat[i , 1]}",
+        )
 
     # 表記方法に問題なし
     return None
 
 
+# 公演を突き合わせるキー(POST /support/events?mode=diff|apply)
+EVENT_MATCH_KEYS = ["group_id", "starts_at", "eventname"]
+
+
+# pandas.DataFrameの値を検証して、公演の列ごとのリストにする
+# 時刻は日本時間の 2024-09-16T09:30:00+09:00 の形にする(models.JSTDateTimeはそのまま保存でき、DBから読んだ時刻のisoformat()と一致する)
+def _event_columns(df: pd.DataFrame) -> Dict[str, list]:
+    # schemas.EventCreateと同じ検証を列ごとにまとめて行う
+    lottery = df.iloc[:, 2].astype(str).str.lower().map(DF_BOOL_VALUES)
+    target = df.iloc[:, 3].astype(str)
+    ticket_stock = pd.to_numeric(df.iloc[:, 4], errors="coerce")
+    times = _parse_df_times(df)
+    invalid = pd.DataFrame(
+        {
+            2: lottery.isna(),
+            3: ~target.isin([role.value for role in schemas.UserRole]),
+            4: ticket_stock.isna() | (ticket_stock % 1 != 0),
+            **{n: times[column].isna() for n, column in enumerate(DF_TIME_COLUMNS, 5)},
+        }
+    )
+    i = _first_row(invalid.any(axis=1))
+    if i is not None:
+        n = int(invalid.columns[np.argmax(invalid.iloc[i].to_numpy())])
+        raise HTTPException(
+            422,
+            f"公演の情報が正しくありません。<エラー箇所> 行番号 : {df.index[i] + 1}, 列番号 : {n + 1}",
+        )
+
+    return {
+        "group_id": df.iloc[:, 0].astype(str).tolist(),
+        "eventname": df.iloc[:, 1].astype(str).tolist(),
+        "lottery": lottery.astype(bool).tolist(),
+        "target": target.tolist(),
+        "ticket_stock": ticket_stock.astype(int).tolist(),
+        **{
+            column: times[column].dt.strftime("%Y-%m-%dT%H:%M:%S+09:00").tolist()
+            for column in DF_TIME_COLUMNS
+        },
+    }
+
+
+# pandas.DataFrameの情報を元にDBにeventを追加する(commitはしない)
+# 全ての行を1回のINSERTでまとめて追加する
+def add_events_from_df(db: Session, df: pd.DataFrame) -> None:
+    events = {"id": [ulid.new().str for _ in range(len(df))], **_event_columns(df)}
+    db.bulk_insert_mappings(
+        models.Event, [dict(zip(events, row)) for row in zip(*events.values())]
+    )
+    return None
+
+
 # pandas.DataFrameの情報を元にDBにeventを追加
+# 途中の行で失敗した時は1件も追加しない
 def create_events_from_df(db: Session, df: pd.DataFrame) -> None:
-    for i in range(len(df)):
-        group_id = df.iat[i, 0]
-
-        # pandas.DataFrameの情報を読み取ってスキーマに変換
-        event = schemas.EventDBInput(
-            eventname=df.iat[i, 1],
-            lottery=df.iat[i, 2],
-            target=df.iat[i, 3],
-            ticket_stock=df.iat[i, 4],
-            starts_at=df.iat[i, 5],
-            ends_at=df.iat[i, 6],
-            sell_starts=df.iat[i, 7],
-            sell_ends=df.iat[i, 8],
+    add_events_from_df(db, df)
+    db.commit()
+    invalidate(*cache_keys.for_events(df.iloc[:, 0].astype(str).unique().tolist()))
+
+    return None
+
+
+CSV_CHUNK_ROWS = 1000  # csvファイルを一度に読み込む行数
+
+
+# アップロードされたcsvファイル(sample-sheet-v2.csvの書式)をCSV_CHUNK_ROWS行ずつ読み、変換・検証したpandas.DataFrameを順に返す
+# ファイル全体を文字列にしないので、大きいファイルでもメモリを使いすぎない
+# 間違った行があればその行を読んだ時点でHTTPExceptionを投げる(行番号はファイル全体での番号)
+# 時間がかかるので、async def のエンドポイントからは呼ばないこと(def のエンドポイントならスレッドプールで実行される)
+def read_events_csv(db: Session, file: BinaryIO) -> Iterator[pd.DataFrame]:
+    try:
+        for df in pd.read_csv(file, chunksize=CSV_CHUNK_ROWS, encoding="utf-8"):
+            converted_df = convert_df(df)
+            check_df(db, converted_df)
+            yield converted_df
+    except (UnicodeDecodeError, pd.errors.ParserError, pd.errors.EmptyDataError):
+        raise HTTPException(
+            422,
+            "csvファイルを読み込めませんでした。UTF-8のcsvファイルであることを確認してください。",
         )
 
-        db_event = models.Event(id=ulid.new().str, group_id=group_id, **event.dict())
-        db.add(db_event)
-        db.commit()
-        db.refresh(db_event)
 
-    return None
+# csvファイル全体を読んで1つのpandas.DataFrameにする(差分を計算するには全ての行が必要)
+def load_events_csv(db: Session, file: BinaryIO) -> pd.DataFrame:
+    chunks = list(read_events_csv(db, file))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=DF_COLUMNS)
+    return pd.concat(chunks)
+
+
+# csvファイルから公演を一括追加する
+# 読んだ分から順にINSERTしていき、全ての行が正しければ最後にcommitする 間違った行があれば1件も追加しない
+def import_events_from_csv(db: Session, file: BinaryIO) -> List[str]:
+    group_ids = set()
+    rows: List[str] = []
+    try:
+        for converted_df in read_events_csv(db, file):
+            add_events_from_df(db, converted_df)
+            group_ids.update(converted_df["group_id"].astype(str))
+            rows += [
+                converted_df.iloc[i, :].to_json() for i in range(len(converted_df))
+            ]
+    except:
+        db.rollback()
+        raise
+    db.commit()
+    invalidate(*cache_keys.for_events(sorted(group_ids)))
+
+    return rows
+
+
+# シートを公演の一覧として、既存の公演との差分を計算する(DBは変更しない)
+# - (group_id, starts_at, eventname)が同じ公演を同じものとみなす
+# - シートにしか無い公演は追加、他の値(終了時刻・配布時刻・抽選・対象・人数)が違う公演は更新
+# - シートに出てくる団体の公演のうち、シートに無いものは削除(シートに出てこない団体の公演はそのまま)
+# - 以前の一括追加で重複して登録された公演は、1件を残して削除する
+def diff_events_from_df(db: Session, df: pd.DataFrame) -> schemas.EventsDiff:
+    sheet = pd.DataFrame(_event_columns(df), columns=DF_COLUMNS)
+    i = _first_row(sheet.duplicated(EVENT_MATCH_KEYS))
+    if i is not None:
+        raise HTTPException(
+            422,
+            f"同じ公演(group_id, starts_at, eventname)が複数行あります。<エラー箇所> 行番号 : {df.index[i] + 1}",
+        )
+
+    db_events = (
+        db.query(models.Event)
+        .filter(models.Event.group_id.in_(sheet["group_id"].unique().tolist()))
+        .order_by(models.Event.id)
+        .all()
+    )
+    existing = pd.DataFrame(
+        [
+            {
+                "id": e.id,
+                "group_id": e.group_id,
+                "eventname": e.eventname,
+                "lottery": bool(e.lottery),
+                "target": e.target,
+                "ticket_stock": e.ticket_stock,
+                **{column: getattr(e, column).isoformat() for column in DF_TIME_COLUMNS},
+            }
+            for e in db_events
+        ],
+        columns=["id"] + DF_COLUMNS,
+    )
+    duplicated = existing.duplicated(EVENT_MATCH_KEYS)
+
+    merged = sheet.merge(
+        existing[~duplicated],
+        on=EVENT_MATCH_KEYS,
+        how="outer",
+        suffixes=("", "_db"),
+        indicator=True,
+    )
+    value_columns = [c for c in DF_COLUMNS if c not in EVENT_MATCH_KEYS]
+    matched = merged[merged["_merge"] == "both"]
+    changed = pd.Series(False, index=matched.index)
+    for column in value_columns:
+        changed |= matched[column] != matched[column + "_db"]
+
+    inserts = merged.loc[merged["_merge"] == "left_only", DF_COLUMNS]
+    updates = matched.loc[changed, ["id"] + DF_COLUMNS]
+    delete_ids = set(merged.loc[merged["_merge"] == "right_only", "id"])
+    delete_ids.update(existing.loc[duplicated, "id"])
+    deletes = existing[existing["id"].isin(delete_ids)]
+
+    return schemas.EventsDiff(
+        inserts=inserts.to_dict("records"),
+        updates=updates.to_dict("records"),
+        deletes=deletes.to_dict("records"),
+    )
+
+
+# diff_events_from_dfで計算した差分を1つのトランザクションでまとめて反映する
+# 整理券が取得されている公演は削除できないので、削除する公演に整理券があれば何もせずに400を返す
+# 人数を取得済みの整理券の人数より少なくする更新も同じく400を返す
+def apply_events_from_df(db: Session, df: pd.DataFrame) -> schemas.EventsDiff:
+    diff = diff_events_from_df(db, df)
+    if len(diff.inserts) + len(diff.updates) + len(diff.deletes) == 0:
+        return diff
+    delete_ids = [e.id for e in diff.deletes]
+    if len(delete_ids) > 0:
+        taken = (
+            db.query(models.Ticket.event_id)
+            .filter(models.Ticket.event_id.in_(delete_ids))
+            .first()
+        )
+        if taken is not None:
+            raise HTTPException(
+                400,
+                f"既に整理券が取得されている公演は削除できません。event_id : {taken.event_id}",
+            )
+    # 人数も、既に取得されている整理券(active・used)の人数より少なくはできない
+    stocks = {e.id: e.ticket_stock for e in diff.updates}
+    if len(stocks) > 0:
+        taken_rows = (
+            db.query(models.Ticket.event_id, func.sum(models.Ticket.person))
+            .filter(
+                models.Ticket.event_id.in_(list(stocks)),
+                models.Ticket.status.in_(["active", "used"]),
+            )
+            .group_by(models.Ticket.event_id)
+            .with_for_update(read=True)  # 反映するまでに整理券が取得されないようにする
+            .all()
+        )
+        for event_id, person_sum in taken_rows:
+            if int(person_sum or 0) > stocks[event_id]:
+                raise HTTPException(
+                    400,
+                    f"既に取得されている整理券の人数より少ない人数には変更できません。event_id : {event_id}",
+                )
+
+    try:
+        db.bulk_insert_mappings(
+            models.Event, [dict(id=ulid.new().str, **e.dict()) for e in diff.inserts]
+        )
+        # シートに無い列(waiting_roomなど)は更新しない
+        db.bulk_update_mappings(
+            models.Event, [e.dict(include={"id", *DF_COLUMNS}) for e in diff.updates]
+        )
+        for event_id in delete_ids:
+            ticket_counters.forget(db, event_id)
+        db.query(models.Event).filter(models.Event.id.in_(delete_ids)).delete(
+            synchronize_session=False
+        )
+        db.commit()
+    except:
+        db.rollback()
+        raise
+
+    # 一覧は変更があった団体のものだけ、公演ごとのキャッシュは更新・削除した公演のものだけ消す
+    changed_events = diff.updates + diff.deletes
+    for e in changed_events:
+        ticket_stock.forget(e.id)
+    invalidate(
+        *cache_keys.for_events(
+            sorted({e.group_id for e in diff.inserts + changed_events})
+        ),
+        *[cache_keys.event(e.group_id, e.id) for e in changed_events],
+        *[cache_keys.tickets_numberdata(e.id) for e in changed_events],
+    )
+    return diff
 
 
 def get_all_news(db: Session):
@@ -1000,6 +1298,7 @@ def create_news(db: Session, news: schemas.NewsUpdate):
     db.add(db_news)
     db.commit()
     db.refresh(db_news)
+    broadcast.publish(db, "news")
     return db_news
 
 
@@ -1009,6 +1308,7 @@ def delete_news(db: Session, news_id: str):
         raise HTTPException(404, "指定されたidを持つお知らせは存在しません。")
     db.delete(news)
     db.commit()
+    broadcast.publish(db, "news")
     return news
 
 
@@ -1021,4 +1321,5 @@ def update_news(db: Session, news_id: str, news: schemas.NewsUpdate):
     db_news.update_dict(news.dict())
     db.commit()
     db.refresh(db_news)
+    broadcast.publish(db, "news")
     return db_news
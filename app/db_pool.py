@@ -0,0 +1,111 @@
+import threading
+from typing import Dict, Union
+
+from fastapi import HTTPException
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.config import settings
+
+"""
+MySQLのコネクションプールの監視と、混雑している時にリクエストを待たせずに断る(load shedding)
+
+- プールのcheckoutイベントで、貸し出した回数・貸し出し中の本数とoverflowの最大値を数える
+- get_db/get_async_dbがコネクションを取るまでに待った時間を記録する
+- 数えた値は /admin/metrics/db で確認できる(workerごとに別々に数えている)
+- 直近の待ち時間(指数移動平均)がDB_SHED_WAIT_THRESHOLD秒を超えていて、かつプールが全て貸し出し中の間は、
+  コネクションを待たずに503(Retry-After付き)を返す
+  pool_timeout秒待ってから失敗するリクエストが積み重なり、後から来たリクエストまで全部遅くなるのを防ぐ
+"""
+
+EWMA_WEIGHT = 0.2  # 直近の待ち時間の指数移動平均で、新しい値にかける重み
+
+
+class PoolMonitor:
+    """1つのエンジンのコネクションプールの統計情報"""
+
+    def __init__(self, engine: Engine, max_overflow: int) -> None:
+        self.engine = engine
+        self.max_overflow = max_overflow
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checked_out_max = 0
+        self.overflow_max = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_recent = 0.0
+        self.timeouts = 0
+        self.shed = 0
+        event.listen(engine, "checkout", self._on_checkout)
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy) -> None:
+        checked_out = self.engine.pool.checkedout()
+        overflow = max(0, self.engine.pool.overflow())
+        with self._lock:
+            self.checkouts += 1
+            if self.checked_out_max < checked_out:
+                self.checked_out_max = checked_out
+            if self.overflow_max < overflow:
+                self.overflow_max = overflow
+
+    def record_wait(self, seconds: float) -> None:
+        """コネクションを取るまでに待った秒数を記録する"""
+        with self._lock:
+            self.waits += 1
+            self.wait_total += seconds
+            if self.wait_max < seconds:
+                self.wait_max = seconds
+            self.wait_recent += EWMA_WEIGHT * (seconds - self.wait_recent)
+
+    def record_timeout(self) -> None:
+        """pool_timeout秒待ってもコネクションを取れなかったことを記録する"""
+        with self._lock:
+            self.timeouts += 1
+        # 待ちきれなかったので、待ち時間はpool_timeout秒として扱う
+        self.record_wait(float(settings.db_pool_timeout))
+
+    def _exhausted(self) -> bool:
+        pool = self.engine.pool
+        return pool.checkedout() >= pool.size() + self.max_overflow
+
+    def shedding(self) -> bool:
+        threshold = float(settings.db_shed_wait_threshold)
+        if threshold <= 0:
+            return False
+        return self.wait_recent > threshold and self._exhausted()
+
+    def shed_if_overloaded(self) -> None:
+        """プールが混み合っている時は、コネクションを待たずに503を返す"""
+        if not self.shedding():
+            return
+        with self._lock:
+            self.shed += 1
+        raise unavailable()
+
+    def metrics(self) -> Dict[str, Union[int, float, bool]]:
+        pool = self.engine.pool
+        with self._lock:
+            return {
+                "pool_size": pool.size(),
+                "max_overflow": self.max_overflow,
+                "checked_out": pool.checkedout(),
+                "overflow": max(0, pool.overflow()),
+                "checked_out_max": self.checked_out_max,
+                "overflow_max": self.overflow_max,
+                "checkouts": self.checkouts,
+                "wait_avg_ms": (self.wait_total / self.waits * 1000) if self.waits else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+                "wait_recent_ms": self.wait_recent * 1000,
+                "timeouts": self.timeouts,
+                "shed": self.shed,
+                "shedding": self.shedding(),
+            }
+
+
+def unavailable() -> HTTPException:
+    return HTTPException(
+        503,
+        detail="データベースが混み合っています。しばらくしてからもう一度お試しください",
+        headers={"Retry-After": str(settings.db_shed_retry_after)},
+    )
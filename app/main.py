@@ -6,8 +6,6 @@ from typing import Dict, List, Optional, Union
 from xml.dom.minidom import Entity
 
 import requests
-from io import StringIO
-import pandas as pd
 from fastapi import (
     Body,
     Depends,
@@ -18,9 +16,12 @@ from fastapi import (
     UploadFile,
     status,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import Field
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette.status import (
     HTTP_401_UNAUTHORIZED,
@@ -28,11 +29,27 @@ from starlette.status import (
     HTTP_404_NOT_FOUND,
 )
 
-from app import auth, crud, db, models, schemas, blob_storage
+from app import (
+    auth,
+    blob_storage,
+    broadcast,
+    cache_keys,
+    crud,
+    db,
+    models,
+    oidc,
+    schemas,
+    ticket_stock,
+    ticket_stream,
+    ticket_token,
+    vote_ranking,
+    waiting_room,
+)
+from app.cache import aget_or_compute, get_or_compute, peek, start_invalidation_listener
 from app.config import settings
 from app.ga import ga_screenpageview
 from app.msgraph import MsGraph
-from app.redis_possible import redis_get_if_possible, redis_set_if_possible
+from app.redis_possible import redis_metrics
 
 # models.Base.metadata.create_all(bind=engine)
 
@@ -77,7 +94,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-REDIS_CACHE_EXPIRE = 120  # (何か特別な意図があってRedisを使うわけでは無く)DB負荷軽減のためにRedisキャッシュするエンドポイントのexpire
+REDIS_CACHE_EXPIRE = (
+    settings.cache_redis_expire
+)  # (何か特別な意図があってRedisを使うわけでは無く)DB負荷軽減のためにRedisキャッシュするエンドポイントのexpire
+EVENTS_NOW_CACHE_EXPIRE = 15  # 時刻によって変わる結果(配布中・今日の公演)はすぐ作り直す
+
+
+@app.on_event("startup")
+def startup():
+    # 他のworker・ノードでの更新によるキャッシュの削除をプロセス内キャッシュにも反映する(app/cache.py)
+    start_invalidation_listener()
+    # Azure AD・B2Cの設定・公開鍵を定期的に取得し直す(app/oidc.py)
+    oidc.start_refresher()
+    # 投票数のランキング(Redis)を定期的にDBから作り直す(app/vote_ranking.py)
+    vote_ranking.start_reconciler()
 
 
 @app.get("/")
@@ -88,6 +118,17 @@ def read_root():
     }
 
 
+### async def と def のエンドポイント
+# def のエンドポイントはStarletteのスレッドプール(40スレッド)で実行されるので、同時に40リクエストを超えると待たされる
+# 読み込みだけのエンドポイント(整理券・公演・団体・投票)は async def にして、AsyncSession(db.get_async_db)を使う
+# - crud.pyの関数は await db.run_sync(crud.xxx, ...) で呼ぶ
+# - キャッシュはaget_or_computeを使う
+# 書き込みや、同期のRedisのクライアントを直接使うエンドポイントは def のまま(Session, db.get_db)
+# 公開されている読み込みだけのエンドポイントは、レプリカから読む(db.get_reader_db, db.get_async_reader_db)
+# - /users/me/* は自分が書き込んだ結果がすぐ見えるように、プライマリから読む
+# - 整理券の残り数は集計の行を作る時に書き込むのでプライマリから読む
+
+
 @app.get(
     "/users/me/tickets",
     response_model=List[schemas.Ticket],
@@ -95,11 +136,11 @@ def read_root():
     tags=["users"],
     description="### 必要な権限\nなし\n### ログインが必要か\nはい\n###注意 \n状態がcancelledになっているチケットも含めて返ってくる",
 )
-def get_list_of_your_tickets(
+async def get_list_of_your_tickets(
     user: schemas.JWTUser = Depends(auth.get_current_user),
-    db: Session = Depends(db.get_db),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
-    return crud.get_list_of_your_tickets(db, user)
+    return await db.run_sync(crud.get_list_of_your_tickets, user)
 
 
 @app.get(
@@ -109,11 +150,11 @@ def get_list_of_your_tickets(
     tags=["users"],
     description="### 必要な権限\nなし\n### ログインが必要か\nはい\n###注意 \n状態がactiveになっているチケットを返す",
 )
-def get_list_of_your_tickets_active(
+async def get_list_of_your_tickets_active(
     user: schemas.JWTUser = Depends(auth.get_current_user),
-    db: Session = Depends(db.get_db),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
-    return crud.get_list_of_your_tickets_active(db, user)
+    return await db.run_sync(crud.get_list_of_your_tickets_active, user)
 
 
 @app.get(
@@ -138,10 +179,11 @@ def get_is_parent_belong_to(
     tags=["users"],
     description="### 必要な権限\n保護者\n### ログインが必要か\nはい",
 )
-def is_buy_all_family_ticket(
-    user: schemas.JWTUser = Depends(auth.parents), db: Session = Depends(db.get_db)
+async def is_buy_all_family_ticket(
+    user: schemas.JWTUser = Depends(auth.parents),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
-    if crud.count_taken_family_ticket(db, user) >= 2:
+    if await db.run_sync(crud.count_taken_family_ticket, user) >= 2:
         return True
     return False
 
@@ -153,10 +195,11 @@ def is_buy_all_family_ticket(
     tags=["users"],
     description="### 必要な権限\n保護者\n### ログインが必要か\nはい",
 )
-def count_taken_family_tickets(
-    user: schemas.JWTUser = Depends(auth.parents), db: Session = Depends(db.get_db)
+async def count_taken_family_tickets(
+    user: schemas.JWTUser = Depends(auth.parents),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
-    return crud.count_taken_family_ticket(db, user)
+    return await db.run_sync(crud.count_taken_family_ticket, user)
 
 
 @app.put(
@@ -295,20 +338,21 @@ def create_group(
     response_model=List[schemas.Group],
     summary="全Groupの情報を取得 [Redis TTL=" + str(REDIS_CACHE_EXPIRE) + "s]",
     tags=["groups"],
-    description="Nuxt generate によってフロントエンドに全団体の情報は埋め込まれるため通常のユーザーがこのエンドポイントを操作することは無いが直接このエンドポイントにF5連打とかされてDB負荷増えたら嫌なので、Redis2分間キャッシュ \n ### 必要な権限\nなし\n### ログインが必要か\nいいえ",
-)
-def get_all_groups(db: Session = Depends(db.get_db)):
-    cacheresult = redis_get_if_possible("groups")
-    if cacheresult:
-        return json.loads(cacheresult)
-    groups = crud.get_all_groups_public(db)
-    groups_serializable = []
-    for g in groups:
-        groups_serializable.append(schemas.Group.from_orm(g).dict())
-    redis_set_if_possible(
-        "groups", json.dumps(groups_serializable), ex=REDIS_CACHE_EXPIRE
+    description="Nuxt generate によってフロントエンドに全団体の情報は埋め込まれるため通常のユーザーがこのエンドポイントを操作することは無いが直接このエンドポイントにF5連打とかされてDB負荷増えたら嫌なので、Redisにキャッシュ(団体の情報が更新されたら削除される) \n ### 必要な権限\nなし\n### ログインが必要か\nいいえ",
+)
+async def get_all_groups(db: AsyncSession = Depends(db.get_async_reader_db)):
+    async def compute():
+        groups = await db.run_sync(crud.get_all_groups_public)
+        groups_serializable = []
+        for g in groups:
+            groups_serializable.append(schemas.Group.from_orm(g).dict())
+        return json.dumps(groups_serializable)
+
+    return json.loads(
+        await aget_or_compute(
+            cache_keys.ALL_GROUPS, compute, fresh_for=REDIS_CACHE_EXPIRE
+        )
     )
-    return groups
 
 
 @app.get(
@@ -319,19 +363,19 @@ def get_all_groups(db: Session = Depends(db.get_db)):
     description="### 必要な権限\nなし\n### ログインが必要か\nいいえ",
     responses={"404": {"description": "指定されたGroupが見つかりません"}},
 )
-def get_group(group_id: str, db: Session = Depends(db.get_db)):
-    cacheresult = redis_get_if_possible("group:" + group_id)
-    if cacheresult:
-        return json.loads(cacheresult)
-    group_result = crud.get_group_public(db, group_id)
-    if not group_result:
-        raise HTTPException(404, "指定されたGroupが見つかりません")
-    redis_set_if_possible(
-        "group:" + group_result.id,
-        json.dumps(schemas.Group.from_orm(group_result).dict()),
-        ex=REDIS_CACHE_EXPIRE,
+async def get_group(group_id: str, db: AsyncSession = Depends(db.get_async_reader_db)):
+    async def compute():
+        group_result = await db.run_sync(crud.get_group_public, group_id)
+        if not group_result:
+            return None
+        return json.dumps(schemas.Group.from_orm(group_result).dict())
+
+    cacheresult = await aget_or_compute(
+        cache_keys.group(group_id), compute, fresh_for=REDIS_CACHE_EXPIRE
     )
-    return group_result
+    if cacheresult is None:
+        raise HTTPException(404, "指定されたGroupが見つかりません")
+    return json.loads(cacheresult)
 
 
 @app.put(
@@ -489,11 +533,13 @@ def delete_group(
     description="### 必要な権限\nなし\n### ログインが必要か\nいいえ",
     responses={"404": {"description": "指定されたGroupが見つかりません"}},
 )
-def get_grouplinks(group_id: str, db: Session = Depends(db.get_db)):
-    group = crud.get_group_public(db, group_id)
+async def get_grouplinks(
+    group_id: str, db: AsyncSession = Depends(db.get_async_reader_db)
+):
+    group = await db.run_sync(crud.get_group_public, group_id)
     if not group:
         raise HTTPException(404, "指定されたGroupが見つかりません")
-    return crud.get_grouplinks_of_group(db, group)
+    return await db.run_sync(crud.get_grouplinks_of_group, group)
 
 
 @app.post(
@@ -588,6 +634,31 @@ def create_event(
     return result
 
 
+@app.get(
+    "/events/on_sale",
+    response_model=List[schemas.Event],
+    summary="今、整理券を配布中の全団体の公演を取得 [Redis TTL="
+    + str(EVENTS_NOW_CACHE_EXPIRE)
+    + "s]",
+    tags=["events"],
+    description="### 必要な権限\nなし\n### ログインが必要か\nいいえ\n",
+)
+async def get_events_on_sale(db: AsyncSession = Depends(db.get_async_reader_db)):
+    async def compute():
+        now = datetime.now(timezone(timedelta(hours=+9)))
+        events = await db.run_sync(crud.get_events_on_sale, now)
+        return json.dumps([schemas.EventDBOutput_fromEvent(e).dict() for e in events])
+
+    return json.loads(
+        await aget_or_compute(
+            cache_keys.EVENTS_ON_SALE,
+            compute,
+            fresh_for=EVENTS_NOW_CACHE_EXPIRE,
+            stale_for=0,
+        )
+    )
+
+
 @app.get(
     "/groups/{group_id}/events",
     response_model=List[schemas.Event],
@@ -597,22 +668,57 @@ def create_event(
     tags=["events"],
     description="### 必要な権限\nなし\n### ログインが必要か\nいいえ\n",
 )
-def get_all_events(group_id: str, db: Session = Depends(db.get_db)):
-    cacheresult = redis_get_if_possible("groupevents:" + group_id)
-    if cacheresult:
-        return json.loads(cacheresult)
-    groupevents = crud.get_all_events(db, group_id)
-    groupevents_serializable = []
-    for e in groupevents:
-        groupevents_serializable.append(
-            schemas.EventDBOutput_fromEvent(schemas.Event.from_orm(e)).dict()
+async def get_all_events(
+    group_id: str, db: AsyncSession = Depends(db.get_async_reader_db)
+):
+    async def compute():
+        groupevents = await db.run_sync(crud.get_all_events, group_id)
+        groupevents_serializable = []
+        for e in groupevents:
+            groupevents_serializable.append(
+                schemas.EventDBOutput_fromEvent(schemas.Event.from_orm(e)).dict()
+            )
+        return json.dumps(groupevents_serializable)
+
+    return json.loads(
+        await aget_or_compute(
+            cache_keys.group_events(group_id), compute, fresh_for=REDIS_CACHE_EXPIRE
+        )
+    )
+
+
+@app.get(
+    "/groups/{group_id}/events/today",
+    response_model=List[schemas.Event],
+    summary="指定されたGroupの今日(日本時間)の公演を開始時刻順に取得 [Redis TTL="
+    + str(EVENTS_NOW_CACHE_EXPIRE)
+    + "s]",
+    tags=["events"],
+    description="### 必要な権限\nなし\n### ログインが必要か\nいいえ\n",
+)
+async def get_events_today(
+    group_id: str, db: AsyncSession = Depends(db.get_async_reader_db)
+):
+    async def compute():
+        today = datetime.now(timezone(timedelta(hours=+9))).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        events = await db.run_sync(
+            crud.get_events_starting_between,
+            group_id,
+            today,
+            today + timedelta(days=1),
+        )
+        return json.dumps([schemas.EventDBOutput_fromEvent(e).dict() for e in events])
+
+    return json.loads(
+        await aget_or_compute(
+            cache_keys.group_events_today(group_id),
+            compute,
+            fresh_for=EVENTS_NOW_CACHE_EXPIRE,
+            stale_for=0,
         )
-    redis_set_if_possible(
-        "groupevents:" + group_id,
-        json.dumps(groupevents_serializable),
-        ex=REDIS_CACHE_EXPIRE,
     )
-    return groupevents
 
 
 @app.get(
@@ -625,21 +731,24 @@ def get_all_events(group_id: str, db: Session = Depends(db.get_db)):
     description="### 必要な権限\nなし\n### ログインが必要か\nいいえ\n",
     responses={"404": {"description": "指定されたGroupまたはEventが見つかりません"}},
 )
-def get_event(group_id: str, event_id: str, db: Session = Depends(db.get_db)):
-    cacheresult = redis_get_if_possible("group:" + group_id + "-event:" + event_id)
-    if cacheresult:
-        return json.loads(cacheresult)
-    event = crud.get_event(db, event_id)
-    if not event:
-        raise HTTPException(404, "指定されたGroupまたはEventが見つかりません")
-    redis_set_if_possible(
-        "group:" + event.group_id + "-event:" + event.id,
-        json.dumps(
+async def get_event(
+    group_id: str, event_id: str, db: AsyncSession = Depends(db.get_async_reader_db)
+):
+    async def compute():
+        event = await db.run_sync(crud.get_event, event_id)
+        # 他のGroupのEventを指定された場合、公演の削除時に消えないキーにキャッシュされてしまうので見つからない扱いにする
+        if not event or event.group_id != group_id:
+            return None
+        return json.dumps(
             schemas.EventDBOutput_fromEvent(schemas.Event.from_orm(event)).dict()
-        ),
-        ex=REDIS_CACHE_EXPIRE,
+        )
+
+    cacheresult = await aget_or_compute(
+        cache_keys.event(group_id, event_id), compute, fresh_for=REDIS_CACHE_EXPIRE
     )
-    return event
+    if cacheresult is None:
+        raise HTTPException(404, "指定されたGroupまたはEventが見つかりません")
+    return json.loads(cacheresult)
 
 
 @app.delete(
@@ -676,15 +785,15 @@ def delete_events(
     tags=["events"],
     description="### 必要な権限\nstudents\n### ログインが必要か\nはい\n### 説明\n指定された公演に対するすべてのアクティブ状態の整理券のIDを返します",
 )
-def get_all_active_tickets_of_event(
+async def get_all_active_tickets_of_event(
     group_id: str,
     event_id: str,
     user: schemas.JWTUser = Depends(auth.get_current_user),
-    db: Session = Depends(db.get_db),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
     if not auth.check_students(user):
         raise HTTPException(403, "生徒である必要があります。")
-    return crud.get_all_active_tickets_of_event(db, event_id)
+    return await db.run_sync(crud.get_all_active_tickets_of_event, event_id)
 
 
 ### Ticket CRUD
@@ -706,20 +815,54 @@ def spectest_ticket(
     if not auth.check_school(user):
         raise HTTPException(HTTP_403_FORBIDDEN)
 
-    if crud.count_tickets_for_event(db, event) + 1 <= event.ticket_stock:
-        res = crud.spectest_ticket(group_id, event_id, db, user)
-    else:
+    if not ticket_stock.reserve(db, event, 1):
         raise HTTPException(404, "already max")
+    try:
+        res = crud.spectest_ticket(group_id, event_id, db, user)
+    except:
+        ticket_stock.release(event.id, 1)
+        raise
 
     return res
 
 
+WAITING_ROOM_REJECTED = "順番待ちの順番が来ていないか、順番待ちのトークンが無効です。順番を確認してからもう一度お試しください"
+
+
+def waiting_room_admitted(
+    group_id: str,
+    event_id: str,
+    waiting_room_token: Union[str, None] = None,
+    user: schemas.JWTUser = Depends(auth.get_current_user),
+) -> bool:
+    """順番待ちをする公演で順番が来ていないリクエストを、DBのコネクションを取る前に断る(create_ticketの依存関係)
+
+    順番待ちをせずに整理券の取得を連打するリクエストがDBに届かないよう、公演はキャッシュ(GET /groups/{group_id}/events/{event_id})から読む
+    キャッシュに無い時は何もせず、create_ticketがDBから読んだ公演で確認する
+
+    Returns:
+        bool: 順番が来ていることを確認できた→True
+    """
+    cached = peek(cache_keys.event(group_id, event_id))
+    if cached is None:
+        return False
+    event = schemas.Event(**json.loads(cached))
+    now = datetime.now(timezone(timedelta(hours=+9)))
+    if not (event.sell_starts < now < event.sell_ends) or not waiting_room.required(
+        event
+    ):
+        return False
+    if not waiting_room.check(event, waiting_room_token, auth.user_object_id(user)):
+        raise HTTPException(HTTP_403_FORBIDDEN, WAITING_ROOM_REJECTED)
+    return True
+
+
 @app.post(
     "/groups/{group_id}/events/{event_id}/tickets",
     response_model=schemas.Ticket,
     summary="整理券取得",
     tags=["tickets"],
-    description="### 必要な権限\nアクティブ(校内に来場済み)なユーザーであること\n### ログインが必要か\nはい\n### 説明\n整理券取得できる条件\n- ユーザーが校内に来場ずみ\n- 現在時刻が取りたい整理券の配布時間内\n- 当該公演の整理券在庫が余っている\n- ユーザーは既にこの整理券を取得していない\n- ユーザーは既に当該公演と同じ時間帯の公演の整理券を取得していない\n- 同時入場人数は3名まで(***Azure ADのアカウントは1人という制約は無くしました***)",
+    description="### 必要な権限\nアクティブ(校内に来場済み)なユーザーであること\n### ログインが必要か\nはい\n### 説明\n整理券取得できる条件\n- ユーザーが校内に来場ずみ\n- 現在時刻が取りたい整理券の配布時間内\n- 当該公演の整理券在庫が余っている\n- ユーザーは既にこの整理券を取得していない\n- ユーザーは既に当該公演と同じ時間帯の公演の整理券を取得していない\n- 同時入場人数は3名まで(***Azure ADのアカウントは1人という制約は無くしました***)\n- 順番待ちをする公演(waiting_room)では、順番が来た順番待ちのトークンを`waiting_room_token`に指定する",
     responses={
         "404": {
             "description": "- 指定されたGroupまたはEventが見つかりません\n- 既にこの公演・この公演と同じ時間帯の公演の整理券を取得している場合、新たに取得はできません\n- この公演の整理券は売り切れています\n- 現在整理券の配布時間外です"
@@ -727,13 +870,19 @@ def spectest_ticket(
         "400": {
             "description": "- 同時入場人数は3人まで(***Azure ADのアカウントは1人という制約は無くしました***)です\n- 校内への来場処理をしたユーザーのみが整理券を取得できます"
         },
+        "403": {
+            "description": "- この公演は整理券を取得できる人が制限されています\n- 順番待ちの順番が来ていないか、順番待ちのトークンが無効です"
+        },
+        "503": {"description": "- 整理券の残数を確認できません(Redisに接続できない)"},
     },
 )
 def create_ticket(
     group_id: str,
     event_id: str,
     person: int,
+    waiting_room_token: Union[str, None] = None,
     user: schemas.JWTUser = Depends(auth.get_current_user),
+    admitted: bool = Depends(waiting_room_admitted),  # dbより先に確認する
     db: Session = Depends(db.get_db),
 ):
     event = crud.get_event(db, event_id)
@@ -748,26 +897,100 @@ def create_ticket(
         event.sell_starts < datetime.now(timezone(timedelta(hours=+9)))
         and datetime.now(timezone(timedelta(hours=+9))) < event.sell_ends
     ):
-        qualified: bool = crud.check_qualified_for_ticket(db, event, user)
+        # 順番待ちをする公演では、DBを使う確認の前に順番が来ているかを確認する(キャッシュで確認できていなければ)
         if (
-            crud.count_tickets_for_event(db, event) + person <= event.ticket_stock
-            and qualified
-        ):  ##まだチケットが余っていて、同時間帯の公演の整理券取得ではない
-            if 0 < person < 4:  # 1アカウントにつき3人まで入れる
-                return crud.create_ticket(db, event, user, person)
-            else:
-                raise HTTPException(400, "同時入場人数は3人までです")
-        elif not qualified:
+            waiting_room.required(event)
+            and not admitted
+            and not waiting_room.check(
+                event, waiting_room_token, auth.user_object_id(user)
+            )
+        ):
+            raise HTTPException(HTTP_403_FORBIDDEN, WAITING_ROOM_REJECTED)
+        if not crud.check_qualified_for_ticket(db, event, user):
             raise HTTPException(
                 404,
                 "既にこの公演・この公演と重複する時間帯の公演の整理券を取得している場合、新たに取得はできません。または取得できる整理券の枚数の上限を超えています",
             )
-        else:
+        if not 0 < person < 4:  # 1アカウントにつき3人まで入れる
+            raise HTTPException(400, "同時入場人数は3人までです")
+        # 残数の確認と確保はRedis上でアトミックに行う(ticket_stock.py)
+        if not ticket_stock.reserve(db, event, person):
             raise HTTPException(404, "この公演の整理券は売り切れています")
+        try:
+            return crud.create_ticket(db, event, user, person)
+        except:
+            ticket_stock.release(event.id, person)
+            raise
     else:
         raise HTTPException(404, "現在整理券の配布時間外です")
 
 
+@app.post(
+    "/groups/{group_id}/events/{event_id}/waiting_room",
+    response_model=schemas.WaitingRoomStatus,
+    summary="整理券の配布開始時の順番待ちの列に並ぶ",
+    tags=["tickets"],
+    description="### 必要な権限\nなし\n### ログインが必要か\nはい\n### 説明\n順番待ちをする公演(waiting_room)の列に並び、順番と順番待ちのトークンを返します。並べるのは配布開始の10分前(WAITING_ROOM_OPENS_BEFORE)から配布終了までで、同じユーザーが何度並んでも順番は変わりません\n- 配布開始後、前から順に1秒に数十人(DBの混み具合によって変わる)ずつ順番が来ます\n- `poll_after`秒ごとに GET /groups/{group_id}/events/{event_id}/waiting_room で順番が来たかを確認し、`admitted`になったらトークンを`waiting_room_token`に指定して整理券を取得してください\n- 順番待ちをしない公演・順番待ちを使えない時は、`admitted`が`true`で空のトークンを返します(そのまま整理券を取得できます)",
+    responses={
+        "404": {
+            "description": "- 指定されたGroupまたはEventが見つかりません\n- 現在整理券の配布時間外です"
+        },
+        "403": {"description": "この公演は整理券を取得できる人が制限されています"},
+    },
+)
+def join_waiting_room(
+    group_id: str,
+    event_id: str,
+    user: schemas.JWTUser = Depends(auth.get_current_user),
+    db: Session = Depends(db.get_reader_db),
+):
+    event = crud.get_event(db, event_id)
+    if not event or event.group_id != group_id:
+        raise HTTPException(404, "指定されたGroupまたはEventが見つかりません")
+    if not auth.check_role(event.target, user):
+        raise HTTPException(
+            HTTP_403_FORBIDDEN, "この公演は整理券を取得できる人が制限されています。"
+        )
+    now = datetime.now(timezone(timedelta(hours=+9)))
+    opens_before = timedelta(seconds=int(settings.waiting_room_opens_before))
+    if not (event.sell_starts - opens_before <= now < event.sell_ends):
+        raise HTTPException(404, "現在整理券の配布時間外です")
+    if not waiting_room.required(event):
+        return waiting_room.pass_through()
+    room_status = waiting_room.join(event, auth.user_object_id(user))
+    if room_status is None:
+        # 並んだ直後に列が作り直された
+        raise HTTPException(
+            409, "順番待ちの列が作り直されました。もう一度並んでください"
+        )
+    return room_status
+
+
+@app.get(
+    "/groups/{group_id}/events/{event_id}/waiting_room",
+    response_model=schemas.WaitingRoomStatus,
+    summary="整理券の配布開始時の順番待ちの順番が来たかを確認",
+    tags=["tickets"],
+    description="### 必要な権限\nなし\n### ログインが必要か\nいいえ\n### 説明\nPOST /groups/{group_id}/events/{event_id}/waiting_room で受け取ったトークンの順番と、前に並んでいる人数・順番が来るまでのおおよその秒数を返します。DBを使わないので、`poll_after`秒ごとに繰り返し呼んでください",
+    responses={
+        "400": {"description": "順番待ちのトークンが無効です"},
+        "409": {
+            "description": "順番待ちの列が作り直されたので、もう一度並ぶ必要があります"
+        },
+    },
+)
+def get_waiting_room_status(group_id: str, event_id: str, token: str):
+    payload = waiting_room.decode(token)
+    if payload is None or payload.event_id != event_id:
+        raise HTTPException(400, "順番待ちのトークンが無効です")
+    room_status = waiting_room.status(token)
+    if room_status is None:
+        raise HTTPException(
+            409, "順番待ちの列が作り直されました。もう一度並んでください"
+        )
+    return room_status
+
+
 @app.post(
     "/groups/{group_id}/events/{event_id}/tickets/admin",
     response_model=schemas.Ticket,
@@ -790,15 +1013,15 @@ def create_ticket_admin(
             HTTP_403_FORBIDDEN, "この公演は整理券を取得できる人が制限されています。"
         )
 
-    if (
-        crud.count_tickets_for_event(db, event) + person <= event.ticket_stock
-    ):  ##まだチケットが余っていて、同時間帯の公演の整理券取得ではない
-        if 0 < person < 4:  # 1アカウントにつき3人まで入れる
-            return crud.create_ticket(db, event, user, person)
-        else:
-            raise HTTPException(400, "同時入場人数は3人までです")
-    else:
+    if not 0 < person < 4:  # 1アカウントにつき3人まで入れる
+        raise HTTPException(400, "同時入場人数は3人までです")
+    if not ticket_stock.reserve(db, event, person):
         raise HTTPException(404, "この公演の整理券は売り切れています")
+    try:
+        return crud.create_ticket(db, event, user, person)
+    except:
+        ticket_stock.release(event.id, person)
+        raise
 
 
 @app.post(
@@ -814,6 +1037,7 @@ def create_ticket_admin(
         "400": {
             "description": "- 同時入場人数は3人まで(***Azure ADのアカウントは1人という制約は無くしました***)です\n- 校内への来場処理をしたユーザーのみが整理券を取得できます"
         },
+        "503": {"description": "- 整理券の残数を確認できません(Redisに接続できない)"},
     },
 )
 def create_family_ticket(
@@ -841,13 +1065,16 @@ def create_family_ticket(
         timezone(timedelta(hours=+9))
     ):
         # チケットがまだ余っている
-        if crud.count_tickets_for_event(db, event) + 1 <= event.ticket_stock:
+        if not ticket_stock.reserve(db, event, 1):
+            raise HTTPException(404, "この公演の整理券は売り切れています")
+        try:
             if crud.count_taken_family_ticket(db, user) < 2:
                 return crud.create_ticket(db, event, user, 1, True)
             else:
                 raise HTTPException(404, "既に保護者用優先券を2枚以上取得しています。")
-        else:
-            raise HTTPException(404, "この公演の整理券は売り切れています")
+        except:
+            ticket_stock.release(event.id, 1)
+            raise
     else:
         raise HTTPException(404, "現在優先券の配布時間外です")
 
@@ -857,7 +1084,7 @@ def create_family_ticket(
     response_model=schemas.TicketsNumberData,
     summary="指定された公演の整理券の枚数情報を取得 [Redis TTL=15s]",
     tags=["tickets"],
-    description='結果はRedisに "tickets-numberdata-<Event.id>" というキーでキャッシュされます(TTL=15) \n ### 必要な権限\nなし\n### ログインが必要か\nいいえ\n',
+    description='結果はRedisに "tickets-numberdata-<Event.id>" というキーでキャッシュされます(TTL=15 期限切れの後は1リクエストだけが作り直し、その間は他のリクエストに古い値を返します) \n ### 必要な権限\nなし\n### ログインが必要か\nいいえ\n',
     responses={
         "404": {
             "description": "- 指定されたGroupが見つかりません\n- 指定されたEventが見つかりません"
@@ -865,20 +1092,70 @@ def create_family_ticket(
     },
 )
 def count_tickets(group_id: str, event_id: str, db: Session = Depends(db.get_db)):
-    cacheresult = redis_get_if_possible("tickets-numberdata-" + event_id)
-    if cacheresult:
-        return json.loads(cacheresult)
+    def compute():
+        event = crud.get_event(db, event_id)
+        if not event:
+            return None
+        return ticket_stock.numbers(db, event).json()
+
+    cacheresult = get_or_compute(
+        cache_keys.tickets_numberdata(event_id), compute, fresh_for=15
+    )
+    if cacheresult is None:
+        raise HTTPException(404, "指定されたEventが見つかりません")
+    return json.loads(cacheresult)
+
+
+@app.get(
+    "/groups/{group_id}/events/{event_id}/tickets/stream",
+    summary="指定された公演の整理券の枚数情報を配信(Server-Sent Events)",
+    tags=["tickets"],
+    description="### 必要な権限\nなし\n### ログインが必要か\nいいえ\n### 説明\n接続した時と、整理券の取得・キャンセルで枚数が変わった時に、`event: tickets` で TicketsNumberData のJSONを送ります(同じ公演について送るのは最短で1秒に1回)。公演が削除されると `event: deleted` を送って終了します。ブラウザでは EventSource で受け取れます",
+    responses={"404": {"description": "指定されたEventが見つかりません"}},
+)
+async def stream_tickets(
+    group_id: str, event_id: str, db: Session = Depends(db.get_db)
+):
+    # 枚数を数える時に集計の行を作り直すことがあるので、レプリカではなくプライマリを使う(count_ticketsと同じ)
+    # 最初の枚数を数える前に登録しておけば、その間に変わった分も後から送られる
+    subscription = ticket_stream.subscribe(event_id)
+    try:
+        first = await run_in_threadpool(ticket_stream.snapshot, db, event_id)
+    except:
+        ticket_stream.unsubscribe(subscription)
+        raise
+    finally:
+        # 配信している間はコネクションを持ち続けないように、すぐにプールに返す
+        await run_in_threadpool(db.close)
+    if first is None:
+        ticket_stream.unsubscribe(subscription)
+        raise HTTPException(404, "指定されたEventが見つかりません")
+    return StreamingResponse(
+        ticket_stream.stream(subscription, first),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.put(
+    "/groups/{group_id}/events/{event_id}/tickets/stock",
+    response_model=schemas.TicketsNumberData,
+    summary="指定された公演の整理券の残数(Redis)をDBから作り直す",
+    tags=["tickets", "admin"],
+    description="### 必要な権限\nAdmin\n### ログインが必要か\nはい\n### 説明\nRedisに保持している整理券の残数を、DBの整理券から数え直して上書きします。DBを直接編集した後などに使ってください",
+    responses={"404": {"description": "指定されたEventが見つかりません"}},
+)
+def rebuild_ticket_stock(
+    group_id: str,
+    event_id: str,
+    permission: schemas.JWTUser = Depends(auth.admin),
+    db: Session = Depends(db.get_db),
+):
     event = crud.get_event(db, event_id)
     if not event:
         raise HTTPException(404, "指定されたEventが見つかりません")
-    taken_tickets: int = crud.count_tickets_for_event(db, event)
-    stock: int = event.ticket_stock
-    left_tickets: int = stock - taken_tickets
-    tnd = schemas.TicketsNumberData(
-        taken_tickets=taken_tickets, left_tickets=left_tickets, stock=stock
-    )
-    redis_set_if_possible("tickets-numberdata-" + event.id, tnd.json(), ex=15)
-    return tnd
+    ticket_stock.rebuild(db, event)
+    return ticket_stock.numbers(db, event)
 
 
 @app.delete(
@@ -913,17 +1190,38 @@ def delete_ticket(
     description="### 必要な権限\nschool(暫定)\n### ログインが必要か\nはい\n### 説明\n総当たり攻撃を防ぐため、指定された整理券は存在するが権限が無い場合も404を返す",
     responses={"404": {"description": "- 指定された整理券が見つかりません"}},
 )
-def get_ticket(
+async def get_ticket(
     ticket_id: str,
     user: schemas.JWTUser = Depends(auth.school),
-    db: Session = Depends(db.get_db),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
-    ticket = crud.get_ticket(db, ticket_id)
+    ticket = await db.run_sync(crud.get_ticket, ticket_id)
     if not ticket:
         raise HTTPException(404, "指定された整理券が見つかりません")
     return ticket
 
 
+@app.put(
+    "/tickets/redeem",
+    response_model=schemas.TicketRedeemResponse,
+    summary="複数の整理券をまとめてもぎる",
+    tags=["tickets"],
+    description="### 必要な権限\nschool\n### ログインが必要か\nはい\n### 説明\n整理券のidの配列を渡してください。activeな整理券だけをusedにし、結果を返します\n- used: 今回もぎった\n- already_used: 既にもぎられていた\n- unavailable: キャンセルされているなど\n- unknown: 存在しない\n複数の入口で同時に同じ整理券をもぎっても、usedになるのはどちらか一方だけです",
+)
+def redeem_tickets(
+    ticket_ids: List[str],
+    permission: schemas.JWTUser = Depends(auth.school),
+    db: Session = Depends(db.get_db),
+):
+    results = crud.use_tickets(db, ticket_ids)
+    response = schemas.TicketRedeemResponse(
+        used=[], already_used=[], unavailable=[], unknown=[]
+    )
+    for ticket_id, result in results.items():
+        getattr(response, result).append(ticket_id)
+    return response
+
+
 @app.put(
     "/tickets/{ticket_id}",
     response_model=schemas.Ticket,
@@ -942,6 +1240,115 @@ def use_ticket(
     raise HTTPException(404, "整理券は使用済み、または存在しません。")
 
 
+@app.get(
+    "/tickets/{ticket_id}/token",
+    response_model=str,
+    summary="指定された整理券の署名付きトークンを取得",
+    tags=["tickets"],
+    description="### 必要な権限\n指定された整理券のオーナー\n### ログインが必要か\nはい\n### 説明\n入口でQRコードにして見せるためのトークンを再発行します。総当たり攻撃を防ぐため、指定された整理券は存在するが所有者でない場合も404を返す",
+    responses={
+        "404": {"description": "- 指定された整理券が見つかりません"},
+        "503": {"description": "- 整理券のトークンを発行する設定がされていません"},
+    },
+)
+def get_ticket_token(
+    ticket_id: str,
+    user: schemas.JWTUser = Depends(auth.get_current_user),
+    db: Session = Depends(db.get_db),
+):
+    if not ticket_token.enabled():
+        raise HTTPException(503, "整理券のトークンを発行する設定がされていません")
+    ticket = crud.get_ticket(db, ticket_id)
+    if not ticket or ticket.owner_id != auth.user_object_id(user):
+        raise HTTPException(404, "指定された整理券が見つかりません")
+    event = crud.get_event(db, ticket.event_id)
+    if not event:
+        raise HTTPException(404, "指定された整理券が見つかりません")
+    return ticket_token.issue(ticket, event)
+
+
+@app.post(
+    "/tickets/verify",
+    response_model=schemas.TicketTokenVerifyResponse,
+    summary="整理券の署名付きトークンを確認",
+    tags=["tickets"],
+    description="### 必要な権限\nschool\n### ログインが必要か\nはい\n### 説明\n署名・入場できる時間帯・整理券がactiveかを確認します。もぎりはしません\n入口の端末は鍵(TICKET_TOKEN_SECRET)があればこのエンドポイントを使わずにその場で確認できます",
+    responses={"503": {"description": "- 整理券のトークンを発行する設定がされていません"}},
+)
+def verify_ticket_token(
+    body: schemas.TicketTokenVerify,
+    permission: schemas.JWTUser = Depends(auth.school),
+    db: Session = Depends(db.get_db),
+):
+    if not ticket_token.enabled():
+        raise HTTPException(503, "整理券のトークンを発行する設定がされていません")
+    payload = ticket_token.decode(body.token)
+    if payload is None:
+        return schemas.TicketTokenVerifyResponse(
+            valid=False, reason="トークンが不正です", payload=None
+        )
+    if not ticket_token.in_window(payload, datetime.now(timezone(timedelta(hours=+9)))):
+        return schemas.TicketTokenVerifyResponse(
+            valid=False, reason="入場できる時間帯ではありません", payload=payload
+        )
+    if not crud.check_ticket_available(db, payload.ticket_id):
+        return schemas.TicketTokenVerifyResponse(
+            valid=False, reason="整理券は使用済み、または存在しません。", payload=payload
+        )
+    return schemas.TicketTokenVerifyResponse(valid=True, reason=None, payload=payload)
+
+
+@app.post(
+    "/tickets/scans",
+    response_model=List[schemas.TicketScanResult],
+    summary="入口の端末でもぎった整理券をまとめて登録",
+    tags=["tickets"],
+    description="### 必要な権限\nschool\n### ログインが必要か\nはい\n### 説明\n入口の端末がオフラインで確認・もぎった整理券のトークンとその時刻をまとめて送ります\n同じトークンを何度送っても、整理券が2回もぎられることはありません(2回目以降はalready_used)\n- used: 今回もぎった\n- already_used: 既にもぎられていた\n- unavailable: キャンセルされているなど\n- unknown: 整理券が存在しない\n- invalid_token: トークンが不正\n- out_of_window: もぎった時刻が入場できる時間帯の外",
+    responses={"503": {"description": "- 整理券のトークンを発行する設定がされていません"}},
+)
+def upload_ticket_scans(
+    scans: List[schemas.TicketScan],
+    permission: schemas.JWTUser = Depends(auth.school),
+    db: Session = Depends(db.get_db),
+):
+    if not ticket_token.enabled():
+        raise HTTPException(503, "整理券のトークンを発行する設定がされていません")
+    results: List[schemas.TicketScanResult] = []
+    ticket_ids: List[str] = []
+    for scan in scans:
+        payload = ticket_token.decode(scan.token)
+        if payload is None:
+            results.append(
+                schemas.TicketScanResult(
+                    token=scan.token, ticket_id=None, result="invalid_token"
+                )
+            )
+        elif not ticket_token.in_window(payload, scan.scanned_at):
+            results.append(
+                schemas.TicketScanResult(
+                    token=scan.token, ticket_id=payload.ticket_id, result="out_of_window"
+                )
+            )
+        elif payload.ticket_id in ticket_ids:  # 同じ整理券を2回もぎった記録
+            results.append(
+                schemas.TicketScanResult(
+                    token=scan.token, ticket_id=payload.ticket_id, result="already_used"
+                )
+            )
+        else:
+            ticket_ids.append(payload.ticket_id)
+            results.append(
+                schemas.TicketScanResult(
+                    token=scan.token, ticket_id=payload.ticket_id, result="unknown"
+                )
+            )
+    used = crud.use_tickets(db, ticket_ids)
+    for result in results:
+        if result.result == "unknown":
+            result.result = used[result.ticket_id]
+    return results
+
+
 @app.post(
     "/chief/groups/{group_id}/events/{event_id}/tickets",
     response_model=schemas.Ticket,
@@ -994,12 +1401,12 @@ def chief_delete_ticket(
     tags=["tickets"],
     description="### 必要な権限\nなし\n### ログインが必要か\nはい\n選択された整理券がactiveな状態であるときTrueを返す",
 )
-def check_ticket_available(
+async def check_ticket_available(
     ticket_id: str,
     user: schemas.JWTUser = Depends(auth.get_current_user),
-    db: Session = Depends(db.get_db),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
-    return crud.check_ticket_available(db, ticket_id)
+    return await db.run_sync(crud.check_ticket_available, ticket_id)
 
 
 ### Vote Crud
@@ -1032,6 +1439,27 @@ def create_vote(
     return crud.create_vote(db, group_id, user)
 
 
+# /votes/{group_id}より前に書かないとrankingがgroup_idとして扱われる
+@app.get(
+    "/votes/ranking",
+    response_model=List[schemas.GroupVotesResponse],
+    summary="全Groupの投票数を多い順に取得",
+    tags=["votes"],
+    description="### 必要な権限\nAdminまたはchief\n### ログインが必要か\nはい\n### 説明\n- 投票数はRedisで数えていて、最大でVOTE_RANKING_RECONCILE_INTERVAL秒ごとにDBの投票数で作り直されます",
+    responses={"401": {"detail": "Adminまたはchiefである必要があります"}},
+)
+def get_votes_ranking(
+    user: schemas.JWTUser = Depends(auth.get_current_user),
+    db: Session = Depends(db.get_db),
+):
+    if not (auth.check_admin(user) or auth.check_chief(user)):
+        raise HTTPException(401, "Adminまたはchiefである必要があります")
+    return [
+        schemas.GroupVotesResponse(group_id=group_id, votes_num=votes_num)
+        for group_id, votes_num in vote_ranking.ranking(db)
+    ]
+
+
 @app.get(
     "/votes/{group_id}",
     response_model=schemas.GroupVotesResponse,
@@ -1043,19 +1471,19 @@ def create_vote(
         "401": {"detail": "Adminまたはchiefである必要があります"},
     },
 )
-def get_group_votes(
+async def get_group_votes(
     group_id: str,
     user: schemas.JWTUser = Depends(auth.get_current_user),
-    db: Session = Depends(db.get_db),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
     # auth.check_chiefでadminも通るのでadminかの判定はいらないがわかりやすいようにauth.check_adminも書いておく
     if not (auth.check_admin(user) or auth.check_chief(user)):
         raise HTTPException(401, "Adminまたはchiefである必要があります")
-    g = crud.get_group_public(db, group_id)
+    g = await db.run_sync(crud.get_group_public, group_id)
     if g is None:
         raise HTTPException(404, "指定された団体が見つかりません")
     return schemas.GroupVotesResponse(
-        group_id=g.id, votes_num=crud.get_group_votes(db, g)
+        group_id=g.id, votes_num=await db.run_sync(crud.get_group_votes, g)
     )
 
 
@@ -1066,15 +1494,53 @@ def get_group_votes(
     tags=["votes"],
     description="### 必要な権限\nなし\n### ログインが必要か\nはい",
 )
-def get_user_votable(
+async def get_user_votable(
     user: schemas.JWTUser = Depends(auth.get_current_user),
-    db: Session = Depends(db.get_db),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
-    if crud.get_user_vote_count(db, user) < 2:
+    if await db.run_sync(crud.get_user_vote_count, user) < 2:
         return True
     return False
 
 
+@app.get(
+    "/users/me/votable_groups",
+    response_model=List[str],
+    summary="userが投票可能な団体のidを全て取得",
+    tags=["votes"],
+    description="### 必要な権限\nなし\n### ログインが必要か\nはい\n### 説明\n- 全団体についてGET /users/me/votes/{group_id}を呼んだ結果がTrueになる団体のidを返します\n- 既に2回投票している場合は空のリストを返します",
+)
+async def get_user_votable_groups(
+    user: schemas.JWTUser = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(db.get_async_db),
+):
+    # ユーザーの整理券・投票が変わるまで結果が変わらない部分だけをキャッシュし、公演が終わったかどうかは毎回判定する
+    async def compute():
+        ends_at = await db.run_sync(crud.get_unvoted_group_ends_at, user)
+        return json.dumps(
+            {
+                "vote_count": await db.run_sync(crud.get_user_vote_count, user),
+                "ends_at": {g: e.isoformat() for g, e in ends_at.items()},
+            }
+        )
+
+    cached = json.loads(
+        await aget_or_compute(
+            cache_keys.user_votable_groups(auth.user_object_id(user)),
+            compute,
+            fresh_for=REDIS_CACHE_EXPIRE,
+        )
+    )
+    if cached["vote_count"] >= 2:
+        return []
+    now = datetime.now(timezone(timedelta(hours=+9)))
+    return sorted(
+        group_id
+        for group_id, ends_at in cached["ends_at"].items()
+        if datetime.fromisoformat(ends_at) < now
+    )
+
+
 @app.get(
     "/users/me/votes/{group_id}",
     response_model=bool,
@@ -1082,15 +1548,15 @@ def get_user_votable(
     tags=["votes"],
     description="指定された団体に対して投票可能かを返す\n### 判定項目\n- 整理券の有効性\n- 団体に対して投票済みか\n- 既に投票している回数（2回以上投票している場合投票不可）",
 )
-def get_user_votable_group(
+async def get_user_votable_group(
     group_id: str,
     user: schemas.JWTUser = Depends(auth.get_current_user),
-    db: Session = Depends(db.get_db),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
-    if crud.get_user_vote_count(db, user) >= 2:
+    if await db.run_sync(crud.get_user_vote_count, user) >= 2:
         return False
 
-    return crud.get_user_votable(db, user, group_id)
+    return await db.run_sync(crud.get_user_votable, user, group_id)
 
 
 # urlを/users/me/votes/countにすると/users/me/votes/{group_id}と認識されて間違った関数が実行される
@@ -1101,11 +1567,11 @@ def get_user_votable_group(
     tags=["votes"],
     description="ユーザーが投票した数を返します",
 )
-def get_user_vote_count(
+async def get_user_vote_count(
     user: schemas.JWTUser = Depends(auth.get_current_user),
-    db: Session = Depends(db.get_db),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
-    return crud.get_user_vote_count(db, user)
+    return await db.run_sync(crud.get_user_vote_count, user)
 
 
 @app.get(
@@ -1115,11 +1581,11 @@ def get_user_vote_count(
     description="userが投票した投票情報を返す",
     tags=["votes"],
 )
-def get_user_votes(
+async def get_user_votes(
     user: schemas.JWTUser = Depends(auth.get_current_user),
-    db: Session = Depends(db.get_db),
+    db: AsyncSession = Depends(db.get_async_db),
 ):
-    return crud.get_user_votes(db, user)
+    return await db.run_sync(crud.get_user_votes, user)
 
 
 # Tag
@@ -1148,7 +1614,7 @@ def create_tag(
     tags=["tags"],
     description="### 必要な権限\nなし\n### ログインが必要か\nいいえ",
 )
-def get_all_tags(db: Session = Depends(db.get_db)):
+def get_all_tags(db: Session = Depends(db.get_reader_db)):
     return crud.get_all_tags(db)
 
 
@@ -1160,7 +1626,7 @@ def get_all_tags(db: Session = Depends(db.get_db)):
     description="### 必要な権限\nなし\n### ログインが必要か\nいいえ\n",
     responses={"404": {"description": "指定されたTagが見つかりません"}},
 )
-def get_tag(tag_id: str, db: Session = Depends(db.get_db)):
+def get_tag(tag_id: str, db: Session = Depends(db.get_reader_db)):
     tag_result = crud.get_tag(db, tag_id)
     if not tag_result:
         raise HTTPException(404, "指定されたTagが見つかりません")
@@ -1238,32 +1704,87 @@ def update_frontend(permission: schemas.JWTUser = Depends(auth.admin)):
         HTTPException(res.status_code, "Cloudflareへのデプロイに失敗しました")
 
 
+@app.get(
+    "/admin/metrics/redis",
+    response_model=schemas.RedisMetricsResponse,
+    summary="このプロセスのRedisキャッシュの統計情報を取得",
+    tags=["admin"],
+    description="### 必要な権限\nAdmin\n### ログインが必要か\nはい\n### 説明\nリクエストを処理したworkerプロセスが起動してからのヒット・ミス・エラーの回数とレイテンシを返します。workerごとに別々に数えています",
+)
+def get_redis_metrics(permission: schemas.JWTUser = Depends(auth.admin)):
+    return redis_metrics()
+
+
+@app.get(
+    "/admin/metrics/jwt",
+    response_model=schemas.JWTCacheMetricsResponse,
+    summary="このプロセスの検証済みJWTのキャッシュの統計情報を取得",
+    tags=["admin"],
+    description="### 必要な権限\nAdmin\n### ログインが必要か\nはい\n### 説明\nリクエストを処理したworkerプロセスが起動してからのヒット・ミスの回数とヒット率を返します。workerごとに別々に数えています",
+)
+def get_jwt_cache_metrics(permission: schemas.JWTUser = Depends(auth.admin)):
+    return auth.jwt_cache_metrics()
+
+
+@app.get(
+    "/admin/metrics/db",
+    response_model=schemas.DBMetricsResponse,
+    summary="このプロセスのMySQLのコネクションプールの統計情報を取得",
+    tags=["admin"],
+    description="### 必要な権限\nAdmin\n### ログインが必要か\nはい\n### 説明\nリクエストを処理したworkerプロセスが起動してからの、コネクションプールの貸し出し中の本数・コネクションを取るまでに待った時間・503を返した回数などを返します。workerごとに別々に数えています",
+)
+def get_db_metrics(permission: schemas.JWTUser = Depends(auth.admin)):
+    return db.pool_metrics()
+
+
+@app.get(
+    "/admin/metrics/waiting_room",
+    response_model=schemas.WaitingRoomMetricsResponse,
+    summary="整理券の配布開始時の順番待ちの統計情報を取得",
+    tags=["admin"],
+    description="### 必要な権限\nAdmin\n### ログインが必要か\nはい\n### 説明\n今並べる公演ごとの列の長さ(全workerで共通)と、リクエストを処理したworkerプロセスが起動してからの、並んだ回数・整理券の取得を断った回数・整理券の取得に進むまでに待った時間・今1秒に通している人数を返します",
+)
+def get_waiting_room_metrics(
+    permission: schemas.JWTUser = Depends(auth.admin),
+    db: Session = Depends(db.get_reader_db),
+):
+    events = crud.get_waiting_room_events(
+        db,
+        datetime.now(timezone(timedelta(hours=+9))),
+        timedelta(seconds=int(settings.waiting_room_opens_before)),
+    )
+    return waiting_room.metrics([event.id for event in events])
+
+
 @app.post(
     "/support/events",
     summary="公演の一括追加",
     tags=["admin"],
-    description="csvファイルを元に公演を一斉に追加します。csvファイルについてはサンプルのエクセルと同じ書式で書いたものにしてください。正しく処理されません。",
+    description="csvファイルを元に公演を一斉に追加します。csvファイルについてはサンプルのエクセルと同じ書式で書いたものにしてください。正しく処理されません。\n### mode\n- 指定なし: シートの全ての行を公演として追加します\n- diff: シートを公演の一覧として、既存の公演との差分(追加・更新・削除)を返します。DBは変更しません\n- apply: diffと同じ差分を反映します\n\n(group_id, starts_at, eventname)が同じ公演を同じものとみなします。シートに出てくる団体の公演のうち、シートに無いものは削除されます。整理券が取得されている公演の削除や、取得済みの人数より少ない人数への変更があれば、何も反映せずに400を返します",
 )
-async def create_all_events_from_csv(
+def create_all_events_from_csv(
     file: UploadFile = File(...),
+    mode: Union[schemas.EventImportMode, None] = None,
     permission: schemas.JWTUser = Depends(auth.chief),
     db: Session = Depends(db.get_db),
 ):
-    # pandasのDataFrameに読み込んだファイルを変換
-    content = file.file.read()
-    string_data = str(content, "utf-8")
-    data = StringIO(string_data)
-    df = pd.read_csv(data)
-    data.close()
-    file.file.close()
-
-    converted_df = crud.convert_df(df)
-    crud.check_df(db, converted_df)
-    crud.create_events_from_df(db, converted_df)
+    # アップロードされたファイル(一時ファイル)を少しずつ読みながら追加する 大きいファイルでも全体をメモリに載せない
+    # def のエンドポイントなので、読み込み・変換はスレッドプールで行われ、同じworkerの他のリクエストを止めない
+    try:
+        if mode is None:
+            return {"message": crud.import_events_from_csv(db, file.file)}
+        df = crud.load_events_csv(db, file.file)
+    finally:
+        file.file.close()
 
-    return {
-        "message": [converted_df.iloc[i, :].to_json() for i in range(len(converted_df))]
-    }
+    if mode == schemas.EventImportMode.diff:
+        return crud.diff_events_from_df(db, df)
+    return crud.apply_events_from_df(db, df)
+
+
+### Hebe・お知らせ
+# サイネージの画面が繰り返し読みに来るので、DBではなく各workerのメモリのスナップショットから返す(app/broadcast.py)
+# 変わった時だけ受け取りたい画面は /hebe/stream, /news/stream (Server-Sent Events)に接続する
 
 
 @app.get(
@@ -1272,12 +1793,8 @@ async def create_all_events_from_csv(
     summary="今やっているHebeの団体IDを取得",
     tags=["chief"],
 )
-def get_hebe_nowplaying(db: Session = Depends(db.get_db)):
-    h = crud.get_hebe_nowplaying(db)
-    if h is not None:
-        return h
-    hh = schemas.HebeResponse(group_id="")
-    return hh
+def get_hebe_nowplaying():
+    return broadcast.current("hebe")["nowplaying"]
 
 
 @app.get(
@@ -1286,12 +1803,22 @@ def get_hebe_nowplaying(db: Session = Depends(db.get_db)):
     summary="次のHebeの団体IDを取得",
     tags=["chief"],
 )
-def get_hebe_upnext(db: Session = Depends(db.get_db)):
-    h = crud.get_hebe_upnext(db)
-    if h is not None:
-        return h
-    hh = schemas.HebeResponse(group_id="")
-    return hh
+def get_hebe_upnext():
+    return broadcast.current("hebe")["upnext"]
+
+
+@app.get(
+    "/hebe/stream",
+    summary="今やっている・次のHebeの団体IDを配信(Server-Sent Events)",
+    tags=["chief"],
+    description='### 必要な権限\nなし\n### ログインが必要か\nいいえ\n### 説明\n接続した時と、変わった時に、`event: hebe` で {"nowplaying": {"group_id": ...}, "upnext": {"group_id": ...}} を送ります',
+)
+async def stream_hebe():
+    return StreamingResponse(
+        broadcast.stream(broadcast.subscribe("hebe")),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.post(
@@ -1330,8 +1857,22 @@ def set_hebe_upnext(
     summary="全てのお知らせ情報を取得する",
     tags=["news"],
 )
-def get_all_news(db: Session = Depends(db.get_db)):
-    return crud.get_all_news(db)
+def get_all_news():
+    return broadcast.current("news")
+
+
+@app.get(
+    "/news/stream",
+    summary="全てのお知らせ情報を配信(Server-Sent Events)",
+    tags=["news"],
+    description="### 必要な権限\nなし\n### ログインが必要か\nいいえ\n### 説明\n接続した時と、お知らせが作成・更新・削除された時に、`event: news` で全てのお知らせのリストを送ります",
+)
+async def stream_news():
+    return StreamingResponse(
+        broadcast.stream(broadcast.subscribe("news")),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get(
@@ -1340,8 +1881,11 @@ def get_all_news(db: Session = Depends(db.get_db)):
     response_model=schemas.NewsBase,
     tags=["news"],
 )
-def get_news(news_id: str, db: Session = Depends(db.get_db)):
-    return crud.get_news(db, news_id)
+def get_news(news_id: str):
+    for news in broadcast.current("news"):
+        if news["id"] == news_id:
+            return news
+    raise HTTPException(404, "指定されたidを持つnewsは存在しません。")
 
 
 @app.post(
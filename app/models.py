@@ -1,5 +1,7 @@
 # from numpy import integer
 # from pandas import notnull
+from datetime import datetime, timedelta, timezone
+
 from sqlalchemy import (
     TEXT,
     TIMESTAMP,
@@ -8,18 +10,48 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     UniqueConstraint,
     text,
 )
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
 
 # from sqlalchemy.dialects.mysql import TIMESTAMP as Timestamp
 from sqlalchemy.sql.functions import current_timestamp
 
 from app.db import Base
 
+JST = timezone(timedelta(hours=+9))
+
+
+class JSTDateTime(TypeDecorator):
+    """日本時間のDATETIME
+
+    MySQLのDATETIMEはタイムゾーンを持たない(TIMESTAMPと違って勝手に変換もされない)ので、日本時間に揃えてから保存し、読み込んだ時に日本時間のタイムゾーンを付ける
+    ISO 8601形式の文字列も受け付ける(CSVからの一括追加など)
+    """
+
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        if value.tzinfo is not None:
+            value = value.astimezone(JST).replace(tzinfo=None)
+        # DATETIMEは秒単位(MySQLは秒未満を四捨五入する)なので、DBによらず切り捨てに揃える
+        return value.replace(microsecond=0)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return value.replace(tzinfo=JST)
+
 
 class Event(Base):
     __tablename__ = "events"
@@ -28,16 +60,22 @@ class Event(Base):
     group_id = Column(VARCHAR(255), ForeignKey("groups.id"), nullable=False)
     eventname = Column(VARCHAR(255))
 
-    # 日時はISO 8601形式で文字列として保存 MySQLによって勝手にタイムゾーンをいじられたり保存されなかったりしたくない
-    starts_at = Column(VARCHAR(255), nullable=False)
-    ends_at = Column(VARCHAR(255), nullable=False)
-    sell_starts = Column(VARCHAR(255), nullable=False)
-    sell_ends = Column(VARCHAR(255), nullable=False)
+    # 日時は日本時間のDATETIMEとして保存 時刻での絞り込み・並べ替えにインデックスが使える
+    starts_at = Column(JSTDateTime, nullable=False)
+    ends_at = Column(JSTDateTime, nullable=False)
+    sell_starts = Column(JSTDateTime, nullable=False)
+    sell_ends = Column(JSTDateTime, nullable=False)
 
     lottery = Column(Boolean)
 
     target = Column(VARCHAR(255), nullable=False)
     ticket_stock = Column(Integer, nullable=False)  # 0でチケット機能を使わない
+    waiting_room = Column(Boolean, nullable=False, default=False, server_default=text("0"))  # 配布開始時に順番待ちをさせる(app/waiting_room.py)
+
+    __table_args__ = (
+        Index("ix_events_group_id_starts_at", "group_id", "starts_at"),  # 団体のその日の公演
+        Index("ix_events_sell_starts_sell_ends", "sell_starts", "sell_ends"),  # 配布中の公演
+    )
 
 
 class GroupTag(Base):
@@ -66,6 +104,11 @@ class Vote(Base):
     user_id = Column(VARCHAR(255), index=True, nullable=False)
     group_id = Column(VARCHAR(255), ForeignKey("groups.id"), nullable=False)
 
+    # 1人1団体に1票まで(投票済みかの判定をインデックスで保証する)
+    __table_args__ = (
+        UniqueConstraint("user_id", "group_id", name="unique_idx_userid_groupid"),
+    )
+
 
 class Group(Base):
     __tablename__ = "groups"
@@ -150,6 +193,28 @@ class Ticket(Base):
         nullable=False,
     )  # active,active,cancelled,used,pending,reject
 
+    # よく使う絞り込みに合わせた複合インデックス(テーブルを読まずにインデックスだけで済むよう、必要な列まで含める)
+    __table_args__ = (
+        # 公演の整理券の人数の合計 count_tickets_for_event
+        Index("ix_tickets_event_id_status_person", "event_id", "status", "person"),
+        # ユーザーの整理券・取得済みの公演 /users/me/tickets, check_qualified_for_ticket
+        Index("ix_tickets_owner_id_status_event_id", "owner_id", "status", "event_id"),
+        # ユーザーの団体ごとの整理券 get_user_votable
+        Index("ix_tickets_owner_id_group_id_status", "owner_id", "group_id", "status"),
+    )
+
+
+class EventTicketCounter(Base):
+    """公演ごとの整理券の人数の集計(app/ticket_counters.py) ticketsの状態を変えるときに同じトランザクションで更新する"""
+
+    __tablename__ = "event_ticket_counters"
+
+    event_id = Column(VARCHAR(255), ForeignKey("events.id"), primary_key=True)
+    taken = Column(Integer, nullable=False, default=0)  # active + used 在庫から引かれている人数
+    used = Column(Integer, nullable=False, default=0)  # used
+    paper = Column(Integer, nullable=False, default=0)  # paper(紙の整理券)
+    cancelled = Column(Integer, nullable=False, default=0)  # cancelled
+
 
 class HebeNowplaying(Base):
     __tablename__ = "hebenowplaying"
@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Union
+
+import requests
+from jwt import PyJWKClient, PyJWTError
+
+from app.config import settings
+
+"""
+Azure AD・B2CのOpenID Connectの設定(discovery document)とJWKS(公開鍵)の取得
+
+今まではapp/auth.pyがimportされた時点でrequests.getしていたので、workerの起動のたびにAzureへの通信を待ち、Azureに繋がらないと起動できなかった
+- 設定は最初に必要になった時に読み込む(lazy)
+- 取得した設定とJWKSはファイル(OIDC_SNAPSHOT_PATH)に保存し、次の起動時はまずそれを使う(Azureに繋がらなくても起動・検証できる)
+- バックグラウンドのスレッドが定期的(OIDC_REFRESH_INTERVAL)に取得し直してファイルも更新する
+- JWKSのキャッシュは期限切れにしないので、リクエストの処理中にJWKSを取得するのは知らないkidのトークンが来た時だけ
+"""
+
+JWKS_CACHE_LIFESPAN = 60 * 60 * 24 * 365  # JWKSはバックグラウンドで取得し直すので、リクエストの処理中には期限切れにしない
+
+
+class OIDCUnavailableError(Exception):
+    """設定をAzureからもファイルからも読み込めなかった"""
+
+
+class OIDCProvider:
+    def __init__(self, name: str, discovery_url: str) -> None:
+        self.name = name
+        self.discovery_url = discovery_url
+        self._config: Union[Dict[str, Any], None] = None
+        self._jwks_client: Union[PyJWKClient, None] = None
+        self._lock = threading.Lock()
+
+    @property
+    def issuer(self) -> str:
+        return self._load()["issuer"]
+
+    @property
+    def jwks_client(self) -> PyJWKClient:
+        self._load()
+        return self._jwks_client
+
+    def _load(self) -> Dict[str, Any]:
+        if self._config is not None:
+            return self._config
+        with self._lock:
+            if self._config is not None:
+                return self._config
+            snapshot = _read_snapshot().get(self.name)
+            if snapshot is not None:
+                self._set(snapshot["config"], snapshot.get("jwks"))
+            else:
+                self._set(self._fetch_config(), None)
+            return self._config
+
+    def _set(self, config: Dict[str, Any], jwks: Union[Dict[str, Any], None]) -> None:
+        if self._jwks_client is None or self._jwks_client.uri != config["jwks_uri"]:
+            self._jwks_client = PyJWKClient(
+                config["jwks_uri"], lifespan=JWKS_CACHE_LIFESPAN
+            )
+        if jwks is not None:
+            try:
+                self._jwks_client.jwk_set_cache.put(jwks)
+            except PyJWTError:
+                pass  # 使えない公開鍵は無視する(必要になった時にAzureから取得される)
+        self._config = config
+
+    def _fetch_config(self) -> Dict[str, Any]:
+        try:
+            response = requests.get(self.discovery_url, timeout=settings.oidc_timeout)
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise OIDCUnavailableError(
+                f"{self.name}のOpenID Connectの設定を取得できません( {e} )"
+            )
+
+    def refresh(self) -> Dict[str, Any]:
+        """設定とJWKSをAzureから取得し直す
+
+        Returns:
+            Dict[str, Any]: スナップショットに保存する内容
+        """
+        config = self._fetch_config()
+        with self._lock:
+            self._set(config, None)
+            jwks_client = self._jwks_client
+        jwks = jwks_client.fetch_data()  # jwk_set_cacheも更新される
+        return {"config": config, "jwks": jwks}
+
+
+def _read_snapshot() -> Dict[str, Any]:
+    try:
+        with open(settings.oidc_snapshot_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_snapshot(snapshot: Dict[str, Any]) -> None:
+    # 複数のworkerが同時に書いても壊れないよう、一時ファイルに書いてから置き換える
+    tmp_path = settings.oidc_snapshot_path + "." + str(os.getpid())
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, settings.oidc_snapshot_path)
+    except OSError as e:
+        print(f"OIDCのスナップショットを保存できません: {e}")
+
+
+b2c = OIDCProvider("b2c", settings.azure_b2c_openidconfiguration)
+ad = OIDCProvider("ad", settings.azure_ad_openidconfiguration)
+
+
+def refresh_all() -> None:
+    snapshot = _read_snapshot()
+    refreshed = False
+    for provider in (b2c, ad):
+        try:
+            snapshot[provider.name] = provider.refresh()
+            refreshed = True
+        except Exception as e:
+            # 取得できなかった場合は今までの設定・公開鍵を使い続ける
+            print(f"{provider.name}のOpenID Connectの設定・公開鍵を更新できません: {e}")
+    if refreshed:
+        _write_snapshot(snapshot)
+
+
+def _refresh_loop() -> None:
+    while True:
+        refresh_all()
+        time.sleep(settings.oidc_refresh_interval)
+
+
+_refresher: Union[threading.Thread, None] = None
+
+
+def start_refresher() -> None:
+    """設定・公開鍵を定期的に取得し直すスレッドを起動する(workerの起動時に1回呼ぶ)"""
+    global _refresher
+    if _refresher is not None:
+        return
+    _refresher = threading.Thread(target=_refresh_loop, name="oidc-refresh", daemon=True)
+    _refresher.start()
@@ -1,26 +1,168 @@
-from typing import Union
+import threading
+import time
+from typing import Dict, List, Union
 
 import redis
 
 from app.config import settings
 
+"""
+Redisへの接続をプロセス内で共有する
+- 呼び出しごとにredis.Redis(...)を作るとその度にTCP接続が張られるので、コネクションプールを1つだけ作って使い回す
+- Redisが落ちている間にリクエストごとに接続タイムアウトを待たないよう、失敗したらしばらくRedisに問い合わせない(サーキットブレーカー)
+- ヒット・ミス・エラーの回数とレイテンシを数えておき、/admin/metrics/redis で確認できるようにする
+"""
+
+_pool = redis.BlockingConnectionPool(
+    host=settings.redis_host,
+    port=6379,
+    db=0,
+    decode_responses=True,
+    max_connections=settings.redis_max_connections,
+    timeout=settings.redis_socket_timeout,  # プールが空くのを待つ時間
+    socket_connect_timeout=settings.redis_socket_timeout,
+    socket_timeout=settings.redis_socket_timeout,
+)
+_client = redis.Redis(connection_pool=_pool)
+
+_lock = threading.Lock()
+_breaker_open_until: float = 0.0  # この時刻(time.monotonic)まではRedisに問い合わせない
+_metrics = {
+    "hits": 0,
+    "misses": 0,
+    "errors": 0,
+    "skipped": 0,  # サーキットブレーカーが開いていてRedisに問い合わせなかった回数
+    "calls": 0,
+    "latency_total": 0.0,
+    "latency_max": 0.0,
+}
+
+
+def get_redis_if_possible() -> Union[redis.Redis, None]:
+    """共有しているRedisクライアントを返す サーキットブレーカーが開いている間はNoneを返す
+
+    このクライアントで直接コマンドを実行してredis.RedisErrorが発生した場合は、report_redis_error()を呼ぶこと
+    """
+    if time.monotonic() < _breaker_open_until:
+        with _lock:
+            _metrics["skipped"] += 1
+        return None
+    return _client
+
+
+def register_script(script: str):
+    """Luaスクリプトを登録する 実行するときはget_redis_if_possible()で取ったクライアントをclientに渡す"""
+    return _client.register_script(script)
+
+
+def report_redis_error() -> None:
+    """Redisへの問い合わせに失敗したことを記録し、サーキットブレーカーを開く"""
+    global _breaker_open_until
+    with _lock:
+        _metrics["errors"] += 1
+        _breaker_open_until = time.monotonic() + settings.redis_breaker_cooldown
+
+
+def _record(started: float, hits: int = 0, misses: int = 0) -> None:
+    latency = time.perf_counter() - started
+    with _lock:
+        _metrics["calls"] += 1
+        _metrics["hits"] += hits
+        _metrics["misses"] += misses
+        _metrics["latency_total"] += latency
+        if _metrics["latency_max"] < latency:
+            _metrics["latency_max"] = latency
+
 
 def redis_get_if_possible(key:str)->Union[str,None]:
+    conn = get_redis_if_possible()
+    if conn is None:
+        return None
+    started = time.perf_counter()
     try:
-        redis_conn = redis.Redis(host=settings.redis_host, port=6379, db=0,decode_responses=True)
-        cache_result=redis_conn.get(key)
-        if cache_result:
-            return cache_result
-    except:
-        pass
+        cache_result=conn.get(key)
+    except redis.RedisError:
+        report_redis_error()
+        return None
+    if cache_result:
+        _record(started, hits=1)
+        return cache_result
+    _record(started, misses=1)
     return None
+
+
+def redis_mget_if_possible(keys:List[str])->List[Union[str,None]]:
+    """複数のキーを1往復で取得する 取得できなかったキーはNone"""
+    conn = get_redis_if_possible()
+    if conn is None or len(keys) == 0:
+        return [None] * len(keys)
+    started = time.perf_counter()
+    try:
+        cache_results=conn.mget(keys)
+    except redis.RedisError:
+        report_redis_error()
+        return [None] * len(keys)
+    hits = len([r for r in cache_results if r])
+    _record(started, hits=hits, misses=len(keys) - hits)
+    return [r if r else None for r in cache_results]
+
+
 def redis_set_if_possible(key:str,value:str,ex:int):
+    conn = get_redis_if_possible()
+    if conn is None:
+        return 1
+    started = time.perf_counter()
     try:
-        redis_conn = redis.Redis(host=settings.redis_host, port=6379, db=0,decode_responses=True)
-        result=redis_conn.set(key,value,ex)
-        if result==0:
-            return 0
-    except:
-        pass
+        result=conn.set(key,value,ex)
+    except redis.RedisError:
+        report_redis_error()
+        return 1
+    _record(started)
+    if result==0:
+        return 0
     return 1
 
+
+def redis_set_many_if_possible(mapping:Dict[str,str],ex:int):
+    """複数のキーをpipelineで1往復でsetする"""
+    conn = get_redis_if_possible()
+    if conn is None or len(mapping) == 0:
+        return
+    started = time.perf_counter()
+    try:
+        pipe = conn.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(key, value, ex)
+        pipe.execute()
+    except redis.RedisError:
+        report_redis_error()
+        return
+    _record(started)
+
+
+def redis_delete_if_possible(*keys:str):
+    conn = get_redis_if_possible()
+    if conn is None or len(keys) == 0:
+        return
+    started = time.perf_counter()
+    try:
+        conn.delete(*keys)
+    except redis.RedisError:
+        report_redis_error()
+        return
+    _record(started)
+
+
+def redis_metrics() -> Dict[str, Union[int, float, bool]]:
+    with _lock:
+        m = dict(_metrics)
+    return {
+        "hits": m["hits"],
+        "misses": m["misses"],
+        "errors": m["errors"],
+        "skipped": m["skipped"],
+        "calls": m["calls"],
+        "latency_avg_ms": (m["latency_total"] / m["calls"] * 1000) if m["calls"] else 0.0,
+        "latency_max_ms": m["latency_max"] * 1000,
+        "breaker_open": time.monotonic() < _breaker_open_until,
+    }
@@ -1,9 +1,9 @@
 from datetime import datetime
 from enum import Enum
-from typing import List, Literal, Union
+from typing import FrozenSet, List, Literal, Tuple, Union
 
 from fastapi import Query
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 
 class UserRole(str,Enum):
@@ -47,6 +47,7 @@ class EventBase(BaseModel):
 
     target:UserRole
     ticket_stock:int
+    waiting_room:bool=False # 配布開始時に整理券の取得の前に順番待ちをさせる(app/waiting_room.py)
 class EventCreate(EventBase):
     starts_at:datetime
     ends_at:datetime
@@ -67,6 +68,15 @@ class EventDBOutput(EventDBInput):
     group_id:str#ULID
     class Config:
         orm_mode=True
+class EventImport(EventDBInput):
+    group_id:str#ULID
+class EventsDiff(BaseModel):
+    inserts:List[EventImport]
+    updates:List[EventDBOutput]
+    deletes:List[EventDBOutput]
+class EventImportMode(str,Enum):
+    diff="diff" # 既存の公演との差分を返すだけ
+    apply="apply" # 差分を反映する
 
 class GroupTagCreate(BaseModel):
     tag_id:str#ULID
@@ -118,15 +128,68 @@ class Ticket(TicketBase):
     id:str#ULID
     created_at:datetime
     status:Literal["active","cancelled","used","pending","reject","paper"] #https://github.com/hibiya-itchief/quaint-api/issues/91
+    token:Union[str,None]=None # 入口で確認するための署名付きトークン(app/ticket_token.py) 整理券の作成時のみ
 
     class Config:
         orm_mode=True
 
+class TicketTokenPayload(BaseModel):
+    ticket_id:str#ULID
+    event_id:str#ULID
+    person:int
+    not_before:datetime # この時刻から入場できる
+    not_after:datetime # この時刻まで入場できる
+
+class TicketTokenVerify(BaseModel):
+    token:str
+
+class TicketTokenVerifyResponse(BaseModel):
+    valid:bool
+    reason:Union[str,None]
+    payload:Union[TicketTokenPayload,None]
+
+class TicketScan(BaseModel):
+    token:str
+    scanned_at:datetime # 入口の端末でもぎった時刻
+
+class TicketScanResult(BaseModel):
+    token:str
+    ticket_id:Union[str,None]
+    result:Literal["used","already_used","unavailable","unknown","invalid_token","out_of_window"]
+
+class TicketRedeemResponse(BaseModel):
+    used:List[str] # 今回もぎった
+    already_used:List[str] # 既にもぎられていた
+    unavailable:List[str] # キャンセルされているなど
+    unknown:List[str] # 存在しない
+
 class TicketsNumberData(BaseModel):
     taken_tickets:int
     left_tickets:int
     stock:int
 
+class WaitingRoomTokenPayload(BaseModel):
+    event_id:str#ULID
+    queue_id:str#ULID
+    position:int # 並んだ順番(1から)
+    sell_starts:datetime
+    joined_at:datetime
+    user:str # ユーザーのidのハッシュ
+
+class WaitingRoomStatus(BaseModel):
+    token:str # 順番待ちのトークン 状態の確認と整理券の取得に使う Redisに接続できない時は空(並ばずに整理券を取得できる)
+    position:int # 並んだ順番(1から)
+    ahead:int # 前に並んでいて、まだ順番が来ていない人数
+    admitted:bool # 順番が来て整理券を取得できるか
+    estimated_wait:float # 順番が来るまでのおおよその秒数
+    poll_after:float # 次に状態を確認するまでの秒数
+
+class WaitingRoomQueue(BaseModel):
+    event_id:str#ULID
+    joined:int # 並んだ人数
+    admitted:int # 順番が来た人数
+    waiting:int # まだ順番が来ていない人数
+
 class JWTUser(BaseModel):
     aud:Union[str,None]
     iss:Union[str,None]
@@ -138,6 +201,7 @@ class JWTUser(BaseModel):
     name:Union[str,None]
     jobTitle:Union[str,None]
     groups:Union[List[str],None]
+    _roles:Union[Tuple[FrozenSet[Union[UserRole,str]],FrozenSet[str]],None]=PrivateAttr(default=None) # app/auth.pyで計算したロール
     
 
 class VoteBase(BaseModel):
@@ -169,6 +233,57 @@ class GAScreenPageViewResponse(BaseModel):
     page_path:str
     view:int
 
+class RedisMetricsResponse(BaseModel):
+    hits:int
+    misses:int
+    errors:int
+    skipped:int # サーキットブレーカーが開いていてRedisに問い合わせなかった回数
+    calls:int
+    latency_avg_ms:float
+    latency_max_ms:float
+    breaker_open:bool
+
+class JWTCacheMetricsResponse(BaseModel):
+    hits:int
+    misses:int
+    entries:int # キャッシュしているトークンの数
+    hit_rate:float
+
+class DBPoolMetrics(BaseModel):
+    pool_size:int
+    max_overflow:int
+    checked_out:int # 今貸し出し中のコネクション数
+    overflow:int # 今pool_sizeを超えて作っているコネクション数
+    checked_out_max:int
+    overflow_max:int
+    checkouts:int # プールから貸し出した回数
+    wait_avg_ms:float # get_db/get_async_dbがコネクションを取るまでに待った時間
+    wait_max_ms:float
+    wait_recent_ms:float # 待ち時間の指数移動平均 503を返すかの判定に使う
+    timeouts:int # DB_POOL_TIMEOUT秒待ってもコネクションを取れなかった回数
+    shed:int # プールが混み合っていて待たずに503を返した回数
+    shedding:bool # 今503を返しているか
+
+class DBReaderMetrics(BaseModel):
+    host:str
+    sync_engine:DBPoolMetrics
+    async_engine:DBPoolMetrics
+
+class DBMetricsResponse(BaseModel):
+    sync_engine:DBPoolMetrics # def のエンドポイント・バックグラウンドのスレッド
+    async_engine:DBPoolMetrics # async def のエンドポイント
+    readers:List[DBReaderMetrics] # 読み込み専用のレプリカ(DB_READER_HOSTS)
+
+class WaitingRoomMetricsResponse(BaseModel):
+    joins:int # 列に並んだ回数(並び直しを含む)
+    polls:int # 順番を確認した回数
+    rejected:int # 順番が来ていない・トークンが無効で整理券の取得を断った回数
+    passed:int # 順番が来たトークンで整理券の取得に進んだ回数
+    wait_avg_ms:float # 並んでから(配布開始前に並んだ人は配布開始から)整理券の取得に進むまでの時間
+    wait_max_ms:float
+    rate:float # 今1秒に通している人数(このworkerのDBの待ち時間から決める)
+    queues:List[WaitingRoomQueue] # 配布中・配布前の順番待ちの公演の列
+
 class HebeResponse(BaseModel):
     group_id:str #userdefined id
     class Config:
@@ -214,5 +329,6 @@ def EventDBOutput_fromEvent(e:Event):
         sell_starts=e.sell_starts.isoformat(),
         sell_ends=e.sell_ends.isoformat(),
         id=e.id,
-        group_id=e.group_id
+        group_id=e.group_id,
+        waiting_room=e.waiting_room
     )
@@ -0,0 +1,142 @@
+import asyncio
+import threading
+from typing import AsyncIterator, Awaitable, Callable, Dict, Set, Tuple, Union
+
+"""
+Server-Sent Eventsの配信で共通の部分(Hebe・お知らせ app/broadcast.py, 整理券の枚数 app/ticket_stream.py)
+
+- 接続(ブラウザ)ごとにSubscriptionを作り、配信するもの(話題・公演のid)ごとにHubに登録しておく
+- 配信するスレッドはHub.send()でメッセージを渡す 各接続のイベントループに渡され、送りきれていない古いものは捨てて最新のものだけを送る
+- stream()がtext/event-streamの本文を作る 前に送ったものと同じメッセージは送らず、何も送らない間は接続を保つためのコメントを送る
+"""
+
+HEARTBEAT_INTERVAL = 15  # 何も送らない時に、接続を保つためのコメントを送る間隔の秒数
+RETRY_MS = 3000  # 切れた時にブラウザが再接続するまでのミリ秒
+
+
+def message(event: str, data: str) -> str:
+    """`event: <event>` でdataを送るメッセージ"""
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+class LazyThread:
+    """最初に使われた時に1回だけ起動するデーモンスレッド"""
+
+    def __init__(self, target: Callable[[], None], name: str) -> None:
+        self.target = target
+        self.name = name
+        self._thread: Union[threading.Thread, None] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self.target, name=self.name, daemon=True
+            )
+            self._thread.start()
+
+
+class Subscription:
+    """1つの接続(ブラウザ)が受け取るメッセージ"""
+
+    def __init__(self, hub: "Hub", key: str) -> None:
+        self.hub = hub
+        self.key = key
+        self.loop = asyncio.get_running_loop()
+        # (メッセージ, 送った後に終了するか) 送りきれていない古いものは捨てて、最新のものだけを送る
+        self.queue: "asyncio.Queue[Tuple[str, bool]]" = asyncio.Queue(maxsize=1)
+
+    def offer(self, message: str, last: bool) -> None:
+        """イベントループのスレッドで呼ぶ"""
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait((message, last))
+
+
+class Hub:
+    """配信するもの(話題・公演のid)ごとの、このworkerの接続の一覧"""
+
+    def __init__(self, thread: LazyThread) -> None:
+        self.thread = thread  # メッセージを送るスレッド 最初の接続の時に起動する
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key: str) -> Subscription:
+        """イベントループ上で呼ぶ"""
+        subscription = Subscription(self, key)
+        with self._lock:
+            self._subscriptions.setdefault(key, set()).add(subscription)
+        self.thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.key)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if len(subscriptions) == 0:
+                del self._subscriptions[subscription.key]
+
+    def keys(self) -> Set[str]:
+        """接続がある(配信中の)もの"""
+        with self._lock:
+            return set(self._subscriptions)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._subscriptions
+
+    def connections(self) -> int:
+        """このworkerで配信中の接続の数"""
+        with self._lock:
+            return sum(len(s) for s in self._subscriptions.values())
+
+    def send(self, key: str, message: str, last: bool = False) -> None:
+        """keyを配信中の全ての接続にメッセージを渡す どのスレッドから呼んでもよい
+
+        lastがTrueなら、そのメッセージを送った後に接続を終了する
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(key, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(
+                    subscription.offer, message, last
+                )
+            except RuntimeError:
+                # イベントループが終了している
+                self.unsubscribe(subscription)
+
+
+async def stream(
+    subscription: Subscription, first: Callable[[], Awaitable[str]]
+) -> AsyncIterator[str]:
+    """text/event-streamの本文 接続が切れるとStreamingResponseがこのジェネレータを止める
+
+    Args:
+        subscription (Subscription): この接続
+        first (Callable[[], Awaitable[str]]): 接続した時に最初に送るメッセージを作るコルーチン関数
+    """
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        last = await first()
+        yield last
+        while True:
+            try:
+                message, done = await asyncio.wait_for(
+                    subscription.queue.get(), HEARTBEAT_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if done:
+                yield message
+                return
+            if message != last:
+                yield message
+                last = message
+    finally:
+        subscription.hub.unsubscribe(subscription)
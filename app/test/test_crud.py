@@ -1,8 +1,9 @@
 from datetime import datetime, timedelta, timezone
 
-from app import crud, schemas, models
+from app import crud, schemas, models, ticket_counters, ticket_stock
 from app.main import app
 from app.test import factories
+from app.test.utils.overrides import TestingSessionLocal
 
 from fastapi import HTTPException
 from fastapi.testclient import TestClient
@@ -256,6 +257,23 @@ def test_create_events_from_df(db):
     crud.create_group(db, group)
 
     assert crud.create_events_from_df(db, df) == None
+    assert len(crud.get_all_events(db, group.id)) == len(df)
+
+
+def test_create_events_from_df_invalid_row(db):
+    df = pd.read_csv(filepath_or_buffer="/workspace/csv/sample-sheet.csv")
+    df = pd.concat([df, df], ignore_index=True)
+    df.iat[1, 3] = "nobody"
+
+    group = factories.group3
+    crud.create_group(db, group)
+
+    # 途中の行が正しくなければ1件も追加しない
+    with pytest.raises(HTTPException) as e:
+        crud.create_events_from_df(db, df)
+    assert e.value.status_code == 422
+    assert "行番号 : 2, 列番号 : 4" in e.value.detail
+    assert crud.get_all_events(db, group.id) == []
 
 
 ### tickets
@@ -288,6 +306,90 @@ def test_use_ticket(db):
     assert crud.use_ticket(db, "aaaa") == None
 
 
+def test_ticket_counters(db):
+    crud.create_group(db, factories.group1)
+    event_create = schemas.EventCreate(
+        eventname="テスト公演",
+        target="everyone",
+        ticket_stock=20,
+        starts_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=2),
+        ends_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=3),
+        sell_starts=datetime.now(timezone(timedelta(hours=+9)))
+        + timedelta(minutes=-10),
+        sell_ends=datetime.now(timezone(timedelta(hours=+9))) + timedelta(minutes=10),
+    )
+    event = crud.get_event(db, crud.create_event(db, factories.group1.id, event_create).id)
+    user = schemas.JWTUser(**factories.valid_student_user)
+
+    ticket_1 = crud.create_ticket(db, event, user, 2)
+    ticket_2 = crud.create_ticket(db, event, user, 3)
+    assert crud.count_tickets_for_event(db, event) == 5
+
+    # 作成・もぎり・キャンセル・紙の整理券の追加と削除が同じトランザクションで集計に反映される
+    crud.use_tickets(db, [ticket_1.id])
+    crud.delete_ticket(db, ticket_2)
+    crud.chief_create_ticket(db, event, user, 1)
+    crud.chief_create_ticket(db, event, user, 1)
+    crud.chief_delete_ticket(db, event)
+    counter = ticket_counters.get(db, event.id)
+    assert (counter.taken, counter.used, counter.paper, counter.cancelled) == (2, 2, 1, 4)
+    assert crud.count_tickets_for_event(db, event) == 2
+
+    # 集計を通さずに追加された整理券はreconcileで反映される
+    db.add(
+        models.Ticket(
+            id=ulid.new().str,
+            group_id=event.group_id,
+            event_id=event.id,
+            owner_id=factories.valid_student_user["oid"],
+            person=1,
+            status="active",
+        )
+    )
+    db.commit()
+    assert [event_id for event_id, _, _ in ticket_counters.reconcile(db)] == [event.id]
+    assert crud.count_tickets_for_event(db, event) == 3
+
+
+
+def test_delete_ticket_twice(db, monkeypatch):
+    crud.create_group(db, factories.group1)
+    event = crud.create_event(db, factories.group1.id, factories.group1_event)
+    ticket = crud.create_ticket(
+        db, event, schemas.JWTUser(**factories.valid_student_user), 2
+    )
+    released = []
+    monkeypatch.setattr(
+        ticket_stock, "release", lambda event_id, person: released.append(person)
+    )
+
+    # 2つのリクエストがどちらもactiveな整理券を読んでから、同時にキャンセルする
+    other = TestingSessionLocal()
+    try:
+        stale = crud.get_ticket(other, ticket.id)
+        assert stale.status == "active"
+        crud.delete_ticket(db, crud.get_ticket(db, ticket.id))
+        crud.delete_ticket(other, stale)
+    finally:
+        other.close()
+
+    # 集計もRedisの残数も1回分しか戻らない
+    counter = ticket_counters.get(db, event.id)
+    assert (counter.taken, counter.cancelled) == (0, 2)
+    assert released == [2]
+
+
+def test_ticket_counters_get_does_not_commit(db):
+    crud.create_group(db, factories.group1)
+    event = crud.create_event(db, factories.group1.id, factories.group1_event)
+
+    # 集計の行が無い公演を読んでも、呼び出し側のまだcommitしていない変更はcommitされない
+    db.add(models.Group(**factories.group2.dict()))
+    assert ticket_counters.get(db, event.id).taken == 0
+    db.rollback()
+    assert crud.get_group_public(db, factories.group2.id) is None
+    assert ticket_counters.get(db, event.id).taken == 0
+
 def test_check_ticket_available(db):
     # 団体作成
     group1 = models.Group(**factories.group1.dict())
@@ -350,6 +452,21 @@ def test_check_ticket_available(db):
 
 
 ### votes
+def test_create_vote_twice(db):
+    crud.create_group(db, factories.group1)
+    user = schemas.JWTUser(**factories.valid_guest_user)
+
+    crud.create_vote(db, factories.group1.id, user)
+    # 同じ団体への2票目は(user_id, group_id)のユニーク制約で弾かれる
+    with pytest.raises(HTTPException) as e:
+        crud.create_vote(db, factories.group1.id, user)
+    assert e.value.status_code == 400
+    assert (
+        db.query(models.Vote).filter(models.Vote.group_id == factories.group1.id).count()
+        == 1
+    )
+
+
 def test_get_user_votable(db):
     group1 = models.Group(**factories.group1.dict())
     db.add(group1)
@@ -432,6 +549,10 @@ def test_get_user_votable(db):
         )
         == True
     )
+    # 全団体分をまとめて判定しても同じ結果になる
+    assert crud.get_user_votable_groups(
+        db, schemas.JWTUser(**factories.valid_student_user)
+    ) == sorted([group1.id, group2.id])
 
 
 def test_get_user_vote_count(db):
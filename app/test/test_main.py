@@ -1,14 +1,24 @@
 from datetime import datetime, timedelta, timezone
+import asyncio
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib import response
 import ulid
 
-from app import crud, schemas, models
+from app import broadcast, cache_keys, crud, schemas, models, ticket_stock, ticket_stream, waiting_room
+from app import db as appdb
+from app import cache
+from app.cache import LocalCache, get_or_compute, invalidate, local_cache
+from app.redis_possible import get_redis_if_possible, redis_get_if_possible
 from app.config import settings
+from app.db_pool import PoolMonitor
 from app.main import app
 from app.test import factories
+from app.test.utils.overrides import TEST_DATABASE_URI, TestingSessionLocal
 
-from fastapi import Depends
+import pytest
+from fastapi import Depends, HTTPException
 from fastapi.testclient import TestClient
 
 from sqlalchemy import create_engine
@@ -62,6 +72,43 @@ def test_users_me_ticket(db):
     assert response.status_code == 200
 
 
+# async def のエンドポイント(AsyncSession)からも、同期のSessionでcommitした整理券が見えることを確認する
+def test_users_me_tickets_active(db):
+    group1 = models.Group(**factories.group1.dict())
+    db.add(group1)
+    db.commit()
+    db.refresh(group1)
+    event = crud.create_event(db, group1.id, factories.group1_event)
+
+    ticket_ids = {}
+    for status in ["active", "cancelled"]:
+        ticket_ids[status] = ulid.new().str
+        db.add(
+            models.Ticket(
+                id=ticket_ids[status],
+                group_id=group1.id,
+                event_id=event.id,
+                owner_id=factories.valid_student_user["oid"],
+                person=1,
+                status=status,
+                created_at=datetime.now(timezone(timedelta(hours=+9))).isoformat(),
+            )
+        )
+    db.commit()
+
+    headers = factories.authheader(factories.valid_student_user)
+    response = client.get("/users/me/tickets", headers=headers)
+    assert response.status_code == 200
+    assert sorted(t["id"] for t in response.json()) == sorted(ticket_ids.values())
+
+    response = client.get("/users/me/tickets/active", headers=headers)
+    assert response.status_code == 200
+    assert [t["id"] for t in response.json()] == [ticket_ids["active"]]
+
+    response = client.get(f"/tickets/{ticket_ids['cancelled']}/available", headers=headers)
+    assert response.json() == False
+
+
 def test_get_is_parent_belong_to_correct():
     response = client.get(
         f"/users/me/family/belong/{factories.group1.id}",
@@ -159,6 +206,143 @@ def test_update_group(db):
     }
 
 
+def test_update_group_invalidates_cache(db):
+    crud.create_group(db, factories.group1)
+
+    # 一度取得してキャッシュさせる
+    response_before = client.get(f"/groups/{factories.group1.id}")
+    assert response_before.status_code == 200
+    assert response_before.json()["title"] != factories.valid_update_group["title"]
+
+    response_put = client.put(
+        f"/groups/{factories.group1.id}",
+        json=factories.valid_update_group,
+        headers=factories.authheader(factories.valid_admin_user),
+    )
+    assert response_put.status_code == 200
+
+    # 更新した内容がすぐに返ってくる
+    response_after = client.get(f"/groups/{factories.group1.id}")
+    assert response_after.status_code == 200
+    assert response_after.json()["title"] == factories.valid_update_group["title"]
+    response_all = client.get("/groups")
+    assert response_all.status_code == 200
+    assert [
+        g["title"] for g in response_all.json() if g["id"] == factories.group1.id
+    ] == [factories.valid_update_group["title"]]
+
+
+# レプリカを使う時は、削除した直後に反映前のレプリカから読んでキャッシュし直した値も後から削除されることを確認する
+def test_invalidate_again_after_reader_lag(monkeypatch):
+    monkeypatch.setattr(settings, "db_reader_hosts", "db-replica")
+    monkeypatch.setattr(settings, "db_reader_max_lag", 0.1)
+    key = cache_keys.group("test-reader-lag")
+
+    local_cache.set(key, "old", ttl=60)
+    invalidate(key)
+    assert local_cache.get(key) is None
+    local_cache.set(key, "old", ttl=60)  # 反映前のレプリカから読んだ値
+    time.sleep(0.5)
+    assert local_cache.get(key) is None
+
+
+def test_cache_single_flight():
+    key = cache_keys.group("test-single-flight-" + ulid.new().str)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.3)
+        return "value"
+
+    # キャッシュが無い時に同時に来ても、作り直すのは1回だけ
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: get_or_compute(key, compute), range(8)))
+    assert results == ["value"] * 8
+    assert len(calls) == 1
+
+
+def test_cache_stale_while_revalidate():
+    key = cache_keys.group("test-stale-" + ulid.new().str)
+    assert get_or_compute(key, lambda: "old", fresh_for=1, stale_for=60) == "old"
+    time.sleep(1.1)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.3)
+        return "new"
+
+    # 新しい期限を過ぎた値は、1つのリクエストだけが作り直し、他は待たずに古い値を返す
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(
+                lambda _: get_or_compute(key, compute, fresh_for=60, stale_for=60),
+                range(8),
+            )
+        )
+    assert len(calls) == 1
+    assert sorted(results) == ["new"] + ["old"] * 7
+    assert get_or_compute(key, compute) == "new"
+    assert len(calls) == 1
+
+
+def test_cache_invalidate_during_compute():
+    key = cache_keys.group("test-invalidate-during-compute-" + ulid.new().str)
+
+    def compute():
+        value = "old"  # DBから読んだ更新前の値
+        invalidate(key)  # 読んだ後に他のリクエストがDBを更新した
+        return value
+
+    # 作り直している間にinvalidate()されたら、作った値は返すが保存しない
+    assert get_or_compute(key, compute) == "old"
+    assert redis_get_if_possible(key) is None
+    assert get_or_compute(key, lambda: "new") == "new"
+
+
+def test_local_cache():
+    # max_entriesを超えたら、一番使われていないものから捨てる
+    lru = LocalCache(max_entries=2, ttl=60)
+    lru.set("a", "1")
+    lru.set("b", "2")
+    assert lru.get("a") == "1"  # aを使ったので、次に捨てられるのはb
+    lru.set("c", "3")
+    assert lru.get("b") is None
+    assert (lru.get("a"), lru.get("c")) == ("1", "3")
+    assert len(lru) == 2
+
+    # ttl秒を過ぎたら期限切れ
+    lru.set("short", "4", ttl=0.1)
+    time.sleep(0.2)
+    assert lru.get("short") is None
+
+
+def test_local_cache_invalidate(monkeypatch):
+    monkeypatch.setattr(local_cache, "ttl", 60)
+    key = cache_keys.group("test-local-invalidate-" + ulid.new().str)
+
+    # このworkerでinvalidate()したら、プロセス内のキャッシュからも消える
+    local_cache.set(key, "old")
+    invalidate(key)
+    assert local_cache.get(key) is None
+
+    # 他のworker・ノードがinvalidate()した時は、pub/subで通知を受け取って消す
+    cache.start_invalidation_listener()
+    conn = get_redis_if_possible()
+    deadline = time.monotonic() + 5
+    while conn.pubsub_numsub(cache.INVALIDATE_CHANNEL)[0][1] == 0:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    time.sleep(0.1)  # 購読を始めた直後のプロセス内のキャッシュの全削除を待つ
+    local_cache.set(key, "old")
+    conn.publish(cache.INVALIDATE_CHANNEL, json.dumps([key]))
+    deadline = time.monotonic() + 5
+    while local_cache.get(key) is not None:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
 def test_delete_group(db):
     crud.create_group(db, factories.group1)
     response = client.delete(
@@ -318,6 +502,74 @@ def test_count_tickets(db):
     assert response.json() == {"taken_tickets": 2, "left_tickets": 18, "stock": 20}
 
 
+def test_get_event(db):
+    crud.create_group(db, factories.group1)
+    crud.create_group(db, factories.group2)
+    event_create = schemas.EventCreate(
+        eventname="テスト公演",
+        target="everyone",
+        ticket_stock=20,
+        starts_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=2),
+        ends_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=3),
+        sell_starts=datetime.now(timezone(timedelta(hours=+9)))
+        + timedelta(minutes=-10),
+        sell_ends=datetime.now(timezone(timedelta(hours=+9))) + timedelta(minutes=10),
+    )
+    event = crud.create_event(db, factories.group1.id, event_create)
+
+    response = client.get(f"/groups/{factories.group1.id}/events/{event.id}")
+    assert response.status_code == 200
+    assert response.json()["eventname"] == "テスト公演"
+
+    # 他のGroupのEventとしては取得できない
+    response_404 = client.get(f"/groups/{factories.group2.id}/events/{event.id}")
+    assert response_404.status_code == 404
+
+    # 削除した後は取得できない
+    crud.delete_events(db, event)
+    response_deleted = client.get(f"/groups/{factories.group1.id}/events/{event.id}")
+    assert response_deleted.status_code == 404
+
+
+def test_get_events_on_sale(db):
+    crud.create_group(db, factories.group1)
+    now = datetime.now(timezone(timedelta(hours=+9)))
+    on_sale = crud.create_event(
+        db,
+        factories.group1.id,
+        schemas.EventCreate(
+            eventname="配布中の公演",
+            target="everyone",
+            ticket_stock=20,
+            starts_at=now + timedelta(hours=1),
+            ends_at=now + timedelta(hours=2),
+            # UTCで指定しても日本時間として保存される
+            sell_starts=(now + timedelta(minutes=-10)).astimezone(timezone.utc),
+            sell_ends=now + timedelta(minutes=10),
+        ),
+    )
+    crud.create_event(
+        db,
+        factories.group1.id,
+        schemas.EventCreate(
+            eventname="配布前の公演",
+            target="everyone",
+            ticket_stock=20,
+            starts_at=now + timedelta(days=2),
+            ends_at=now + timedelta(days=2, hours=1),
+            sell_starts=now + timedelta(days=1),
+            sell_ends=now + timedelta(days=2),
+        ),
+    )
+
+    response = client.get("/events/on_sale")
+    assert response.status_code == 200
+    assert [e["id"] for e in response.json()] == [on_sale.id]
+    assert datetime.fromisoformat(response.json()[0]["sell_starts"]) == (
+        now + timedelta(minutes=-10)
+    ).replace(microsecond=0)
+
+
 def test_get_all_active_tickets_of_event(db):
     # 団体作成
     group1 = models.Group(**factories.group1.dict())
@@ -484,6 +736,58 @@ def test_create_ticket_admin(db):
     assert response_3.status_code == 404
 
 
+# キャンセルした整理券の分は再び取得できる
+def test_create_ticket_after_cancel(db):
+    # 団体作成
+    group1 = models.Group(**factories.group1.dict())
+    db.add(group1)
+    db.commit()
+    db.refresh(group1)
+
+    # 公演作成
+    event_create = schemas.EventCreate(
+        eventname="テスト公演",
+        target="everyone",
+        ticket_stock=1,
+        starts_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=2),
+        ends_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=3),
+        sell_starts=datetime.now(timezone(timedelta(hours=+9)))
+        + timedelta(days=+1, hours=+0),
+        sell_ends=datetime.now(timezone(timedelta(hours=+9)))
+        + timedelta(days=+1, hours=+1),
+    )
+    event = crud.create_event(db, group1.id, event_create)
+
+    response_1 = client.post(
+        f"/groups/{group1.id}/events/{event.id}/tickets/admin",
+        params={"person": 1},
+        headers=factories.authheader(factories.valid_admin_user),
+    )
+    assert response_1.status_code == 200
+    response_2 = client.post(
+        f"/groups/{group1.id}/events/{event.id}/tickets/admin",
+        params={"person": 1},
+        headers=factories.authheader(factories.valid_admin_user),
+    )
+    assert response_2.status_code == 404
+
+    response_3 = client.delete(
+        f"/groups/{group1.id}/events/{event.id}/tickets/{response_1.json()['id']}",
+        headers=factories.authheader(factories.valid_admin_user),
+    )
+    assert response_3.status_code == 200
+
+    response_4 = client.post(
+        f"/groups/{group1.id}/events/{event.id}/tickets/admin",
+        params={"person": 1},
+        headers=factories.authheader(factories.valid_admin_user),
+    )
+    assert response_4.status_code == 200
+
+    response_5 = client.get(f"/groups/{group1.id}/events/{event.id}/tickets")
+    assert response_5.json() == {"taken_tickets": 1, "left_tickets": 0, "stock": 1}
+
+
 def test_create_family_ticket(db):
     # 環境変数書き換え
     # テスト実行後に変数は元の値に戻してくれるみたい
@@ -755,6 +1059,166 @@ def test_change_ticket_used(db):
     assert response_3.status_code == 404
 
 
+def test_redeem_tickets(db):
+    # 団体作成
+    group1 = models.Group(**factories.group1.dict())
+    db.add(group1)
+    db.commit()
+    db.refresh(group1)
+
+    # 公演作成
+    event_create = schemas.EventCreate(
+        eventname="テスト公演",
+        target="everyone",
+        ticket_stock=20,
+        starts_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=2),
+        ends_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=3),
+        sell_starts=datetime.now(timezone(timedelta(hours=+9)))
+        + timedelta(minutes=-10),
+        sell_ends=datetime.now(timezone(timedelta(hours=+9))) + timedelta(minutes=10),
+    )
+    event = crud.create_event(db, group1.id, event_create)
+
+    # active, cancelled, usedのチケットを作成
+    tickets = []
+    for status in ["active", "cancelled", "used"]:
+        ticket = models.Ticket(
+            id=ulid.new().str,
+            group_id=group1.id,
+            event_id=event.id,
+            owner_id=factories.valid_student_user["oid"],
+            person=1,
+            status=status,
+            is_family_ticket=False,
+            created_at=datetime.now(timezone(timedelta(hours=+9))).isoformat(),
+        )
+        db.add(ticket)
+        db.commit()
+        db.refresh(ticket)
+        tickets.append(ticket)
+    unknown_id = ulid.new().str
+
+    response_1 = client.put(
+        "/tickets/redeem",
+        json=[t.id for t in tickets] + [unknown_id],
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert response_1.status_code == 200
+    assert response_1.json() == {
+        "used": [tickets[0].id],
+        "already_used": [tickets[2].id],
+        "unavailable": [tickets[1].id],
+        "unknown": [unknown_id],
+    }
+
+    # 2回目は既にもぎられている
+    response_2 = client.put(
+        "/tickets/redeem",
+        json=[tickets[0].id],
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert response_2.json() == {
+        "used": [],
+        "already_used": [tickets[0].id],
+        "unavailable": [],
+        "unknown": [],
+    }
+
+
+def test_ticket_token(db):
+    # 団体作成
+    group1 = models.Group(**factories.group1.dict())
+    db.add(group1)
+    db.commit()
+    db.refresh(group1)
+
+    # 公演作成 (開始30分前なので入場できる時間帯)
+    event_create = schemas.EventCreate(
+        eventname="テスト公演",
+        target="everyone",
+        ticket_stock=20,
+        starts_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(minutes=30),
+        ends_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(hours=2),
+        sell_starts=datetime.now(timezone(timedelta(hours=+9)))
+        + timedelta(minutes=-10),
+        sell_ends=datetime.now(timezone(timedelta(hours=+9))) + timedelta(minutes=10),
+    )
+    event = crud.create_event(db, group1.id, event_create)
+
+    res_ticket = client.post(
+        f"/groups/{group1.id}/events/{event.id}/tickets/admin",
+        params={"person": 2},
+        headers=factories.authheader(factories.valid_admin_user),
+    )
+    assert res_ticket.status_code == 200
+    ticket_id = res_ticket.json()["id"]
+    token = res_ticket.json()["token"]
+    assert token
+
+    # 所有者はトークンを取り直せる
+    res_token = client.get(
+        f"/tickets/{ticket_id}/token",
+        headers=factories.authheader(factories.valid_admin_user),
+    )
+    assert res_token.json() == token
+    res_token_404 = client.get(
+        f"/tickets/{ticket_id}/token",
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert res_token_404.status_code == 404
+
+    res_verify = client.post(
+        "/tickets/verify",
+        json={"token": token},
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert res_verify.status_code == 200
+    assert res_verify.json()["valid"] == True
+    assert res_verify.json()["payload"]["ticket_id"] == ticket_id
+    assert res_verify.json()["payload"]["person"] == 2
+
+    # 署名を改ざんしたトークン
+    res_verify_invalid = client.post(
+        "/tickets/verify",
+        json={"token": token[:-1] + ("A" if token[-1] != "A" else "B")},
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert res_verify_invalid.json()["valid"] == False
+
+    # もぎった記録をまとめて送る 同じ記録を何度送っても2回もぎられることはない
+    scanned_at = datetime.now(timezone(timedelta(hours=+9))).isoformat()
+    scans = [
+        {"token": token, "scanned_at": scanned_at},
+        {"token": token, "scanned_at": scanned_at},
+        {"token": "invalid", "scanned_at": scanned_at},
+    ]
+    res_scans = client.post(
+        "/tickets/scans",
+        json=scans,
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert res_scans.status_code == 200
+    assert [r["result"] for r in res_scans.json()] == [
+        "used",
+        "already_used",
+        "invalid_token",
+    ]
+    res_scans_again = client.post(
+        "/tickets/scans",
+        json=scans[:1],
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert [r["result"] for r in res_scans_again.json()] == ["already_used"]
+    assert crud.get_ticket(db, ticket_id).status == "used"
+
+    res_verify_used = client.post(
+        "/tickets/verify",
+        json={"token": token},
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert res_verify_used.json()["valid"] == False
+
+
 def test_check_ticket_available(db):
     # 団体作成
     group1 = models.Group(**factories.group1.dict())
@@ -1133,6 +1597,87 @@ def test_get_user_votable(db):
     assert response_2.json() == False
 
 
+def test_get_votes_ranking(db):
+    crud.create_group(db, factories.group1)
+    crud.create_group(db, factories.group2)
+    db.add_all(
+        [
+            models.Vote(id=ulid.new().str, group_id=factories.group2.id, user_id="a"),
+            models.Vote(id=ulid.new().str, group_id=factories.group2.id, user_id="b"),
+            models.Vote(id=ulid.new().str, group_id=factories.group1.id, user_id="a"),
+        ]
+    )
+    db.commit()
+
+    response = client.get(
+        "/votes/ranking", headers=factories.authheader(factories.valid_admin_user)
+    )
+    assert response.status_code == 200
+    assert response.json() == [
+        {"group_id": factories.group2.id, "votes_num": 2},
+        {"group_id": factories.group1.id, "votes_num": 1},
+    ]
+
+    response_401 = client.get(
+        "/votes/ranking", headers=factories.authheader(factories.valid_student_user)
+    )
+    assert response_401.status_code == 401
+
+
+def test_get_user_votable_groups(db):
+    crud.create_group(db, factories.group1)
+    crud.create_group(db, factories.group2)
+    now = datetime.now(timezone(timedelta(hours=+9)))
+    for group, ends_at in [
+        (factories.group1, now + timedelta(minutes=-10)),
+        (factories.group2, now + timedelta(minutes=10)),  # まだ終わっていない
+    ]:
+        event = crud.create_event(
+            db,
+            group.id,
+            schemas.EventCreate(
+                eventname="テスト公演",
+                target="everyone",
+                ticket_stock=20,
+                starts_at=ends_at + timedelta(hours=-1),
+                ends_at=ends_at,
+                sell_starts=now + timedelta(hours=-3),
+                sell_ends=now + timedelta(hours=-2),
+            ),
+        )
+        db.add(
+            models.Ticket(
+                id=ulid.new().str,
+                group_id=group.id,
+                event_id=event.id,
+                owner_id=factories.valid_guest_user["oid"],
+                person=1,
+                status="used",
+            )
+        )
+    db.commit()
+
+    response_1 = client.get(
+        "/users/me/votable_groups",
+        headers=factories.authheader(factories.valid_guest_user),
+    )
+    assert response_1.status_code == 200
+    assert response_1.json() == [factories.group1.id]
+
+    # 投票した団体は含まれなくなる
+    response_vote = client.post(
+        url="/votes",
+        params={"group_id": factories.group1.id},
+        headers=factories.authheader(factories.valid_guest_user),
+    )
+    assert response_vote.status_code == 200
+    response_2 = client.get(
+        "/users/me/votable_groups",
+        headers=factories.authheader(factories.valid_guest_user),
+    )
+    assert response_2.json() == []
+
+
 # userの投票情報を取得
 def test_get_user_votes(db):
     group1 = models.Group(**factories.group1.dict())
@@ -1179,4 +1724,410 @@ def test_create_news(db):
     assert response_2.status_code == 200
 
 
+### admin
+def test_get_redis_metrics():
+    response_1 = client.get(
+        "/admin/metrics/redis", headers=factories.authheader(factories.valid_admin_user)
+    )
+    assert response_1.status_code == 200
+    assert "hits" in response_1.json()
+
+    response_2 = client.get(
+        "/admin/metrics/redis",
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert response_2.status_code == 403
+
+
+def test_get_db_metrics():
+    response = client.get(
+        "/admin/metrics/db", headers=factories.authheader(factories.valid_admin_user)
+    )
+    assert response.status_code == 200
+    assert "checked_out" in response.json()["sync_engine"]
+    assert "wait_recent_ms" in response.json()["async_engine"]
+    assert response.json()["readers"] == []  # テストではレプリカを使わない
+
+
+# コネクションを長く待っていて、プールが全て貸し出し中の間だけ503を返すことを確認する
+def test_db_pool_shedding():
+    engine = create_engine(TEST_DATABASE_URI, pool_size=1, max_overflow=0)
+    monitor = PoolMonitor(engine, max_overflow=0)
+    conn = engine.connect()
+    monitor.record_wait(settings.db_shed_wait_threshold * 10)
+    with pytest.raises(HTTPException) as e:
+        monitor.shed_if_overloaded()
+    assert e.value.status_code == 503
+    assert e.value.headers["Retry-After"] == str(settings.db_shed_retry_after)
+
+    conn.close()
+    monitor.shed_if_overloaded()  # プールが空いたら待ち時間が長くても断らない
+    metrics = monitor.metrics()
+    assert metrics["checkouts"] == 1
+    assert metrics["checked_out_max"] == 1
+    assert metrics["shed"] == 1
+    engine.dispose()
+
+
 # もっと細かく書けるかも(https://nmomos.com/tips/2021/03/07/fastapi-docker-8/#toc_id_2)
+
+
+def test_create_all_events_from_csv(db):
+    crud.create_group(db, factories.group3)
+    header = "group_id,eventname,lottery,target,ticket_stock,year,month,day,starts_at,ends_at,sell_starts,sell_ends\n"
+    row = "test_1,テストイベント,FALSE,everyone,50,2024,9,16,9:30:00,10:30:00,8:30:00,9:00:00\n"
+    rows = crud.CSV_CHUNK_ROWS * 2 + 1  # 複数回に分けて読まれる
+
+    response = client.post(
+        "/support/events",
+        headers=factories.authheader(factories.valid_chief_user),
+        files={"file": ("sheet.csv", (header + row * rows).encode("utf-8"))},
+    )
+    assert response.status_code == 200
+    assert len(response.json()["message"]) == rows
+    assert len(crud.get_all_events(db, "test_1")) == rows
+
+    # 後ろの方の行が間違っていたら、ファイル全体での行番号を返して1件も追加しない
+    bad_row = "test_1,テストイベント,FALSE,everyone,50,2024,9,16,9:30,10:30:00,8:30:00,9:00:00\n"
+    response = client.post(
+        "/support/events",
+        headers=factories.authheader(factories.valid_chief_user),
+        files={
+            "file": ("sheet.csv", (header + row * (rows - 1) + bad_row).encode("utf-8"))
+        },
+    )
+    assert response.status_code == 422
+    assert f"行番号 : {rows}" in response.json()["detail"]
+    assert len(crud.get_all_events(db, "test_1")) == rows
+
+
+def test_create_all_events_from_csv_diff_and_apply(db):
+    crud.create_group(db, factories.group3)
+    header = "group_id,eventname,lottery,target,ticket_stock,year,month,day,starts_at,ends_at,sell_starts,sell_ends\n"
+    first = "test_1,公演1,FALSE,everyone,50,2024,9,16,9:30:00,10:30:00,8:30:00,9:00:00\n"
+    second = "test_1,公演2,FALSE,everyone,50,2024,9,16,12:30:00,13:30:00,11:30:00,12:00:00\n"
+    third = "test_1,公演3,FALSE,everyone,50,2024,9,16,15:30:00,16:30:00,14:30:00,15:00:00\n"
+
+    def upload(sheet: str, mode: str = ""):
+        return client.post(
+            "/support/events" + mode,
+            headers=factories.authheader(factories.valid_chief_user),
+            files={"file": ("sheet.csv", (header + sheet).encode("utf-8"))},
+        )
+
+    # 同じシートを2回追加してしまった
+    assert upload(first + second).status_code == 200
+    assert upload(first + second).status_code == 200
+    assert len(crud.get_all_events(db, "test_1")) == 4
+
+    # 公演2の人数を変えて、公演3を追加する
+    sheet = first + second.replace(",50,", ",80,") + third
+    response = upload(sheet, "?mode=diff")
+    assert response.status_code == 200
+    diff = response.json()
+    assert [e["eventname"] for e in diff["inserts"]] == ["公演3"]
+    assert [(e["eventname"], e["ticket_stock"]) for e in diff["updates"]] == [
+        ("公演2", 80)
+    ]
+    assert sorted(e["eventname"] for e in diff["deletes"]) == ["公演1", "公演2"]  # 重複
+    assert len(crud.get_all_events(db, "test_1")) == 4  # diffではDBを変更しない
+
+    assert upload(sheet, "?mode=apply").status_code == 200
+    db.expire_all()
+    events = crud.get_all_events(db, "test_1")
+    assert sorted((e.eventname, e.ticket_stock) for e in events) == [
+        ("公演1", 50),
+        ("公演2", 80),
+        ("公演3", 50),
+    ]
+    diff = upload(sheet, "?mode=diff").json()
+    assert diff == {"inserts": [], "updates": [], "deletes": []}
+
+
+def test_create_all_events_from_csv_apply_keeps_waiting_room(db):
+    crud.create_group(db, factories.group3)
+    header = "group_id,eventname,lottery,target,ticket_stock,year,month,day,starts_at,ends_at,sell_starts,sell_ends\n"
+    first = "test_1,公演1,FALSE,everyone,50,2024,9,16,9:30:00,10:30:00,8:30:00,9:00:00\n"
+
+    def upload(sheet: str, mode: str = ""):
+        return client.post(
+            "/support/events" + mode,
+            headers=factories.authheader(factories.valid_chief_user),
+            files={"file": ("sheet.csv", (header + sheet).encode("utf-8"))},
+        )
+
+    assert upload(first).status_code == 200
+    db.query(models.Event).update({models.Event.waiting_room: True})
+    db.commit()
+
+    # シートに無い列は、人数を変えても元のまま
+    assert upload(first.replace(",50,", ",80,"), "?mode=apply").status_code == 200
+    db.expire_all()
+    [event] = crud.get_all_events(db, "test_1")
+    assert event.ticket_stock == 80
+    assert event.waiting_room == True
+
+
+def test_create_all_events_from_csv_apply_rejects_stock_below_taken(db):
+    crud.create_group(db, factories.group3)
+    header = "group_id,eventname,lottery,target,ticket_stock,year,month,day,starts_at,ends_at,sell_starts,sell_ends\n"
+    first = "test_1,公演1,FALSE,everyone,50,2024,9,16,9:30:00,10:30:00,8:30:00,9:00:00\n"
+
+    def upload(sheet: str, mode: str = ""):
+        return client.post(
+            "/support/events" + mode,
+            headers=factories.authheader(factories.valid_chief_user),
+            files={"file": ("sheet.csv", (header + sheet).encode("utf-8"))},
+        )
+
+    assert upload(first).status_code == 200
+    [event] = crud.get_all_events(db, "test_1")
+    user = schemas.JWTUser(**factories.valid_student_user)
+    crud.create_ticket(db, event, user, 3)
+
+    # 取得済みの3人より少なくはできず、何も変わらない
+    response = upload(first.replace(",50,", ",2,"), "?mode=apply")
+    assert response.status_code == 400
+    assert event.id in response.json()["detail"]
+    db.expire_all()
+    assert crud.get_all_events(db, "test_1")[0].ticket_stock == 50
+
+    # 取得済みの人数ちょうどまでは減らせる
+    assert upload(first.replace(",50,", ",3,"), "?mode=apply").status_code == 200
+    db.expire_all()
+    assert crud.get_all_events(db, "test_1")[0].ticket_stock == 3
+
+
+def test_stream_tickets(db, monkeypatch):
+    # 配信のスレッドはテスト用のDBから数え、通知が無くてもすぐに数え直すようにする
+    monkeypatch.setattr(ticket_stream, "SessionLocal", TestingSessionLocal)
+    monkeypatch.setattr(settings, "ticket_stream_interval", 0.1)
+    monkeypatch.setattr(settings, "ticket_stream_refresh", 0.2)
+
+    group1 = models.Group(**factories.group1.dict())
+    db.add(group1)
+    db.commit()
+    event_create = schemas.EventCreate(
+        eventname="テスト公演",
+        target="everyone",
+        ticket_stock=20,
+        starts_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=2),
+        ends_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=3),
+        sell_starts=datetime.now(timezone(timedelta(hours=+9)))
+        + timedelta(minutes=-10),
+        sell_ends=datetime.now(timezone(timedelta(hours=+9))) + timedelta(minutes=10),
+    )
+    event = crud.create_event(db, group1.id, event_create)
+
+    response = client.get(
+        f"/groups/{group1.id}/events/{ulid.new().str}/tickets/stream"
+    )
+    assert response.status_code == 404
+
+    async def watch():
+        subscription = ticket_stream.subscribe(event.id)
+        body = ticket_stream.stream(subscription, ticket_stream.snapshot(db, event.id))
+        assert await body.__anext__() == "retry: 3000\n\n"
+        assert '"left_tickets": 20' in await body.__anext__()
+
+        # 続けて取られた整理券の枚数が送られてくる
+        student = schemas.JWTUser(**factories.valid_student_user)
+        for person in [2, 3]:
+            assert ticket_stock.reserve(db, event, person)
+            crud.create_ticket(db, event, student, person)
+        while True:
+            message = await asyncio.wait_for(body.__anext__(), 5)
+            if message.startswith(":"):
+                continue
+            if '"left_tickets": 15' in message:
+                break
+
+        await body.aclose()
+        assert ticket_stream.connections() == 0
+
+    asyncio.run(watch())
+
+
+
+def test_ticket_stock_unavailable(db, monkeypatch):
+    group1 = models.Group(**factories.group1.dict())
+    db.add(group1)
+    db.commit()
+    event = crud.create_event(db, group1.id, factories.group1_event)
+    assert ticket_stock.reserve(db, event, 1)
+    assert ticket_stock.left(db, event) == 19
+
+    # Redisに接続できない間はDBで判定せずに503を返し、戻した人数は覚えておく
+    with monkeypatch.context() as m:
+        m.setattr(ticket_stock, "get_redis_if_possible", lambda: None)
+        with pytest.raises(HTTPException) as e:
+            ticket_stock.reserve(db, event, 1)
+        assert e.value.status_code == 503
+        ticket_stock.release(event.id, 2)
+        assert ticket_stock._pending == {event.id: 2}
+
+    # 次にRedisに接続できた時に、残数のキーを削除せずに戻した人数を足す
+    assert ticket_stock.reserve(db, event, 1)
+    assert ticket_stock._pending == {}
+    assert ticket_stock.left(db, event) == 20
+
+
+### Hebe・お知らせ
+def test_hebe(db):
+    crud.create_group(db, factories.group3)
+    assert client.get("/hebe/nowplaying").json() == {"group_id": ""}
+
+    response = client.post(
+        "/hebe/nowplaying",
+        json={"group_id": factories.group3.id},
+        headers=factories.authheader(factories.valid_chief_user),
+    )
+    assert response.status_code == 200
+    assert client.get("/hebe/nowplaying").json() == {"group_id": factories.group3.id}
+    assert client.get("/hebe/upnext").json() == {"group_id": ""}
+
+
+def test_news_snapshot(db):
+    client.post(
+        "/news/create",
+        json={"title": "chief", "author": "chief", "detail": "チーフ会"},
+        headers=factories.authheader(factories.valid_chief_user),
+    )
+    news_id = client.get("/news").json()[0]["id"]
+    assert client.get(f"/news/{news_id}").json()["title"] == "chief"
+
+    client.delete(
+        f"/news/{news_id}", headers=factories.authheader(factories.valid_chief_user)
+    )
+    assert client.get("/news").json() == []
+    assert client.get(f"/news/{news_id}").status_code == 404
+
+
+def test_stream_hebe(db):
+    crud.create_group(db, factories.group3)
+
+    async def watch():
+        subscription = broadcast.subscribe("hebe")
+        body = broadcast.stream(subscription)
+        assert await body.__anext__() == "retry: 3000\n\n"
+        assert '"nowplaying": {"group_id": ""}' in await body.__anext__()
+
+        # 変更したworkerでは、commitした直後に送られる
+        crud.set_hebe_nowplaying(db, schemas.HebeResponse(group_id=factories.group3.id))
+        message = await asyncio.wait_for(body.__anext__(), 5)
+        assert message.startswith("event: hebe\n")
+        assert f'"nowplaying": {{"group_id": "{factories.group3.id}"}}' in message
+
+        await body.aclose()
+        assert broadcast.connections() == 0
+
+    asyncio.run(watch())
+
+
+def test_waiting_room(db, monkeypatch):
+    # 団体作成
+    group1 = models.Group(**factories.group1.dict())
+    db.add(group1)
+    db.commit()
+    db.refresh(group1)
+
+    # 順番待ちをする公演を作成
+    event_create = schemas.EventCreate(
+        eventname="テスト公演",
+        target="everyone",
+        ticket_stock=20,
+        waiting_room=True,
+        starts_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=2),
+        ends_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=3),
+        sell_starts=datetime.now(timezone(timedelta(hours=+9)))
+        + timedelta(minutes=-10),
+        sell_ends=datetime.now(timezone(timedelta(hours=+9))) + timedelta(minutes=10),
+    )
+    event = crud.create_event(db, group1.id, event_create)
+    url = f"/groups/{group1.id}/events/{event.id}"
+
+    # 他の人のトークン・改ざんしたトークンでは整理券を取得できない
+    token = waiting_room._issue(event, ulid.new().str, 1, "someone-else")
+    assert waiting_room.decode(token).position == 1
+    assert waiting_room.decode(token[:-1] + ("A" if token[-1] != "A" else "B")) is None
+    res_other = client.post(
+        f"{url}/tickets",
+        params={"person": 1, "waiting_room_token": token},
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert res_other.status_code == 403
+    assert client.get(f"{url}/waiting_room", params={"token": "invalid"}).status_code == 400
+
+    # Redisに接続できない時は並ばずに通す
+    monkeypatch.setattr(waiting_room, "get_redis_if_possible", lambda: None)
+    res_join = client.post(
+        f"{url}/waiting_room",
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert res_join.status_code == 200
+    assert res_join.json()["admitted"] == True
+    assert res_join.json()["token"] == ""
+    res_ticket = client.post(
+        f"{url}/tickets",
+        params={"person": 1},
+        headers=factories.authheader(factories.valid_student_user),
+    )
+    assert res_ticket.status_code == 200
+
+    # DBのコネクションを待った時間が長いほど通す人数を減らす
+    monkeypatch.setattr(settings, "waiting_room_rate", 20)
+    monkeypatch.setattr(settings, "waiting_room_min_rate", 2)
+    monkeypatch.setattr(settings, "waiting_room_target_wait", 0.05)
+    monkeypatch.setattr(appdb.sync_pool, "wait_recent", 0.0)
+    assert waiting_room.admission_rate() == 20
+    monkeypatch.setattr(appdb.sync_pool, "wait_recent", 0.1)
+    assert waiting_room.admission_rate() == 10
+    monkeypatch.setattr(appdb.sync_pool, "wait_recent", 10)
+    assert waiting_room.admission_rate() == 2
+
+    res_metrics = client.get(
+        "/admin/metrics/waiting_room",
+        headers=factories.authheader(factories.valid_admin_user),
+    )
+    assert res_metrics.status_code == 200
+    assert res_metrics.json()["rejected"] >= 1
+
+
+def test_waiting_room_rejects_before_db(db):
+    group1 = models.Group(**factories.group1.dict())
+    db.add(group1)
+    db.commit()
+    event_create = schemas.EventCreate(
+        eventname="テスト公演",
+        target="everyone",
+        ticket_stock=20,
+        waiting_room=True,
+        starts_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=2),
+        ends_at=datetime.now(timezone(timedelta(hours=+9))) + timedelta(days=3),
+        sell_starts=datetime.now(timezone(timedelta(hours=+9)))
+        + timedelta(minutes=-10),
+        sell_ends=datetime.now(timezone(timedelta(hours=+9))) + timedelta(minutes=10),
+    )
+    event = crud.create_event(db, group1.id, event_create)
+    url = f"/groups/{group1.id}/events/{event.id}"
+    assert client.get(url).json()["waiting_room"] == True  # 公演がキャッシュされる
+
+    # 順番待ちのトークンが無いリクエストは、DBのコネクションを取る前に断る
+    checkouts = []
+    get_db = app.dependency_overrides[appdb.get_db]
+
+    def counting_get_db():
+        checkouts.append(1)
+        yield from get_db()
+
+    app.dependency_overrides[appdb.get_db] = counting_get_db
+    try:
+        response = client.post(
+            f"{url}/tickets",
+            params={"person": 1},
+            headers=factories.authheader(factories.valid_student_user),
+        )
+    finally:
+        app.dependency_overrides[appdb.get_db] = get_db
+    assert response.status_code == 403
+    assert checkouts == []
@@ -2,12 +2,16 @@ import json
 
 from fastapi import Header
 
+from app import broadcast
 from app.auth import verify_jwt
+from app.cache import local_cache
 from app.config import settings
-from app.db import get_db
+from app.db import get_async_db, get_async_reader_db, get_db, get_reader_db
 from app.main import app
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from typing import Any, Dict
 
 ### DBのオーバーライド
@@ -38,10 +42,41 @@ def override_get_db():
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_reader_db] = override_get_db # テストではレプリカを使わない
+
+# async def のエンドポイント用
+# TestClientはリクエストごとに別のイベントループで実行するので、前のループで作ったコネクションを使い回さないようにプールしない
+TEST_ASYNC_DATABASE_URI = "mysql+aiomysql://"+ settings.mysql_user +":"+ settings.mysql_password +"@"+ settings.db_host +"/quaint-app-test"
+
+async_engine = create_async_engine(TEST_ASYNC_DATABASE_URI, poolclass=NullPool)
+TestingAsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False)
+
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+app.dependency_overrides[get_async_db] = override_get_async_db
+app.dependency_overrides[get_async_reader_db] = override_get_async_db
 
 ### テストの時はJWTの検証をバイパス
 # JWTのpayloadを「署名無し・(Base64エンコードではなく)JSON文字列形式」でAuthorizationヘッダーに指定する。
 # 単にヘッダーで指定されたJSONをDictにして返す
 def override_verify_jwt(authorization=Header(default=None))->Dict[str,Any]:
     return json.loads(authorization)
-app.dependency_overrides[verify_jwt] = override_verify_jwt
\ No newline at end of file
+app.dependency_overrides[verify_jwt] = override_verify_jwt
+
+### テストの時はプロセス内キャッシュ(app/cache.py)を無効化
+# テストケースごとにDBを作り直すので、前のテストケースの結果がメモリに残っていると困る
+local_cache.ttl = 0
+
+### テスト用の整理券のトークンの署名の鍵
+settings.ticket_token_secret = "quaint-test-ticket-token-secret"
+
+### Hebe・お知らせのスナップショット(app/broadcast.py)はテスト用のDBから読み、毎回読み直す
+# テストケースごとにDBを作り直すので、前のテストケースの値がメモリに残っていると困る
+broadcast.SessionLocal = TestingSessionLocal
+settings.broadcast_refresh = 0
+
+### テスト用の順番待ちのトークンの署名の鍵
+settings.waiting_room_secret = "quaint-test-waiting-room-secret"
@@ -0,0 +1,178 @@
+from typing import Dict, List, Tuple, Union
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+from app import models
+from app.db import SessionLocal
+
+"""
+公演ごとの整理券の人数の集計(event_ticket_counters)
+
+今までは整理券の取得・GET /groups/{group_id}/events/{event_id}/tickets・紙の整理券の追加のたびに、公演の全整理券をSUMしていた
+整理券の状態を変える処理(作成・キャンセル・もぎり・紙の整理券の追加と削除)が同じトランザクションで集計の行を更新し、読み込みは主キーで1行引くだけにする
+- 更新するときは、先に整理券の変更をflushしてから集計を更新する(下の作り直しとのロックの順番を揃えるため)
+- 集計の行がまだ無い公演(追加したばかり・このテーブルを作る前からある公演)は、最初に読み込んだ時にticketsから作る
+  ticketsを共有ロック付きでSUMするので、その間に作成・commitされる整理券も取りこぼさない
+  作り直しは呼び出し側とは別のセッション(同じエンジン)でcommitするので、get()は呼び出し側のトランザクションをcommit・rollbackしない
+  ただし別のトランザクションになるので、その公演の整理券を変更してまだcommitしていないセッションでget()を呼ばないこと(ロックを待ち続ける)
+- ずれてしまった場合は python -m app.ticket_counters でticketsから全公演分を作り直せる
+"""
+
+COUNTERS = ("taken", "used", "paper", "cancelled")
+
+# ticketsのstatusごとに、どの集計に人数を数えるか(pending, rejectなどはどこにも数えない)
+STATUS_COUNTERS: Dict[str, Tuple[str, ...]] = {
+    "active": ("taken",),
+    "used": ("taken", "used"),
+    "paper": ("paper",),
+    "cancelled": ("cancelled",),
+}
+
+
+def deltas(
+    person: int, from_status: Union[str, None], to_status: Union[str, None]
+) -> Dict[str, int]:
+    """整理券の状態がfrom_statusからto_statusに変わったときの集計の増減 作成はfrom_status=None"""
+    result = dict.fromkeys(COUNTERS, 0)
+    for counter in STATUS_COUNTERS.get(from_status, ()):
+        result[counter] -= person
+    for counter in STATUS_COUNTERS.get(to_status, ()):
+        result[counter] += person
+    return {counter: d for counter, d in result.items() if d != 0}
+
+
+def add(db: Session, event_id: str, event_deltas: Dict[str, int]) -> None:
+    """集計を増減する commitはしないので、呼び出し側で整理券の変更と一緒にcommitすること
+
+    集計の行がまだ無い公演は何もしない(最初に読み込んだ時にticketsから作られる)
+    """
+    if len(event_deltas) == 0:
+        return
+    table = models.EventTicketCounter
+    db.query(table).filter(table.event_id == event_id).update(
+        {getattr(table, c): getattr(table, c) + d for c, d in event_deltas.items()},
+        synchronize_session=False,
+    )
+
+
+def transition(
+    db: Session,
+    event_id: str,
+    person: int,
+    from_status: Union[str, None],
+    to_status: Union[str, None],
+) -> None:
+    """整理券1枚の状態の変化を集計に反映する(commitはしない)"""
+    add(db, event_id, deltas(person, from_status, to_status))
+
+
+def _count_from_tickets(db: Session, event_id: str) -> Dict[str, int]:
+    totals = dict.fromkeys(COUNTERS, 0)
+    rows = (
+        db.query(models.Ticket.status, func.sum(models.Ticket.person))
+        .filter(models.Ticket.event_id == event_id)
+        .group_by(models.Ticket.status)
+        .with_for_update(read=True)  # 作り直している間に整理券が作成・commitされないようにする
+        .all()
+    )
+    for status, person_sum in rows:
+        for counter in STATUS_COUNTERS.get(status, ()):
+            totals[counter] += int(person_sum or 0)
+    return totals
+
+
+def _select(db: Session, event_id: str, for_update: bool = False):
+    query = db.query(models.EventTicketCounter).filter(
+        models.EventTicketCounter.event_id == event_id
+    )
+    if for_update:
+        query = query.with_for_update()
+    # add()はセッション内のオブジェクトを更新しないので、必ずDBから読み直す
+    return query.populate_existing().first()
+
+
+def rebuild(db: Session, event_id: str) -> models.EventTicketCounter:
+    """公演の集計をticketsから作り直してcommitする
+
+    Args:
+        db (Session): Session
+        event_id (str): 公演のid
+
+    Returns:
+        models.EventTicketCounter: 作り直した集計
+    """
+    totals = _count_from_tickets(db, event_id)
+    counter = _select(db, event_id, for_update=True)
+    if counter is None:
+        counter = models.EventTicketCounter(event_id=event_id, **totals)
+        db.add(counter)
+    else:
+        for c, value in totals.items():
+            setattr(counter, c, value)
+    try:
+        db.commit()
+    except IntegrityError:
+        # 他のリクエストが同時に作った
+        db.rollback()
+        return _select(db, event_id)
+    return counter
+
+
+def get(db: Session, event_id: str) -> models.EventTicketCounter:
+    """公演の集計を返す 行が無ければ別のセッションでticketsから作る(dbはcommitしない)"""
+    counter = _select(db, event_id)
+    if counter is not None:
+        return counter
+    # 呼び出し側の変更を勝手にcommitしないように、作り直しは別のトランザクションで行う
+    own = SessionLocal(bind=db.get_bind(), expire_on_commit=False)
+    try:
+        counter = rebuild(own, event_id)
+        own.expunge(counter)
+    finally:
+        own.close()
+    return counter
+
+
+def forget(db: Session, event_id: str) -> None:
+    """公演の集計の行を削除する(公演の削除時 commitはしない)"""
+    db.query(models.EventTicketCounter).filter(
+        models.EventTicketCounter.event_id == event_id
+    ).delete(synchronize_session=False)
+
+
+def reconcile(
+    db: Session,
+) -> List[Tuple[str, Union[Dict[str, int], None], Dict[str, int]]]:
+    """全公演の集計をticketsから作り直す
+
+    Returns:
+        List[Tuple[str, Union[Dict[str, int], None], Dict[str, int]]]: 値が変わった公演の(id, 作り直す前, 作り直した後) 行が無かった公演は作り直す前がNone
+    """
+    changed = []
+    for (event_id,) in db.query(models.Event.id).order_by(models.Event.id).all():
+        before = _select(db, event_id)
+        before_values = (
+            None if before is None else {c: getattr(before, c) for c in COUNTERS}
+        )
+        after = rebuild(db, event_id)
+        after_values = {c: getattr(after, c) for c in COUNTERS}
+        if before_values != after_values:
+            changed.append((event_id, before_values, after_values))
+    return changed
+
+
+if __name__ == "__main__":
+    from app import ticket_stock
+
+    db = SessionLocal()
+    try:
+        changed = reconcile(db)
+    finally:
+        db.close()
+    for event_id, before, after in changed:
+        print(f"{event_id}: {before} -> {after}")
+        # Redisの残数もDBから作り直させる
+        ticket_stock.forget(event_id)
+    print(f"{len(changed)}公演の集計を修正しました")
@@ -0,0 +1,243 @@
+import math
+import threading
+from typing import Dict
+
+import redis
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from app import cache_keys, crud, schemas
+from app.config import settings
+from app.redis_possible import (
+    get_redis_if_possible,
+    register_script,
+    report_redis_error,
+)
+
+"""
+公演ごとの整理券の残り人数をRedisで管理する
+
+整理券取得のたびにcrud.count_tickets_for_event(ticketsテーブルのSUM)を実行すると、配布開始直後に大量のリクエストが同時にSUMを実行してDBが詰まる
+さらにSUMしてからINSERTするまでの間に他のリクエストが割り込めるので、在庫を超えて配布してしまうことがある
+そこでRedisに「あと何人分取得できるか」を公演ごとに持っておき、Luaスクリプトで残数の確認と減算をアトミックに行う
+- キーが無い(初回・期限切れ・LRUで追い出された)ときだけDBのSUMから残数を計算して作り直す
+  確保するたびにexpireを延ばすので、配布中の公演のキーが期限切れで作り直されることは無い
+- Redisに接続できないworkerは確保せずに503を返す
+  DBのSUMで判定すると、SUMしてからINSERTするまでの間の割り込みと、他のworkerがRedisで確保した分(まだcommitされていない)を数えられず、在庫を超えて配布してしまう
+  残数のキーは他のworkerが使っているので、削除・上書きはしない
+- Redisに接続できない間に戻した人数は覚えておき、次に接続できた時に残数に足す
+  問い合わせに失敗した時は戻せたか分からないので足さない(多く戻すと在庫を超えて配布してしまう)
+- 残数が変わったらSTOCK_CHANNELに公演のidを送る(整理券の枚数の配信 app/ticket_stream.py)
+"""
+
+TICKET_STOCK_EXPIRE = 60 * 60 * 24  # 残数キーのexpire DBからいつでも作り直せるので長めでいい
+STOCK_CHANNEL = "quaint-ticket-stock"  # 残数が変わった公演のidを送るpub/subのチャンネル
+
+# KEYS[1]:残数のキー ARGV[1]:確保する人数 ARGV[2]:STOCK_CHANNEL ARGV[3]:公演のid ARGV[4]:expire
+# 戻り値 -2:キーが無い(DBから作り直す必要がある) -1:残数が足りない 0以上:確保した後の残数
+_RESERVE_SCRIPT = """
+local left = redis.call('GET', KEYS[1])
+if not left then
+    return -2
+end
+local person = tonumber(ARGV[1])
+if tonumber(left) < person then
+    return -1
+end
+left = redis.call('DECRBY', KEYS[1], person)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('PUBLISH', ARGV[2], ARGV[3])
+return left
+"""
+
+# キーがある時だけ残数を戻す(キーが無い時は次の確保でDBから作り直されるので何もしない)
+# 引数は_RESERVE_SCRIPTと同じ
+_RELEASE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    local left = redis.call('INCRBY', KEYS[1], ARGV[1])
+    redis.call('PUBLISH', ARGV[2], ARGV[3])
+    return left
+end
+return -2
+"""
+
+# スクリプトのSHAはプロセス内で使い回す(EVALSHAが失敗した時だけスクリプト本体を送る)
+_reserve_script = register_script(_RESERVE_SCRIPT)
+_release_script = register_script(_RELEASE_SCRIPT)
+
+_pending: Dict[str, int] = {}  # Redisに接続できない間に戻した、公演ごとの人数
+_pending_lock = threading.Lock()
+
+
+def stock_key(event_id: str) -> str:
+    return cache_keys.ticket_stock_left(event_id)
+
+
+def _left_from_db(db: Session, event: schemas.Event) -> int:
+    return event.ticket_stock - crud.count_tickets_for_event(db, event)
+
+
+def _args(event_id: str, person: int):
+    return [person, STOCK_CHANNEL, event_id, TICKET_STOCK_EXPIRE]
+
+
+def _publish(conn: redis.Redis, event_id: str) -> None:
+    conn.publish(STOCK_CHANNEL, event_id)
+
+
+def _unavailable() -> HTTPException:
+    return HTTPException(
+        503,
+        detail="整理券の残数を確認できません。しばらくしてからもう一度お試しください",
+        headers={"Retry-After": str(math.ceil(settings.redis_breaker_cooldown))},
+    )
+
+
+def _add_pending(event_id: str, person: int) -> None:
+    with _pending_lock:
+        _pending[event_id] = _pending.get(event_id, 0) + person
+
+
+def _release_pending(conn: redis.Redis) -> None:
+    """Redisに接続できない間に戻した人数を残数に足す"""
+    with _pending_lock:
+        if len(_pending) == 0:
+            return
+        pending = list(_pending.items())
+        _pending.clear()
+    for i, (event_id, person) in enumerate(pending):
+        try:
+            _release_script(
+                keys=[stock_key(event_id)], args=_args(event_id, person), client=conn
+            )
+        except redis.RedisError:
+            # 失敗した公演は足せたか分からないので諦め(多く戻すと在庫を超えて配布してしまう)、残りは次に接続できた時に足す
+            for left_id, left_person in pending[i + 1 :]:
+                _add_pending(left_id, left_person)
+            raise
+
+
+def rebuild(db: Session, event: schemas.Event) -> int:
+    """DBのticketsから残数を計算してRedisのキーを上書きする
+
+    Args:
+        db (Session): Session
+        event (schemas.Event): 作り直す公演
+
+    Returns:
+        int: DBから計算した残数
+    """
+    left_tickets = _left_from_db(db, event)
+    conn = get_redis_if_possible()
+    if conn is None:
+        return left_tickets
+    try:
+        conn.set(stock_key(event.id), left_tickets, ex=TICKET_STOCK_EXPIRE)
+        _publish(conn, event.id)
+    except redis.RedisError:
+        report_redis_error()
+    return left_tickets
+
+
+def left(db: Session, event: schemas.Event) -> int:
+    """公演の整理券があと何人分残っているかを返す キーが無ければDBから作り直す"""
+    conn = get_redis_if_possible()
+    if conn is None:
+        return _left_from_db(db, event)
+    try:
+        _release_pending(conn)
+        cache_result = conn.get(stock_key(event.id))
+        if cache_result is not None:
+            return int(cache_result)
+        left_tickets = _left_from_db(db, event)
+        # 他のworkerが先に作っていたらそちらを優先する
+        conn.set(stock_key(event.id), left_tickets, ex=TICKET_STOCK_EXPIRE, nx=True)
+        return left_tickets
+    except redis.RedisError:
+        report_redis_error()
+        return _left_from_db(db, event)
+
+
+def reserve(db: Session, event: schemas.Event, person: int) -> bool:
+    """公演の整理券をperson人分確保する
+
+    確保できた後に整理券の作成に失敗した場合は、必ずrelease()で戻すこと
+
+    Args:
+        db (Session): Session
+        event (schemas.Event): 整理券を取得する公演
+        person (int): 確保する人数
+
+    Returns:
+        bool: 確保できた→True, 残数が足りない→False
+
+    Raises:
+        HTTPException: Redisに接続できない(503) DBのSUMでは判定しない
+    """
+    conn = get_redis_if_possible()
+    if conn is None:
+        raise _unavailable()
+    try:
+        _release_pending(conn)
+        result = _reserve_script(
+            keys=[stock_key(event.id)], args=_args(event.id, person), client=conn
+        )
+        if result == -2:
+            # 他のworkerが先に作っていたらそちらを優先する(使われている残数は上書きしない)
+            conn.set(
+                stock_key(event.id),
+                _left_from_db(db, event),
+                ex=TICKET_STOCK_EXPIRE,
+                nx=True,
+            )
+            result = _reserve_script(
+                keys=[stock_key(event.id)], args=_args(event.id, person), client=conn
+            )
+    except redis.RedisError:
+        report_redis_error()
+        raise _unavailable()
+    if result == -2:  # 作り直した直後に追い出された
+        raise _unavailable()
+    return result >= 0
+
+
+def release(event_id: str, person: int) -> None:
+    """確保していた・取得されていた整理券のperson人分を残数に戻す
+
+    Redisに接続できない間は覚えておき、次に接続できた時に戻す
+    問い合わせに失敗した時は戻せたか分からないので戻さない(少なく数える分には在庫を超えない)
+    ずれた残数は PUT /groups/{group_id}/events/{event_id}/tickets/stock で作り直せる
+    """
+    conn = get_redis_if_possible()
+    if conn is None:
+        _add_pending(event_id, person)
+        return
+    try:
+        _release_pending(conn)
+        _release_script(
+            keys=[stock_key(event_id)], args=_args(event_id, person), client=conn
+        )
+    except redis.RedisError:
+        report_redis_error()
+
+
+def forget(event_id: str) -> None:
+    """公演の残数のキーを削除する(公演の削除時など)"""
+    conn = get_redis_if_possible()
+    if conn is None:
+        return
+    try:
+        conn.delete(stock_key(event_id))
+        _publish(conn, event_id)
+    except redis.RedisError:
+        report_redis_error()
+
+
+def numbers(db: Session, event: schemas.Event) -> schemas.TicketsNumberData:
+    """GET /groups/{group_id}/events/{event_id}/tickets の整理券の枚数"""
+    left_tickets = left(db, event)
+    return schemas.TicketsNumberData(
+        taken_tickets=event.ticket_stock - left_tickets,
+        left_tickets=left_tickets,
+        stock=event.ticket_stock,
+    )
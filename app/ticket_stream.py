@@ -0,0 +1,136 @@
+import threading
+import time
+from typing import AsyncIterator, Set, Union
+
+import redis
+from sqlalchemy.orm import Session
+
+from app import crud, schemas, sse, ticket_stock
+from app.config import settings
+from app.db import SessionLocal
+from app.redis_possible import get_redis_if_possible, report_redis_error
+
+"""
+公演の整理券の枚数(TicketsNumberData)をServer-Sent Eventsで配信する
+
+配布開始の直後は、ブラウザが残数を見るために GET /groups/{group_id}/events/{event_id}/tickets を繰り返し読みに来る
+GET /groups/{group_id}/events/{event_id}/tickets/stream に接続しておけば、枚数が変わった時だけ送られてくる
+- 整理券の確保・キャンセルで残数が変わると、ticket_stock.pyがRedisのpub/sub(STOCK_CHANNEL)に公演のidを送る
+- 各workerは接続しているブラウザの数によらず、1つのスレッドで1つだけ購読する
+- 送られてきた公演は印を付けておき、TICKET_STREAM_INTERVAL秒に1回まとめて枚数を数えて送る
+  同じ公演の整理券が続けて取られても、間隔ごとに1回しか数えない・送らない
+- 通知を取りこぼした時やRedisに接続できない時のため、TICKET_STREAM_REFRESH秒ごとに配信中の全公演を数え直す
+- 枚数が前に送ったものと同じなら送らない(app/sse.py)
+"""
+
+_dirty: Set[str] = set()  # 枚数が変わった(かもしれない)公演
+_lock = threading.Lock()
+
+
+def subscribe(event_id: str) -> sse.Subscription:
+    """イベントループ上で呼ぶ"""
+    return _hub.subscribe(event_id)
+
+
+def unsubscribe(subscription: sse.Subscription) -> None:
+    _hub.unsubscribe(subscription)
+
+
+def connections() -> int:
+    """このworkerで配信中の接続の数"""
+    return _hub.connections()
+
+
+def snapshot(db: Session, event_id: str) -> Union[schemas.TicketsNumberData, None]:
+    """公演の今の枚数 公演が無ければNone"""
+    event = crud.get_event(db, event_id)
+    if not event:
+        return None
+    return ticket_stock.numbers(db, event)
+
+
+def _format(data: schemas.TicketsNumberData) -> str:
+    return sse.message("tickets", data.json())
+
+
+def stream(
+    subscription: sse.Subscription, first: schemas.TicketsNumberData
+) -> AsyncIterator[str]:
+    """text/event-streamの本文 接続した時と枚数が変わった時に `event: tickets` で枚数を送る 公演が削除されたら `event: deleted` を送って終了する"""
+
+    async def first_message() -> str:
+        return _format(first)
+
+    return sse.stream(subscription, first_message)
+
+
+def _flush(event_ids: Set[str]) -> None:
+    """公演の枚数を数えて、その公演を配信中の全ての接続に送る"""
+    if len(event_ids) == 0:
+        return
+    db = SessionLocal()
+    try:
+        for event_id in event_ids & _hub.keys():
+            try:
+                data = snapshot(db, event_id)
+            except Exception as e:
+                print(f"整理券の枚数を数えられません: {e}")
+                db.rollback()
+                continue
+            if data is None:
+                _hub.send(event_id, sse.message("deleted", "{}"), last=True)
+            else:
+                _hub.send(event_id, _format(data))
+    finally:
+        db.close()
+
+
+def _run() -> None:
+    pubsub = None
+    next_flush = 0.0
+    next_refresh = time.monotonic() + float(settings.ticket_stream_refresh)
+    while True:
+        interval = float(settings.ticket_stream_interval)
+        try:
+            if pubsub is None:
+                conn = get_redis_if_possible()
+                if conn is not None:
+                    pubsub = conn.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(ticket_stock.STOCK_CHANNEL)
+            if pubsub is None:
+                time.sleep(interval)
+            else:
+                message = pubsub.get_message(timeout=interval)
+                if message is not None:
+                    event_id = message["data"]
+                    if isinstance(event_id, bytes):
+                        event_id = event_id.decode()
+                    if event_id in _hub:
+                        with _lock:
+                            _dirty.add(event_id)
+        except redis.RedisError:
+            report_redis_error()
+            if pubsub is not None:
+                pubsub.close()
+            pubsub = None
+            time.sleep(interval)
+
+        now = time.monotonic()
+        if now < next_flush:
+            continue
+        next_flush = now + interval
+        with _lock:
+            if now >= next_refresh:
+                next_refresh = now + float(settings.ticket_stream_refresh)
+                event_ids = _hub.keys()
+            else:
+                event_ids = set(_dirty)
+            _dirty.clear()
+        try:
+            _flush(event_ids)
+        except Exception as e:
+            print(f"整理券の枚数を配信できません: {e}")
+
+
+# 枚数の変化を購読して配信するスレッド(最初の接続の時に1回だけ起動する)
+_hub = sse.Hub(sse.LazyThread(_run, "ticket-stream"))
@@ -0,0 +1,146 @@
+import threading
+import time
+from typing import Dict, List, Tuple, Union
+
+import redis
+from sqlalchemy.orm import Session
+
+from app import cache_keys, crud
+from app.config import settings
+from app.db import SessionLocal
+from app.redis_possible import (
+    get_redis_if_possible,
+    register_script,
+    report_redis_error,
+)
+
+"""
+団体ごとの投票数のランキングをRedisのsorted setで管理する
+
+団体ごとにcrud.get_group_votes(votesのCOUNT)を呼ぶと、結果の画面を作るのに団体の数だけクエリが走る
+投票のたびにsorted setの団体のスコアを1増やしておき、GET /votes/ranking はZRANGEの1回で全団体分を返す
+- キーが無い(初回・LRUで追い出された)ときは、DBの1回のGROUP BYから作り直す
+- 投票の加算とDBからの作り直しが同時に起きると加算が反映されないことがあるので、バックグラウンドのスレッドが
+  VOTE_RANKING_RECONCILE_INTERVAL秒ごとにDBから作り直す(Redisのロックで全workerのうち1つだけが実行する)
+- Redisに接続できないときはDBのGROUP BYで返す
+"""
+
+RECONCILE_LOCK_KEY = "lock:" + cache_keys.VOTE_RANKING + "-reconcile"
+
+# キーがある時だけ加算する(キーが無い時は次に読み込んだ時にDBから作り直されるので何もしない)
+_INCR_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('ZINCRBY', KEYS[1], 1, ARGV[1])
+end
+return false
+"""
+_incr_script = register_script(_INCR_SCRIPT)
+
+
+def _sorted(votes: Dict[str, int]) -> List[Tuple[str, int]]:
+    # 投票数の多い順 同数なら団体のid順
+    return sorted(votes.items(), key=lambda item: (-item[1], item[0]))
+
+
+def incr(group_id: str) -> None:
+    """団体の投票数を1増やす(crud.create_voteでcommitした後に呼ぶ)"""
+    conn = get_redis_if_possible()
+    if conn is None:
+        return
+    try:
+        _incr_script(keys=[cache_keys.VOTE_RANKING], args=[group_id], client=conn)
+    except redis.RedisError:
+        report_redis_error()
+
+
+def rebuild(db: Session) -> List[Tuple[str, int]]:
+    """DBから全団体の投票数を数えてRedisのキーを置き換える
+
+    Returns:
+        List[Tuple[str, int]]: (団体のid, 投票数)の投票数の多い順のリスト
+    """
+    votes = crud.count_votes_of_all_groups(db)
+    conn = get_redis_if_possible()
+    if conn is None:
+        return _sorted(votes)
+    try:
+        # 一時的なキーに作ってからRENAMEで入れ替えるので、作り直している途中の状態は読まれない
+        tmp_key = cache_keys.VOTE_RANKING + ":rebuild"
+        pipe = conn.pipeline()
+        pipe.delete(tmp_key)
+        if len(votes) != 0:
+            pipe.zadd(tmp_key, votes)
+            pipe.rename(tmp_key, cache_keys.VOTE_RANKING)
+        else:
+            pipe.delete(cache_keys.VOTE_RANKING)
+        pipe.execute()
+    except redis.RedisError:
+        report_redis_error()
+    return _sorted(votes)
+
+
+def ranking(db: Session) -> List[Tuple[str, int]]:
+    """全団体の(団体のid, 投票数)を投票数の多い順に返す"""
+    conn = get_redis_if_possible()
+    if conn is None:
+        return _sorted(crud.count_votes_of_all_groups(db))
+    try:
+        rows = conn.zrange(cache_keys.VOTE_RANKING, 0, -1, withscores=True)
+    except redis.RedisError:
+        report_redis_error()
+        return _sorted(crud.count_votes_of_all_groups(db))
+    if len(rows) == 0:
+        return rebuild(db)
+    return _sorted({group_id: int(score) for group_id, score in rows})
+
+
+def reconcile() -> bool:
+    """他のworkerがこの間隔の間に作り直していなければ、DBから作り直す
+
+    Returns:
+        bool: 作り直した→True
+    """
+    conn = get_redis_if_possible()
+    if conn is None:
+        return False
+    try:
+        acquired = conn.set(
+            RECONCILE_LOCK_KEY,
+            "1",
+            ex=max(1, int(settings.vote_ranking_reconcile_interval)),
+            nx=True,
+        )
+    except redis.RedisError:
+        report_redis_error()
+        return False
+    if not acquired:
+        return False
+    db = SessionLocal()
+    try:
+        rebuild(db)
+    finally:
+        db.close()
+    return True
+
+
+def _reconcile_loop() -> None:
+    while True:
+        try:
+            reconcile()
+        except Exception as e:
+            print(f"投票数のランキングを作り直せません: {e}")
+        time.sleep(settings.vote_ranking_reconcile_interval)
+
+
+_reconciler: Union[threading.Thread, None] = None
+
+
+def start_reconciler() -> None:
+    """投票数のランキングを定期的にDBから作り直すスレッドを起動する(workerの起動時に1回呼ぶ)"""
+    global _reconciler
+    if _reconciler is not None:
+        return
+    _reconciler = threading.Thread(
+        target=_reconcile_loop, name="vote-ranking-reconcile", daemon=True
+    )
+    _reconciler.start()
@@ -0,0 +1,364 @@
+import base64
+import hashlib
+import hmac
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Union
+
+import redis
+import ulid
+
+from app import cache_keys, db, schemas
+from app.config import settings
+from app.redis_possible import (
+    get_redis_if_possible,
+    register_script,
+    report_redis_error,
+)
+
+"""
+整理券の配布開始時の順番待ち(仮想の待合室)
+
+配布開始(sell_starts)の直後に全員が一斉にPOST /groups/{group_id}/events/{event_id}/tickets を呼ぶと、DBが詰まってしまう
+waiting_roomを有効にした公演では、整理券を取得する前に順番待ちの列に並んでもらう
+- POST .../waiting_room で並ぶと、Redisで採番した順番を署名したトークンが返ってくる(同じユーザーが並び直しても順番は変わらない)
+- GET .../waiting_room?token= で順番が来たかを確認する ログイン不要・DBを使わずRedisに1回問い合わせるだけ
+- 配布開始後は、公演ごとのトークンバケットで1秒にWAITING_ROOM_RATE人ずつ前から順に通す
+  バケットは状態を確認しに来たリクエストがLuaスクリプトでアトミックに進めるので、列を進めるためのスレッドは要らない
+- 通す人数は、このworkerのコネクションを待った時間(db_pool.PoolMonitor.wait_recent)が
+  WAITING_ROOM_TARGET_WAIT秒を超えた分だけ減らす(最低でもWAITING_ROOM_MIN_RATE人) 503を返している間は最低の人数にする
+- 整理券の取得では、順番が来たトークンを持っているかを確認する
+- Redisに接続できない時は順番待ちをせずに通す(今まで通り整理券の取得で判定する)
+- 列の長さ・待った時間などは /admin/metrics/waiting_room で確認できる
+
+トークンの形式: v1.<公演のid>.<列のid>.<順番>.<配布開始>.<並んだ時刻>.<ユーザー>.<署名(base64url)>
+- 配布開始・並んだ時刻はUNIX時間(秒)
+- 列のid はRedisの列を作り直した(期限切れ・追い出された)時に古いトークンを無効にするため
+- ユーザーはユーザーのidのSHA-256の先頭(他人のトークンでは整理券を取得できない)
+"""
+
+TOKEN_VERSION = "v1"
+JST = timezone(timedelta(hours=+9))
+WAITING_ROOM_EXPIRE = 60 * 60 * 24  # 列のキーのexpire 並ぶたびに延ばす
+POLL_MIN = 1  # 状態を確認する間隔の最短の秒数
+POLL_MAX = 10  # 状態を確認する間隔の最長の秒数
+
+# KEYS[1]:列の状態(hash) KEYS[2]:ユーザー → 順番(hash)
+# ARGV[1]:ユーザー ARGV[2]:列が無い時に作る列のid ARGV[3]:expire
+# 戻り値 {列のid, 順番}
+_JOIN_SCRIPT = """
+local queue_id = redis.call('HGET', KEYS[1], 'id')
+if not queue_id then
+    queue_id = ARGV[2]
+    redis.call('DEL', KEYS[1], KEYS[2])
+    redis.call('HSET', KEYS[1], 'id', queue_id, 'seq', 0, 'admitted', 0)
+end
+local position = redis.call('HGET', KEYS[2], ARGV[1])
+if not position then
+    position = redis.call('HINCRBY', KEYS[1], 'seq', 1)
+    redis.call('HSET', KEYS[2], ARGV[1], position)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return {queue_id, tonumber(position)}
+"""
+
+# トークンバケットを進めて、前から順に通す
+# KEYS[1]:列の状態(hash)
+# ARGV[1]:今の時刻(秒) ARGV[2]:1秒に通す人数 ARGV[3]:バケットの大きさ ARGV[4]:配布開始後なら1
+# 戻り値 {列のid, 並んだ人数, 通した人数} 列が無ければfalse(nil)
+_ADMIT_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'id', 'seq', 'admitted', 'tokens', 'ts')
+if not state[1] then
+    return false
+end
+local seq = tonumber(state[2])
+local admitted = tonumber(state[3])
+if ARGV[4] == '1' then
+    local now = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local burst = tonumber(ARGV[3])
+    local tokens = burst
+    if state[5] then
+        tokens = math.min(burst, tonumber(state[4]) + math.max(0, now - tonumber(state[5])) * rate)
+    end
+    local n = math.min(math.floor(tokens), seq - admitted)
+    if n > 0 then
+        admitted = admitted + n
+        tokens = tokens - n
+    end
+    redis.call('HSET', KEYS[1], 'admitted', admitted, 'tokens', tostring(tokens), 'ts', ARGV[1])
+end
+return {state[1], seq, admitted}
+"""
+
+_join_script = register_script(_JOIN_SCRIPT)
+_admit_script = register_script(_ADMIT_SCRIPT)
+
+_lock = threading.Lock()
+_metrics = {
+    "joins": 0,
+    "polls": 0,
+    "rejected": 0,  # 順番が来ていない・トークンが無効で整理券の取得を断った回数
+    "passed": 0,  # 順番が来たトークンで整理券の取得に進んだ回数
+    "wait_total": 0.0,
+    "wait_max": 0.0,
+}
+
+
+def enabled() -> bool:
+    """署名の鍵が設定されているか 設定されていなければ順番待ちをしない"""
+    return bool(settings.waiting_room_secret)
+
+
+def required(event: schemas.Event) -> bool:
+    """公演の整理券の取得に順番待ちが必要か"""
+    return event.waiting_room and enabled()
+
+
+def _sign(message: str) -> str:
+    digest = hmac.new(
+        settings.waiting_room_secret.encode(), message.encode(), hashlib.sha256
+    ).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def _user_hash(user_id: str) -> str:
+    digest = hashlib.sha256(user_id.encode()).digest()
+    return base64.urlsafe_b64encode(digest[:12]).decode()
+
+
+def _issue(event: schemas.Event, queue_id: str, position: int, user_id: str) -> str:
+    message = ".".join(
+        [
+            TOKEN_VERSION,
+            event.id,
+            queue_id,
+            str(position),
+            str(int(event.sell_starts.timestamp())),
+            str(int(time.time())),
+            _user_hash(user_id),
+        ]
+    )
+    return message + "." + _sign(message)
+
+
+def decode(token: str) -> Union[schemas.WaitingRoomTokenPayload, None]:
+    """トークンの署名を確認して中身を返す
+
+    Returns:
+        Union[schemas.WaitingRoomTokenPayload, None]: 署名が正しくない・形式が違う時はNone
+    """
+    if not enabled():
+        return None
+    message, sep, signature = token.rpartition(".")
+    if not sep or not hmac.compare_digest(_sign(message), signature):
+        return None
+    parts = message.split(".")
+    if len(parts) != 7 or parts[0] != TOKEN_VERSION:
+        return None
+    try:
+        return schemas.WaitingRoomTokenPayload(
+            event_id=parts[1],
+            queue_id=parts[2],
+            position=int(parts[3]),
+            sell_starts=datetime.fromtimestamp(int(parts[4]), JST),
+            joined_at=datetime.fromtimestamp(int(parts[5]), JST),
+            user=parts[6],
+        )
+    except ValueError:
+        return None
+
+
+def admission_rate() -> float:
+    """1秒に通す人数 DBのコネクションを待った時間が長いほど減らす"""
+    rate = float(settings.waiting_room_rate)
+    minimum = min(rate, float(settings.waiting_room_min_rate))
+    if db.sync_pool.shedding():
+        return minimum
+    target = float(settings.waiting_room_target_wait)
+    wait = db.sync_pool.wait_recent
+    if wait <= target:
+        return rate
+    return max(minimum, rate * target / wait)
+
+
+def _status(
+    token: str, payload: schemas.WaitingRoomTokenPayload, admitted: int, rate: float
+) -> schemas.WaitingRoomStatus:
+    ahead = max(0, payload.position - admitted - 1)
+    if payload.position <= admitted:
+        estimated_wait = 0.0
+    else:
+        # 配布開始前なら、開始までの時間も待つ
+        until_open = max(0.0, payload.sell_starts.timestamp() - time.time())
+        estimated_wait = until_open + (ahead + 1) / rate
+    return schemas.WaitingRoomStatus(
+        token=token,
+        position=payload.position,
+        ahead=ahead,
+        admitted=payload.position <= admitted,
+        estimated_wait=estimated_wait,
+        poll_after=min(POLL_MAX, max(POLL_MIN, estimated_wait / 2)),
+    )
+
+
+def pass_through() -> schemas.WaitingRoomStatus:
+    """並ばずに整理券の取得に進んでもらう(順番待ちをしない公演・Redisに接続できない時)"""
+    return schemas.WaitingRoomStatus(
+        token="",
+        position=0,
+        ahead=0,
+        admitted=True,
+        estimated_wait=0.0,
+        poll_after=POLL_MIN,
+    )
+
+
+def join(event: schemas.Event, user_id: str) -> Union[schemas.WaitingRoomStatus, None]:
+    """列に並ぶ 既に並んでいれば同じ順番を返す
+
+    Args:
+        event (schemas.Event): 整理券を取得する公演
+        user_id (str): 並ぶユーザーのid
+
+    Returns:
+        Union[schemas.WaitingRoomStatus, None]: 順番とトークン Redisに接続できない時は並ばずに通す 並んだ直後に列が作り直された時はNone
+    """
+    conn = get_redis_if_possible()
+    if conn is None:
+        return pass_through()
+    try:
+        queue_id, position = _join_script(
+            keys=[
+                cache_keys.waiting_room(event.id),
+                cache_keys.waiting_room_users(event.id),
+            ],
+            args=[user_id, ulid.new().str, WAITING_ROOM_EXPIRE],
+            client=conn,
+        )
+    except redis.RedisError:
+        report_redis_error()
+        return pass_through()
+    with _lock:
+        _metrics["joins"] += 1
+    token = _issue(event, queue_id, int(position), user_id)
+    return status(token)
+
+
+def _admit(
+    conn: redis.Redis, payload: schemas.WaitingRoomTokenPayload, rate: float
+) -> Union[List[str], None]:
+    opened = payload.sell_starts.timestamp() <= time.time()
+    return _admit_script(
+        keys=[cache_keys.waiting_room(payload.event_id)],
+        args=[repr(time.time()), repr(rate), repr(max(1.0, rate)), 1 if opened else 0],
+        client=conn,
+    )
+
+
+def status(token: str) -> Union[schemas.WaitingRoomStatus, None]:
+    """順番が来たかを確認する 配布開始後は列を進める
+
+    Returns:
+        Union[schemas.WaitingRoomStatus, None]: トークンが無効・列が作り直されていて並び直す必要がある時はNone
+    """
+    payload = decode(token)
+    if payload is None:
+        return None
+    conn = get_redis_if_possible()
+    if conn is None:
+        return pass_through()
+    rate = admission_rate()
+    try:
+        state = _admit(conn, payload, rate)
+    except redis.RedisError:
+        report_redis_error()
+        return pass_through()
+    with _lock:
+        _metrics["polls"] += 1
+    if not state or state[0] != payload.queue_id:
+        return None
+    return _status(token, payload, int(state[2]), rate)
+
+
+def check(event: schemas.Event, token: Union[str, None], user_id: str) -> bool:
+    """整理券の取得に進んでよいか(順番が来たトークンを持っているか)
+
+    Redisに接続できない時は、トークンが無くても通す
+    """
+    payload = decode(token) if token else None
+    if payload is not None and (
+        payload.event_id != event.id or payload.user != _user_hash(user_id)
+    ):
+        payload = None
+    passed = False
+    conn = get_redis_if_possible()
+    try:
+        if conn is not None:
+            if payload is not None:
+                state = conn.hmget(
+                    cache_keys.waiting_room(event.id), ["id", "admitted"]
+                )
+                passed = state[0] == payload.queue_id and payload.position <= int(
+                    state[1]
+                )
+        else:
+            passed = payload is not None or not token
+    except redis.RedisError:
+        report_redis_error()
+        passed = payload is not None or not token
+    with _lock:
+        if not passed:
+            _metrics["rejected"] += 1
+        elif payload is not None:
+            _metrics["passed"] += 1
+            # 並んでから(配布開始前に並んだ人は配布開始から)整理券の取得に進むまでの時間
+            waited = max(
+                0.0,
+                time.time()
+                - max(payload.sell_starts.timestamp(), payload.joined_at.timestamp()),
+            )
+            _metrics["wait_total"] += waited
+            if _metrics["wait_max"] < waited:
+                _metrics["wait_max"] = waited
+    return passed
+
+
+def queue(event_id: str) -> Union[schemas.WaitingRoomQueue, None]:
+    """公演の列の長さ 列が無い・Redisに接続できない時はNone"""
+    conn = get_redis_if_possible()
+    if conn is None:
+        return None
+    try:
+        seq, admitted = conn.hmget(
+            cache_keys.waiting_room(event_id), ["seq", "admitted"]
+        )
+    except redis.RedisError:
+        report_redis_error()
+        return None
+    if seq is None:
+        return None
+    return schemas.WaitingRoomQueue(
+        event_id=event_id,
+        joined=int(seq),
+        admitted=int(admitted),
+        waiting=int(seq) - int(admitted),
+    )
+
+
+def metrics(event_ids: List[str]) -> Dict[str, object]:
+    with _lock:
+        m = dict(_metrics)
+    queues = [queue(event_id) for event_id in event_ids]
+    return {
+        "joins": m["joins"],
+        "polls": m["polls"],
+        "rejected": m["rejected"],
+        "passed": m["passed"],
+        "wait_avg_ms": (m["wait_total"] / m["passed"] * 1000) if m["passed"] else 0.0,
+        "wait_max_ms": m["wait_max"] * 1000,
+        "rate": admission_rate(),
+        "queues": [q for q in queues if q is not None],
+    }
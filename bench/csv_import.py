@@ -0,0 +1,98 @@
+"""
+公演の一括追加(POST /support/events)のベンチマーク
+
+合成したシート(既定で1万行 sample-sheet-v2.csvと同じ書式)を、crud.convert_df → check_df → create_events_from_df の順に通して
+それぞれにかかった時間を測る
+
+使い方(.envのDB(MySQL)に作業用の団体と公演を作って最後に消す 本番のDBでは実行しないこと)
+$ python -m bench.csv_import --rows 10000
+--uriで別のDBを指定できる(テーブルが無ければ作る) 結果はDBによって大きく変わるので、比べる時は同じDBで測ること
+$ python -m bench.csv_import --rows 10000 --uri sqlite:///bench.db
+"""
+
+import argparse
+import random
+import time
+from io import StringIO
+
+import pandas as pd
+
+from sqlalchemy import create_engine
+
+from app import crud, models
+from app.db import Base, SessionLocal
+
+GROUP_PREFIX = "bench-csv-"
+TARGETS = ["everyone"] * 8 + ["paper", "b2c"]
+
+
+def make_sheet(rows: int, groups: int) -> str:
+    """sample-sheet-v2.csvと同じ書式のCSV(年・月・日と時刻が別の列)"""
+    lines = [
+        "group_id,eventname,lottery,target,ticket_stock,year,month,day,starts_at,ends_at,sell_starts,sell_ends"
+    ]
+    for i in range(rows):
+        hour = random.randint(9, 15)
+        lines.append(
+            f"{GROUP_PREFIX}{i % groups},公演{i},{random.choice(['TRUE', 'FALSE'])},"
+            f"{random.choice(TARGETS)},{random.randint(20, 200)},2024,9,{random.randint(14, 16)},"
+            f"{hour}:30:00,{hour + 1}:30:00,{hour - 1}:00:00,{hour}:00:00"
+        )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--groups", type=int, default=80)
+    parser.add_argument("--keep", action="store_true", help="作業用の団体と公演を消さない")
+    parser.add_argument("--uri", help=".envのDBの代わりに使うDBのURI")
+    args = parser.parse_args()
+
+    sheet = make_sheet(args.rows, args.groups)
+    group_ids = [f"{GROUP_PREFIX}{i}" for i in range(args.groups)]
+    if args.uri:
+        engine = create_engine(args.uri)
+        Base.metadata.create_all(engine)
+        db = SessionLocal(bind=engine)
+    else:
+        db = SessionLocal()
+    print(f"DB: {db.get_bind().url.render_as_string(hide_password=True)}")
+    try:
+        db.add_all(
+            [models.Group(id=group_id, groupname=group_id) for group_id in group_ids]
+        )
+        db.commit()
+
+        total = time.perf_counter()
+        start = time.perf_counter()
+        df = pd.read_csv(StringIO(sheet))
+        print(f"read_csv: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        start = time.perf_counter()
+        converted_df = crud.convert_df(df)
+        print(f"convert_df: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        start = time.perf_counter()
+        crud.check_df(db, converted_df)
+        print(f"check_df: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        start = time.perf_counter()
+        crud.create_events_from_df(db, converted_df)
+        print(f"create_events_from_df: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        print(f"{args.rows}行の合計: {(time.perf_counter() - total) * 1000:.1f} ms")
+    finally:
+        if not args.keep:
+            db.query(models.Event).filter(models.Event.group_id.in_(group_ids)).delete(
+                synchronize_session=False
+            )
+            db.query(models.Group).filter(models.Group.id.in_(group_ids)).delete(
+                synchronize_session=False
+            )
+            db.commit()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+ticketsの複合インデックスのベンチマーク
+
+合成した整理券(既定で300万件)を入れた作業用のテーブル(bench_tickets)で、よく使うクエリの実行計画(EXPLAIN)と実行時間を
+複合インデックスの追加前・追加後で比べる 複合インデックスはapp/models.pyのTicketに書いてあるものをそのまま使う
+
+使い方(.envのDBに作業用のテーブルを作って最後に消す 本番のDBでは実行しないこと)
+$ python -m bench.ticket_indexes --rows 3000000
+"""
+
+import argparse
+import random
+import time
+from typing import Dict, List
+
+import ulid
+from sqlalchemy import text
+
+from app import models
+from app.db import engine
+
+TABLE = "bench_tickets"
+STATUSES = ["active"] * 6 + ["used"] * 3 + ["cancelled"]  # 実際の比率に近づける
+
+QUERIES: Dict[str, str] = {
+    # crud.count_tickets_for_event
+    "count_tickets_for_event": f"SELECT SUM(person) FROM {TABLE}"
+    " WHERE event_id = :event_id AND status IN ('active', 'used')",
+    # GET /users/me/tickets/active, crud.check_qualified_for_ticket
+    "tickets_of_user": f"SELECT event_id FROM {TABLE}"
+    " WHERE owner_id = :owner_id AND status IN ('active', 'used')",
+    # crud.get_user_votable
+    "tickets_of_user_for_group": f"SELECT id FROM {TABLE}"
+    " WHERE owner_id = :owner_id AND group_id = :group_id AND status IN ('active', 'used')",
+}
+
+
+def composite_indexes() -> Dict[str, List[str]]:
+    return {
+        index.name: [c.name for c in index.columns]
+        for index in models.Ticket.__table__.indexes
+        if len(index.columns) > 1
+    }
+
+
+def create_table(conn, rows: int, events: int, users: int, groups: int) -> None:
+    conn.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+    # 外部キーは付けない(合成データなので) インデックスは追加前の状態(id, status)と同じにする
+    conn.execute(
+        text(
+            f"CREATE TABLE {TABLE} ("
+            " id VARCHAR(255) NOT NULL PRIMARY KEY,"
+            " created_at VARCHAR(255),"
+            " group_id VARCHAR(255),"
+            " event_id VARCHAR(255),"
+            " owner_id VARCHAR(255),"
+            " person INT,"
+            " is_family_ticket BOOL,"
+            " status VARCHAR(255) NOT NULL DEFAULT 'active',"
+            " INDEX ix_status (status), INDEX ix_event_id (event_id), INDEX ix_group_id (group_id)"
+            ")"
+        )
+    )
+    insert = text(
+        f"INSERT INTO {TABLE} (id, group_id, event_id, owner_id, person, is_family_ticket, status)"
+        " VALUES (:id, :group_id, :event_id, :owner_id, :person, 0, :status)"
+    )
+    batch = []
+    for i in range(rows):
+        event = random.randrange(events)
+        batch.append(
+            {
+                "id": ulid.new().str,
+                "group_id": f"group-{event % groups}",
+                "event_id": f"event-{event}",
+                "owner_id": f"user-{random.randrange(users)}",
+                "person": random.randint(1, 3),
+                "status": random.choice(STATUSES),
+            }
+        )
+        if len(batch) == 10000 or i == rows - 1:
+            conn.execute(insert, batch)
+            batch = []
+    conn.execute(text(f"ANALYZE TABLE {TABLE}"))
+
+
+def measure(conn, params: Dict[str, str], repeat: int) -> None:
+    for name, sql in QUERIES.items():
+        plan = conn.execute(text("EXPLAIN " + sql), params).mappings().all()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(text(sql), params).fetchall()
+        elapsed = (time.perf_counter() - start) / repeat * 1000
+        print(f"  {name}: {elapsed:.2f} ms")
+        for row in plan:
+            print(
+                f"    type={row['type']} key={row['key']} rows={row['rows']} Extra={row['Extra']}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=3000000)
+    parser.add_argument("--events", type=int, default=1500)
+    parser.add_argument("--users", type=int, default=500000)
+    parser.add_argument("--groups", type=int, default=80)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="作業用のテーブルを消さない")
+    args = parser.parse_args()
+
+    params = {"event_id": "event-0", "owner_id": "user-0", "group_id": "group-0"}
+    with engine.connect() as conn:
+        print(f"{TABLE}に{args.rows}件の整理券を作成中...")
+        start = time.perf_counter()
+        create_table(conn, args.rows, args.events, args.users, args.groups)
+        print(f"  {time.perf_counter() - start:.1f} s")
+
+        print("複合インデックスなし")
+        measure(conn, params, args.repeat)
+
+        for name, columns in composite_indexes().items():
+            conn.execute(
+                text(f"ALTER TABLE {TABLE} ADD INDEX {name} ({', '.join(columns)})")
+            )
+        conn.execute(text(f"ANALYZE TABLE {TABLE}"))
+
+        print("複合インデックスあり")
+        measure(conn, params, args.repeat)
+
+        if not args.keep:
+            conn.execute(text(f"DROP TABLE {TABLE}"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+# レプリカ(docker-compose-replica.yml)を使う時だけ、レプリカが接続するためのユーザーを作る
+# 実行権限が無いのでdocker-entrypoint.shからsourceされる(exitすると初期化ごと止まるのでifで囲む)
+if [ -n "$MYSQL_REPLICATION_USER" ] && [ -n "$MYSQL_REPLICATION_PASSWORD" ]; then
+	docker_process_sql --database=mysql <<-EOSQL
+		CREATE USER '${MYSQL_REPLICATION_USER}'@'%' IDENTIFIED BY '${MYSQL_REPLICATION_PASSWORD}';
+		GRANT REPLICATION SLAVE ON *.* TO '${MYSQL_REPLICATION_USER}'@'%';
+	EOSQL
+fi
@@ -0,0 +1,11 @@
+# docker-compose-replica.yml のレプリカの初回起動時に、プライマリ(db)からのレプリケーションを始める
+# プライマリのデータベース・ユーザー(docker_devなど)はレプリケーションで作られるので、レプリカではMYSQL_DATABASE・MYSQL_USERを設定しない
+docker_process_sql --database=mysql <<-EOSQL
+	CHANGE REPLICATION SOURCE TO
+		SOURCE_HOST='${MYSQL_SOURCE_HOST}',
+		SOURCE_USER='${MYSQL_REPLICATION_USER}',
+		SOURCE_PASSWORD='${MYSQL_REPLICATION_PASSWORD}',
+		SOURCE_AUTO_POSITION=1,
+		GET_SOURCE_PUBLIC_KEY=1;
+	START REPLICA;
+EOSQL
@@ -0,0 +1,30 @@
+"""公演の順番待ち
+
+Revision ID: 3f6b2d9a8c41
+Revises: e7d15a9c3b20
+Create Date: 2026-10-18 10:12:40.518203
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3f6b2d9a8c41"
+down_revision = "e7d15a9c3b20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "events",
+        sa.Column(
+            "waiting_room", sa.Boolean(), server_default=sa.text("0"), nullable=False
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("events", "waiting_room")
@@ -0,0 +1,112 @@
+"""eventの日時をvarcharからdatetimeに変更
+
+Revision ID: 9a3c1f27d5b4
+Revises: 5e583a6e225c
+Create Date: 2026-10-17 10:12:41.508213
+
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9a3c1f27d5b4"
+down_revision = "5e583a6e225c"
+branch_labels = None
+depends_on = None
+
+JST = timezone(timedelta(hours=+9))
+COLUMNS = ["starts_at", "ends_at", "sell_starts", "sell_ends"]
+BATCH_SIZE = 500
+
+# テーブルを作り直さずに 1. 新しいカラムを追加(NULL可) 2. 少しずつ値を埋める 3. 古いカラムと入れ替える の順に変更する
+# オンラインのマイグレーションではないので、流している間はAPIを止めること(星陵祭の期間中には流さない)
+# 2と3の間に古いバージョンのAPIが公演を追加・変更すると、新しいカラムがNULLのまま・古い値のままになり、
+# 3でNOT NULLにできずに失敗するか、その変更が古いカラムと一緒に消えてしまう
+# 少しずつ埋めるのは、1つのトランザクション・UPDATEを小さくしてレプリカへの反映を遅らせないため
+
+
+def _to_jst_naive(value: str) -> datetime:
+    time = datetime.fromisoformat(value)
+    if time.tzinfo is not None:
+        time = time.astimezone(JST).replace(tzinfo=None)
+    return time
+
+
+def _backfill(convert, old_suffix: str, new_suffix: str) -> None:
+    conn = op.get_bind()
+    events = sa.table(
+        "events",
+        sa.column("id", sa.VARCHAR(255)),
+        *[sa.column(c + old_suffix) for c in COLUMNS],
+        *[sa.column(c + new_suffix) for c in COLUMNS],
+    )
+    last_id = ""
+    while True:
+        rows = conn.execute(
+            sa.select([events.c.id] + [events.c[c + old_suffix] for c in COLUMNS])
+            .where(events.c.id > last_id)
+            .order_by(events.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if len(rows) == 0:
+            break
+        for row in rows:
+            conn.execute(
+                events.update()
+                .where(events.c.id == row[0])
+                .values({c + new_suffix: convert(v) for c, v in zip(COLUMNS, row[1:])})
+            )
+        last_id = rows[-1][0]
+
+
+def _swap(new_type) -> None:
+    # 埋めている間に追加された公演があれば、古いカラムを消す前に止める
+    conn = op.get_bind()
+    missing = conn.execute(
+        sa.text(
+            "SELECT COUNT(*) FROM events WHERE "
+            + " OR ".join(c + "_new IS NULL" for c in COLUMNS)
+        )
+    ).scalar()
+    if missing:
+        raise RuntimeError(
+            f"値を埋められていない公演が{missing}件あります。APIを止めてからもう一度流してください"
+        )
+    for c in COLUMNS:
+        op.drop_column("events", c)
+        op.alter_column(
+            "events",
+            c + "_new",
+            new_column_name=c,
+            existing_type=new_type,
+            nullable=False,
+        )
+
+
+def upgrade() -> None:
+    for c in COLUMNS:
+        op.add_column("events", sa.Column(c + "_new", sa.DateTime(), nullable=True))
+    _backfill(_to_jst_naive, "", "_new")
+    _swap(sa.DateTime())
+    op.create_index(
+        "ix_events_group_id_starts_at", "events", ["group_id", "starts_at"], unique=False
+    )
+    op.create_index(
+        "ix_events_sell_starts_sell_ends",
+        "events",
+        ["sell_starts", "sell_ends"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_events_sell_starts_sell_ends", table_name="events")
+    op.drop_index("ix_events_group_id_starts_at", table_name="events")
+    for c in COLUMNS:
+        op.add_column("events", sa.Column(c + "_new", sa.VARCHAR(255), nullable=True))
+    _backfill(lambda v: v.replace(tzinfo=JST).isoformat(), "", "_new")
+    _swap(sa.VARCHAR(255))
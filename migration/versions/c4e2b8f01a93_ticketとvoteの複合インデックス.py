@@ -0,0 +1,54 @@
+"""ticketとvoteの複合インデックス
+
+Revision ID: c4e2b8f01a93
+Revises: 9a3c1f27d5b4
+Create Date: 2026-10-17 11:03:27.194655
+
+"""
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "c4e2b8f01a93"
+down_revision = "9a3c1f27d5b4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_tickets_event_id_status_person",
+        "tickets",
+        ["event_id", "status", "person"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_tickets_owner_id_status_event_id",
+        "tickets",
+        ["owner_id", "status", "event_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_tickets_owner_id_group_id_status",
+        "tickets",
+        ["owner_id", "group_id", "status"],
+        unique=False,
+    )
+    # ユニーク制約を付ける前に、同じユーザーの同じ団体への重複した投票は最初の1票(ULIDが最小のもの)だけ残す
+    op.execute(
+        "DELETE v1 FROM votes v1 JOIN votes v2"
+        " ON v1.user_id = v2.user_id AND v1.group_id = v2.group_id AND v1.id > v2.id"
+    )
+    op.create_unique_constraint(
+        "unique_idx_userid_groupid", "votes", ["user_id", "group_id"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint("unique_idx_userid_groupid", "votes", type_="unique")
+    # MySQLはevent_idの外部キー用のインデックスを複合インデックスで置き換えているので、消す前に作り直しておく
+    op.create_index("ix_tickets_event_id", "tickets", ["event_id"], unique=False)
+    op.drop_index("ix_tickets_owner_id_group_id_status", table_name="tickets")
+    op.drop_index("ix_tickets_owner_id_status_event_id", table_name="tickets")
+    op.drop_index("ix_tickets_event_id_status_person", table_name="tickets")
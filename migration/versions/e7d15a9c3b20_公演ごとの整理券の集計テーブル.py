@@ -0,0 +1,39 @@
+"""公演ごとの整理券の集計テーブル
+
+Revision ID: e7d15a9c3b20
+Revises: c4e2b8f01a93
+Create Date: 2026-10-17 11:48:09.337120
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e7d15a9c3b20"
+down_revision = "c4e2b8f01a93"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "event_ticket_counters",
+        sa.Column("event_id", sa.VARCHAR(length=255), nullable=False),
+        sa.Column("taken", sa.Integer(), nullable=False),
+        sa.Column("used", sa.Integer(), nullable=False),
+        sa.Column("paper", sa.Integer(), nullable=False),
+        sa.Column("cancelled", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["event_id"],
+            ["events.id"],
+        ),
+        sa.PrimaryKeyConstraint("event_id"),
+    )
+    # 既存の公演の行はここでは作らない(最初に読み込んだ時にticketsから作られる)
+    # マイグレーション中に古いバージョンのAPIが作成した整理券は集計に反映されないため
+
+
+def downgrade() -> None:
+    op.drop_table("event_ticket_counters")